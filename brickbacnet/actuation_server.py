@@ -1,14 +1,246 @@
-#import dataservice_pb2 as dsrpc_data
-#import dataservice_pb2_grpc  as dsrpc_mtd
-#
-#class ActuationServer(dsrpc_mtd.DataserviceServicer):
-#    def viewSensorData(self, sensorId, context):
-#        value = 123
-#        return dsrpc_data.sensorData(uuid=sensorId.uuid, datapoint=str(value))
-#
-#    def recvSensorData(self, requestList, context):
-#        for sensor_data in requestList.list:
-#            print(sensor_data.uuid, sensor_data.datapoint)
-#
-#        # Log the write into a Database, see ActionLog
-#        return dsrpc_data.sendStatus(numOfFailures=0)
+""" Writes to BACnet points, sent ahead of the reads that poll their devices.
+    The writes to a device go out one batch at a time. While a batch is in flight, new writes
+    are queued, and a write to the same point and priority as a queued one replaces it. The next
+    batch carries the whole queue in one WritePropertyMultiple request if the device supports it.
+    `start_actuation_server` accepts writes over HTTP and answers with how long each one took to
+    be acknowledged by its device.
+"""
+
+import json
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from .bacnet_wrapper import WpmNotSupported
+from .metrics import METRICS
+
+
+WRITE_LATENCY_SECONDS = METRICS.histogram(
+    'b2b_write_latency_seconds', 'Time from receiving a write to its device acknowledging it',
+    ['status'])
+WRITES_COALESCED = METRICS.counter(
+    'b2b_writes_coalesced_total', 'Queued writes replaced by a newer write to the same point')
+WRITE_BATCH_SIZE = METRICS.histogram(
+    'b2b_write_batch_size', 'Writes sent to a device in one request',
+    buckets=(1, 2, 4, 8, 16, 32, 64))
+
+
+class QueuedWrite(object):
+    __slots__ = ('key', 'write', 'future', 'received_time')
+
+    def __init__(self, key, write, future, received_time):
+        self.key = key
+        self.write = write # the arguments of BacnetWrapper.write_async after the address.
+        self.future = future
+        self.received_time = received_time
+
+
+class Actuator(object):
+    """ Queues writes by device and sends them with `bacnet`. A batch holds up to `max_batch`
+        writes, and with `use_wpm` a batch of more than one is a single WritePropertyMultiple.
+        With `device_ids`, only the writes to those devices are accepted: the devices polled
+        through the same `bacnet`, whose reads the writes go ahead of.
+    """
+
+    def __init__(self, bacnet, sqlite_db, logger, max_batch=16, use_wpm=True, device_ids=None):
+        self.bacnet = bacnet
+        self.device_ids = None if device_ids is None else set(device_ids)
+        self.sqlite_db = sqlite_db
+        self.logger = logger
+        self.max_batch = max_batch
+        self.use_wpm = use_wpm
+        self.wpm_unsupported = set() # addresses of the devices that rejected the service.
+        self.lock = threading.Lock()
+        self.queues = {} # device address -> OrderedDict of key -> QueuedWrite
+        self.busy = set() # addresses of the devices with a batch in flight.
+        self.addrs = {} # device_id -> address
+
+    def resolve(self, target):
+        """ (device address, object type, instance) of a write `target`, which names its object
+            either by `uuid`, or by `device_id`, `object_type` and `instance`.
+        """
+        if 'uuid' in target:
+            obj = self.sqlite_db.find_obj_by_uuid(target['uuid'])
+            if obj is None:
+                raise KeyError('unknown uuid {0}'.format(target['uuid']))
+            dev_id, obj_type, instance = obj
+        else:
+            dev_id, obj_type, instance = \
+                int(target['device_id']), target['object_type'], int(target['instance'])
+        if self.device_ids is not None and dev_id not in self.device_ids:
+            raise KeyError('Device {0} is not polled by this connector'.format(dev_id))
+        if dev_id not in self.addrs:
+            self.addrs = self.sqlite_db.get_device_addresses()
+            if dev_id not in self.addrs:
+                raise KeyError('unknown device {0}'.format(dev_id))
+        return self.addrs[dev_id], obj_type, instance
+
+    def submit(self, target):
+        """ Queue a write described by a dict with the target object (see `resolve`), the
+            `value`, and optionally the `property` (presentValue by default), `priority`,
+            `index` and `type` (see BacnetWrapper.encode_value).
+            returns a Future of a dict with the write's `status` ('ok', 'error' or
+            'superseded'), its `latency` in seconds, and the `error` if it failed.
+        """
+        received_time = time.time()
+        future = Future()
+        try:
+            dev_addr, obj_type, instance = self.resolve(target)
+            write = {
+                'obj_type': obj_type,
+                'obj_instance': instance,
+                'prop_id': target.get('property', 'presentValue'),
+                'value': target['value'],
+                'prop_type': target.get('type', 'invalid prop_type'),
+                'indx': target.get('index'),
+                'priority': target.get('priority'),
+            }
+            # A value that cannot be encoded fails now rather than with the rest of its batch.
+            self.bacnet.encode_value(obj_type, write['prop_id'], write['value'],
+                                     write['prop_type'], write['indx'])
+        except Exception as e:
+            self.finish(QueuedWrite(None, target, future, received_time), 'error', e)
+            return future
+
+        key = (obj_type, instance, write['prop_id'], write['indx'], write['priority'])
+        queued = QueuedWrite(key, write, future, received_time)
+        with self.lock:
+            queue = self.queues.setdefault(dev_addr, OrderedDict())
+            superseded = queue.get(key)
+            queue[key] = queued # keeps the place of the write it replaces.
+            start = dev_addr not in self.busy
+            self.busy.add(dev_addr)
+        if superseded:
+            WRITES_COALESCED.inc()
+            self.finish(superseded, 'superseded')
+        if start:
+            self.send_batch(dev_addr)
+        return future
+
+    def write(self, targets):
+        """ Write each of `targets` and wait for all of them. returns the results of `submit`. """
+        futures = [self.submit(target) for target in targets]
+        return [future.result() for future in futures]
+
+    def send_batch(self, dev_addr):
+        """ Send the writes queued for a device, up to `max_batch` of them. """
+        with self.lock:
+            queue = self.queues.get(dev_addr)
+            if not queue:
+                self.busy.discard(dev_addr)
+                return
+            batch = [queue.popitem(last=False)[1] for _ in range(min(len(queue), self.max_batch))]
+        WRITE_BATCH_SIZE.observe(value=len(batch))
+        if self.use_wpm and len(batch) > 1 and dev_addr not in self.wpm_unsupported:
+            future = self.bacnet.write_multiple_async(dev_addr, [queued.write for queued in batch])
+            future.add_done_callback(lambda f: self.on_batch_written(dev_addr, batch, f))
+            return
+        remaining = [len(batch)]
+        def on_written(queued, f):
+            self.on_written(queued, f)
+            with self.lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            self.send_batch(dev_addr)
+        for queued in batch:
+            future = self.bacnet.write_async(dev_addr, **queued.write)
+            future.add_done_callback(lambda f, queued=queued: on_written(queued, f))
+
+    def on_written(self, queued, future):
+        try:
+            future.result()
+        except Exception as e:
+            self.finish(queued, 'error', e)
+            return
+        self.finish(queued, 'ok')
+
+    def on_batch_written(self, dev_addr, batch, future):
+        try:
+            results = future.result()
+        except WpmNotSupported as e:
+            self.logger.warning('Device at {0} falls back to single writes because "{1}"'
+                                .format(dev_addr, e))
+            self.wpm_unsupported.add(dev_addr)
+            self.requeue(dev_addr, batch)
+            results = []
+        except Exception as e:
+            results = [e] * len(batch)
+        not_tried = []
+        for queued, result in zip(batch, results):
+            if result is None:
+                not_tried.append(queued)
+            elif isinstance(result, Exception):
+                self.finish(queued, 'error', result)
+            else:
+                self.finish(queued, 'ok')
+        # The writes after a failed one in the same request go out again in the next batch.
+        self.requeue(dev_addr, not_tried)
+        self.send_batch(dev_addr)
+
+    def requeue(self, dev_addr, batch):
+        """ Put writes back at the front of their device's queue, unless newer writes to the
+            same points arrived meanwhile.
+        """
+        superseded = []
+        with self.lock:
+            queue = self.queues.setdefault(dev_addr, OrderedDict())
+            for queued in reversed(batch):
+                if queued.key in queue:
+                    superseded.append(queued)
+                    continue
+                queue[queued.key] = queued
+                queue.move_to_end(queued.key, last=False)
+        for queued in superseded:
+            WRITES_COALESCED.inc()
+            self.finish(queued, 'superseded')
+
+    def finish(self, queued, status, error=None):
+        latency = time.time() - queued.received_time
+        WRITE_LATENCY_SECONDS.observe(status, value=latency)
+        result = {'status': status, 'latency': latency}
+        if error is not None:
+            result['error'] = str(error)
+            self.logger.warning('Writing {0} failed because "{1}"'.format(queued.write, error))
+        queued.future.set_result(result)
+
+
+class ActuationHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128 # the commands of a demand-response event arrive all at once.
+
+
+def start_actuation_server(actuator, port, host=''):
+    """ Accept writes at http://host:port/write from a daemon thread.
+        The body of a POST is a write as described in `Actuator.submit`, or {"writes": [...]}
+        for several of them. The response, once every write finished, is {"results": [...]}
+        with a result of `Actuator.submit` for each write.
+    """
+    class ActuationHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path.split('?')[0] != '/write':
+                self.send_error(404)
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length))
+                targets = body['writes'] if 'writes' in body else [body]
+            except (ValueError, TypeError, KeyError) as e:
+                self.send_error(400, str(e))
+                return
+            results = actuator.write(targets)
+            payload = json.dumps({'results': results}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ActuationHTTPServer((host, port), ActuationHandler)
+    threading.Thread(target=server.serve_forever, name='actuation', daemon=True).start()
+    return server
@@ -6,13 +6,24 @@
 
 from pdb import set_trace as bp
 
+import time
+import random
 import threading
-from bacpypes.core import run
+from collections import deque
+from concurrent.futures import Future
+from bacpypes.core import run, deferred
 from bacpypes.pdu import Address
 from bacpypes.consolelogging import ConfigArgumentParser
-from bacpypes.iocb import IOCB
+from bacpypes.iocb import IOCB, PENDING, TimeoutError as IOCB_TIMEOUT
 from bacpypes.apdu import ReadPropertyRequest, \
-                          ReadPropertyACK, WritePropertyRequest, SimpleAckPDU
+                          ReadPropertyACK, WritePropertyRequest, SimpleAckPDU, \
+                          ReadPropertyMultipleRequest, ReadPropertyMultipleACK, \
+                          ReadAccessSpecification, RejectPDU, AbortPDU, \
+                          RejectReason, AbortReason, ComplexAckPDU, ErrorPDU, \
+                          UnconfirmedRequestPDU, SubscribeCOVRequest, \
+                          WritePropertyMultipleRequest, WriteAccessSpecification, \
+                          WritePropertyMultipleError
+from bacpypes.basetypes import PropertyReference, PropertyValue
 from bacpypes.constructeddata import Array, Any, AnyAtomic
 from bacpypes.primitivedata import Null, Atomic, Boolean, Unsigned, Integer, \
     Real, Double, OctetString, CharacterString, BitString, Date, Time, ObjectIdentifier, Enumerated
@@ -20,10 +31,88 @@ from bacpypes.primitivedata import ObjectType
 from bacpypes.local.device import LocalDeviceObject
 from bacpypes.app import BIPSimpleApplication
 from bacpypes.object import get_datatype
-from bacpypes.task import TaskManager
+from bacpypes.task import TaskManager, FunctionTask
 from bacpypes.pdu import Address
 
 from .common import make_obj_id
+from .pacing import Pacer
+from .rtt import RttEstimator, MAX_TIMEOUT
+
+# Whole-request failures that mean the device cannot serve ReadPropertyMultiple, or
+# WritePropertyMultiple, at all (as opposed to a transient failure such as a timeout).
+RPM_REJECT_REASONS = {RejectReason.unrecognizedService}
+RPM_ABORT_REASONS = {AbortReason.segmentationNotSupported,
+                     AbortReason.bufferOverflow,
+                     AbortReason.apduTooLong,
+                     }
+# Failures that mean a device or the network to it is overloaded, so requests are paced down.
+BUSY_ERROR_CODES = {'busy', 'deviceBusy', 'routerBusy', 'abortOutOfResources'}
+BUSY_ABORT_REASONS = {AbortReason.outOfResources,
+                      AbortReason.preemptedByHigherPriorityTask,
+                      AbortReason.applicationExceededReplyTime,
+                      AbortReason.tsmTimeout,
+                      AbortReason.serverTimeout,
+                      AbortReason.noResponse,
+                      }
+BUSY_REJECT_REASONS = {RejectReason.other, RejectReason.bufferOverflow}
+# Errors that will not go away by reading again.
+PERMANENT_ERROR_CODES = ('unknownObject', 'unknownProperty')
+RETRY_BASE_DELAY = 0.1 # seconds
+# After this many requests in a row time out, a device is considered unreachable. Only one
+# request at a time is sent to it until it answers again, and the queued ones fail fast.
+UNREACHABLE_AFTER = 3
+HEDGE_QUANTILE = 0.95 # a duplicate is sent once a request takes longer than this RTT quantile.
+
+
+class RpmNotSupported(Exception):
+    """ Raised when a device rejects ReadPropertyMultiple requests. """
+
+
+class WpmNotSupported(Exception):
+    """ Raised when a device rejects WritePropertyMultiple requests. """
+
+
+class RequestRefused(Exception):
+    """ Raised when a device answers a request with an error or a reject. """
+
+
+class RequestCancelled(Exception):
+    """ Another attempt of the same request got its response first. """
+
+
+class DeviceUnreachable(Exception):
+    """ Raised for the requests queued to a device that stopped answering. """
+
+
+def is_timeout(err):
+    """ bacpypes aborts a timed out IOCB with its own TimeoutError, a RuntimeError instance. """
+    return err is IOCB_TIMEOUT or isinstance(err, TimeoutError)
+
+def is_congestion(err):
+    if is_timeout(err):
+        return True
+    if isinstance(err, AbortPDU):
+        return err.apduAbortRejectReason in BUSY_ABORT_REASONS
+    if isinstance(err, RejectPDU):
+        return err.apduAbortRejectReason in BUSY_REJECT_REASONS
+    return getattr(err, 'errorCode', None) in BUSY_ERROR_CODES
+
+def is_permanent_error(e):
+    return any(code in str(e) for code in PERMANENT_ERROR_CODES)
+
+def raise_read_error(err):
+    if isinstance(err, DeviceUnreachable):
+        raise err
+    if is_timeout(err):
+        raise TimeoutError("READ ERROR: timed out")
+    raise Exception("READ ERROR:" + str(err))
+
+def gather_result(future):
+    """ The result of a finished read, or the exception it raised. """
+    try:
+        return future.result()
+    except Exception as e:
+        return e
 
 def get_port_from_ini(ini_file):
     args = ConfigArgumentParser().parse_args(["--ini", ini_file])
@@ -37,12 +126,498 @@ def get_static_object_types():
     return non_dynamic_objects
 
 
-class BacnetWrapper(BIPSimpleApplication):
+class DeviceWindow(object):
+    """ Confirmed requests to a single device: at most `size` of them are in flight and the
+        rest wait in FIFO order. With a `pacer`, the size adapts to how the device responds,
+        up to `max_size`. Urgent requests, such as writes, wait apart and are sent before the
+        others, in one slot more than `size` and without waiting for the pacer's gap.
+    """
+    __slots__ = ('max_size', 'inflight', 'pending', 'urgent', 'pacer', 'next_send_time',
+                 'wakeup', 'rtt', 'timeouts')
+
+    def __init__(self, size, pacer=None):
+        self.max_size = size
+        self.inflight = {} # invoke ID -> IOCB
+        self.pending = deque()
+        self.urgent = deque()
+        self.pacer = pacer
+        self.rtt = RttEstimator() # sets the timeouts of the requests to the device.
+        self.timeouts = 0 # requests in a row that timed out.
+        self.next_send_time = 0 # when the pacer's gap allows the next request.
+        self.wakeup = None # task that dispatches once the gap passes.
+
+    @property
+    def size(self):
+        return self.pacer.size if self.pacer else self.max_size
+
+
+class Transaction(object):
+    """ A confirmed request that is sent again, up to `retries` times, when it times out or the
+        device is busy, and may be hedged with a duplicate when it is slow. `future` resolves
+        to `decode` of the first attempt that gets a response.
+    """
+    __slots__ = ('request', 'decode', 'future', 'timeout', 'retries', 'urgent', 'attempts',
+                 'done', 'hedge_task')
+
+    def __init__(self, request, decode, future, timeout, retries, urgent=False):
+        self.request = request
+        self.decode = decode
+        self.future = future
+        self.timeout = timeout # seconds per attempt, or None for the device's RTT-based timeout.
+        self.retries = retries
+        self.urgent = urgent
+        self.attempts = [] # IOCBs
+        self.done = False
+        self.hedge_task = None
+
+
+class BacnetClient(BIPSimpleApplication):
+    """ A bacpypes application that keeps up to `max_inflight` confirmed requests in flight to
+        each device and exposes them as futures.
+    """
+
+    def __init__(self, local_device, local_address, max_inflight: int=1,
+                 adaptive_pacing: bool=False, retries: int=2, hedge: bool=False):
+        # Requests are retried here, with their own timeouts, instead of by the stack.
+        local_device.numberOfApduRetries = 0
+        local_device.apduTimeout = int(MAX_TIMEOUT * 1000)
+        BIPSimpleApplication.__init__(self, local_device, local_address)
+        self.max_inflight = max_inflight # default number of concurrent requests per device.
+        # With adaptive pacing, `max_inflight` is the most a device's window can grow to.
+        self.adaptive_pacing = adaptive_pacing
+        self.retries = retries
+        # With `hedge`, a duplicate of a request is sent once it takes longer than most do.
+        self.hedge = hedge
+        self.windows = {} # destination address -> DeviceWindow
+        # Called with (dev_addr, device_id, obj_type, obj_instance, {prop_id: value}) for each
+        # change-of-value notification.
+        self.cov_callback = None
+
+    def request_window(self, dev_addr):
+        """ The window of requests in flight to the device at `dev_addr`. Runs in the bacpypes
+            core thread, which is the only one that changes `windows`.
+        """
+        if not isinstance(dev_addr, Address):
+            dev_addr = Address(dev_addr)
+        window = self.windows.get(dev_addr)
+        if window is None:
+            pacer = Pacer(self.max_inflight) if self.adaptive_pacing else None
+            window = DeviceWindow(self.max_inflight, pacer)
+            self.windows[dev_addr] = window
+        return window
+
+    def set_max_inflight(self, dev_addr, max_inflight):
+        deferred(self._set_max_inflight, dev_addr, max_inflight)
+
+    def _set_max_inflight(self, dev_addr, max_inflight):
+        window = self.request_window(dev_addr)
+        window.max_size = max(1, int(max_inflight))
+        if window.pacer:
+            window.pacer.max_limit = window.max_size
+            window.pacer.limit = min(window.pacer.limit, window.max_size)
+
+    def get_pacing(self, dev_addr):
+        """ (requests in flight, seconds between requests) learned for a device, or None. """
+        if not isinstance(dev_addr, Address):
+            dev_addr = Address(dev_addr)
+        window = self.windows.get(dev_addr)
+        if window is None or not window.pacer:
+            return None
+        return window.pacer.limit, window.pacer.gap
+
+    def set_pacing(self, dev_addr, limit, gap):
+        """ Start the pacing of a device from what was learned before. Like the requests, it is
+            applied in the bacpypes core thread, ahead of the requests submitted after it.
+        """
+        deferred(self._set_pacing, dev_addr, limit, gap)
+
+    def _set_pacing(self, dev_addr, limit, gap):
+        window = self.request_window(dev_addr)
+        if window.pacer:
+            window.pacer.limit = min(max(1, limit), window.pacer.max_limit)
+            window.pacer.gap = gap
+
+    def process_io(self, iocb):
+        """ Queue a confirmed request in the window of its destination instead of the
+            one-at-a-time queue bacpypes keeps per address. Runs in the bacpypes core thread.
+        """
+        apdu = iocb.args[0]
+        if isinstance(apdu, UnconfirmedRequestPDU):
+            return BIPSimpleApplication.process_io(self, iocb)
+        window = self.request_window(apdu.pduDestination)
+        txn = getattr(iocb, 'txn', None)
+        queue = window.urgent if txn and txn.urgent else window.pending
+        if txn and len(txn.attempts) > 1:
+            # Retries and hedges have waited longer than the other requests.
+            queue.appendleft(iocb)
+        else:
+            queue.append(iocb)
+        self._dispatch(apdu.pduDestination, window)
+
+    def _dispatch(self, dev_addr, window):
+        while window.urgent or window.pending:
+            queue = window.urgent or window.pending
+            urgent = queue is window.urgent
+            iocb = queue[0]
+            if iocb.ioState != PENDING or iocb.ioComplete.is_set():
+                # timed out while it was waiting for a slot.
+                queue.popleft()
+                continue
+            if self._is_unreachable(window) and window.inflight:
+                queue.popleft()
+                self.abort_io(iocb, DeviceUnreachable(f"{dev_addr} is not answering"))
+                continue
+            # An urgent request does not wait for a full window of reads to drain.
+            if len(window.inflight) >= window.size + urgent:
+                break
+            if window.pacer and window.pacer.gap and not urgent:
+                now = time.time()
+                if now < window.next_send_time:
+                    if window.wakeup is None:
+                        window.wakeup = FunctionTask(self._wake_up, dev_addr, window)
+                        window.wakeup.install_task(delta=window.next_send_time - now)
+                    return
+                window.next_send_time = now + window.pacer.gap
+            queue.popleft()
+            apdu = iocb.args[0]
+            apdu.apduInvokeID = self.smap.get_next_invoke_id(dev_addr)
+            window.inflight[apdu.apduInvokeID] = iocb
+            self.active_io(iocb)
+            iocb.add_callback(self._release, dev_addr, apdu.apduInvokeID)
+            iocb.sent_time = time.time()
+            txn = getattr(iocb, 'txn', None)
+            if txn:
+                # The timeout starts once the request is sent, not while it waits for a slot.
+                iocb.set_timeout(txn.timeout or window.rtt.timeout)
+                if self.hedge and txn.hedge_task is None:
+                    self._schedule_hedge(txn, window)
+            self._app_request(apdu)
+
+    def _is_unreachable(self, window):
+        return window is not None and window.timeouts >= UNREACHABLE_AFTER
+
+    def _wake_up(self, dev_addr, window):
+        window.wakeup = None
+        self._dispatch(dev_addr, window)
+
+    def _release(self, iocb, dev_addr, invoke_id):
+        window = self.windows[dev_addr]
+        if window.inflight.get(invoke_id) is iocb:
+            del window.inflight[invoke_id]
+            if iocb.ioResponse is not None:
+                rtt = time.time() - iocb.sent_time
+                window.timeouts = 0
+                window.rtt.on_response(rtt)
+                if window.pacer:
+                    window.pacer.on_response(rtt)
+            elif iocb.ioError is not None:
+                if is_timeout(iocb.ioError):
+                    window.timeouts += 1
+                    window.rtt.on_timeout()
+                elif not isinstance(iocb.ioError, RequestCancelled):
+                    window.timeouts = 0 # an error is still an answer.
+                if window.pacer and is_congestion(iocb.ioError):
+                    window.pacer.on_congestion(iocb.sent_time)
+        self._dispatch(dev_addr, window)
+
+    def confirmation(self, apdu):
+        """ Match an ack, error, reject or abort to its request by the invoke ID. """
+        window = self.windows.get(apdu.pduSource)
+        iocb = window.inflight.get(apdu.apduInvokeID) if window else None
+        if iocb is None: # a late response to a request that already timed out.
+            return
+        if isinstance(apdu, (SimpleAckPDU, ComplexAckPDU)):
+            self.complete_io(iocb, apdu)
+        elif isinstance(apdu, (ErrorPDU, RejectPDU, AbortPDU)):
+            self.abort_io(iocb, apdu)
+        else:
+            raise RuntimeError("unrecognized APDU type")
+
+    def submit(self, request, decode, timeout=None, retries=None, urgent=False):
+        """ Send a confirmed request without waiting for the response.
+            Each attempt times out after `timeout` seconds, or after the timeout derived from
+            the device's round-trip times if it is None, and is retried up to `retries` times
+            (`self.retries` if None). An `urgent` request is sent ahead of the others queued
+            to its device.
+            returns a Future that resolves to `decode(iocb)`, or to the raised exception.
+        """
+        future = Future()
+        txn = Transaction(request, decode, future, timeout,
+                          self.retries if retries is None else retries, urgent)
+        deferred(self._send_attempt, txn)
+        return future
+
+    def _send_attempt(self, txn):
+        if txn.done:
+            return
+        iocb = IOCB(txn.request)
+        iocb.txn = txn
+        iocb.add_callback(self._on_attempt_complete, txn)
+        txn.attempts.append(iocb)
+        self.request_io(iocb)
+
+    def _schedule_hedge(self, txn, window):
+        delay = window.rtt.percentile(HEDGE_QUANTILE)
+        if delay is not None and delay < (txn.timeout or window.rtt.timeout):
+            txn.hedge_task = FunctionTask(self._send_attempt, txn)
+            txn.hedge_task.install_task(delta=delay)
+
+    def _on_attempt_complete(self, iocb, txn):
+        if txn.done:
+            return
+        err = iocb.ioError
+        if err is not None and is_congestion(err):
+            if any(not attempt.ioComplete.is_set() for attempt in txn.attempts):
+                return # a hedged attempt may still get a response.
+            # A device that stopped answering is probed by one attempt at a time instead.
+            if txn.retries > 0 and \
+               not self._is_unreachable(self.windows.get(txn.request.pduDestination)):
+                txn.retries -= 1
+                num_retried = len(txn.attempts) - 1
+                FunctionTask(self._send_attempt, txn).install_task(
+                    delta=random.uniform(0, RETRY_BASE_DELAY * 2 ** num_retried))
+                return
+        txn.done = True
+        if txn.hedge_task is not None:
+            txn.hedge_task.suspend_task()
+        for attempt in txn.attempts:
+            if attempt is not iocb:
+                self.abort_io(attempt, RequestCancelled())
+        if txn.future.cancelled():
+            return
+        try:
+            txn.future.set_result(txn.decode(iocb))
+        except Exception as e:
+            txn.future.set_exception(e)
+
+    def read_async(self,
+                   dev_addr: str,
+                   obj_type: str,
+                   obj_instance: int,
+                   prop_id: str,
+                   indx: int=None,
+                   timeout: float=None,
+                   ):
+        """ Start reading a property of a specific object from a device at `dev_addr`.
+            returns a Future of the value.
+        """
+        obj_id = make_obj_id(obj_type, obj_instance)
+        obj_id = ObjectIdentifier(obj_id).value
+        datatype = get_datatype(obj_id[0], prop_id)
+        if not datatype:
+            future = Future()
+            future.set_exception(
+                Exception(f"{prop_id}:invalid property for object type '{obj_type}'"))
+            return future
+
+        # build a request
+        request = ReadPropertyRequest(
+            objectIdentifier=obj_id,
+            propertyIdentifier=prop_id,
+            )
+        request.pduDestination = Address(dev_addr)
+
+        if indx is not None:
+            request.propertyArrayIndex = indx
+
+        return self.submit(request, self._decode_read, timeout)
+
+    def read_many(self, points, prop_id='presentValue', timeout=None):
+        """ read `prop_id` of many objects, keeping up to the window of each device in flight.
+            `points` is a list of (dev_addr, obj_type, obj_instance).
+            returns the values in the order of `points`, where a failed read is its Exception.
+        """
+        futures = [self.read_async(dev_addr, obj_type, obj_instance, prop_id, timeout=timeout)
+                   for dev_addr, obj_type, obj_instance in points]
+        return [gather_result(future) for future in futures]
+
+    def _decode_read(self, iocb):
+        if iocb.ioError:
+            raise_read_error(iocb.ioError)
+
+        if iocb.ioResponse:
+            apdu = iocb.ioResponse
+            #print("read resp %s"%apdu)
+            if not isinstance(apdu, ReadPropertyACK): #should be an ack to our request
+                raise Exception("Response not an ACK")
+
+            return self._cast_value(apdu.objectIdentifier[0],
+                                    apdu.propertyIdentifier,
+                                    apdu.propertyArrayIndex,
+                                    apdu.propertyValue,
+                                    )
+
+        else:
+            raise Exception("ioError or ioResponse expected")
+
+    def read_multiple_async(self,
+                            dev_addr: str,
+                            obj_props: dict,
+                            timeout: float=None,
+                            ):
+        """ Start reading several properties of several objects from a device at `dev_addr`
+            with a single ReadPropertyMultiple request. returns a Future of the results
+            described in `do_read_multiple`.
+        """
+        read_access_specs = []
+        for (obj_type, obj_instance), prop_ids in obj_props.items():
+            obj_id = ObjectIdentifier(make_obj_id(obj_type, obj_instance)).value
+            prop_refs = [PropertyReference(propertyIdentifier=prop_id) for prop_id in prop_ids]
+            read_access_specs.append(ReadAccessSpecification(objectIdentifier=obj_id,
+                                                             listOfPropertyReferences=prop_refs,
+                                                             ))
+        request = ReadPropertyMultipleRequest(listOfReadAccessSpecs=read_access_specs)
+        request.pduDestination = Address(dev_addr)
+
+        return self.submit(request, self._decode_read_multiple, timeout)
+
+    def do_read_multiple(self,
+                         dev_addr: str,
+                         obj_props: dict,
+                         timeout: float=None,
+                         ):
+        """ read several properties of several objects from a device at `dev_addr` with a single
+            ReadPropertyMultiple request.
+            `obj_props` maps (obj_type, obj_instance) to a list of property identifiers.
+            returns {(obj_type, obj_instance): {prop_id: value}}, where the value is an Exception
+            for the properties the device could not read or left out of its ACK.
+            if the device does not support the service, raise RpmNotSupported.
+            if the whole request fails otherwise, raise exception
+        """
+        return self.read_multiple_async(dev_addr, obj_props, timeout).result()
+
+    def _decode_read_multiple(self, iocb):
+        if iocb.ioError:
+            err = iocb.ioError
+            dev_addr = iocb.args[0].pduDestination
+            if (isinstance(err, RejectPDU) and err.apduAbortRejectReason in RPM_REJECT_REASONS) or \
+               (isinstance(err, AbortPDU) and err.apduAbortRejectReason in RPM_ABORT_REASONS):
+                raise RpmNotSupported(f"{dev_addr} does not support ReadPropertyMultiple: {err}")
+            raise_read_error(err)
+
+        if not iocb.ioResponse:
+            raise Exception("ioError or ioResponse expected")
+
+        apdu = iocb.ioResponse
+        if not isinstance(apdu, ReadPropertyMultipleACK):
+            raise Exception("Response not an ACK")
+
+        results = {}
+        for result in apdu.listOfReadAccessResults:
+            obj_type, obj_instance = result.objectIdentifier
+            obj_res = results.setdefault((obj_type, obj_instance), {})
+            for element in result.listOfResults:
+                prop_id = element.propertyIdentifier
+                read_result = element.readResult
+                if read_result.propertyAccessError is not None:
+                    error = read_result.propertyAccessError
+                    obj_res[prop_id] = Exception(f"{prop_id}:{error.errorClass}:{error.errorCode}")
+                    continue
+                try:
+                    obj_res[prop_id] = self._cast_value(obj_type,
+                                                        prop_id,
+                                                        element.propertyArrayIndex,
+                                                        read_result.propertyValue,
+                                                        )
+                except Exception as e:
+                    obj_res[prop_id] = e
+        # A device may leave objects or properties out of the ACK instead of reporting errors.
+        for spec in iocb.args[0].listOfReadAccessSpecs:
+            obj_key = tuple(spec.objectIdentifier)
+            missing = 'object:unknownObject' if obj_key not in results else \
+                'property:unknownProperty'
+            obj_res = results.setdefault(obj_key, {})
+            for prop_ref in spec.listOfPropertyReferences:
+                prop_id = prop_ref.propertyIdentifier
+                if prop_id not in obj_res:
+                    obj_res[prop_id] = Exception(
+                        f"{prop_id}:{missing}: left out of the ReadPropertyMultiple ACK")
+        return results
+
+    def subscribe_cov_async(self,
+                            dev_addr: str,
+                            obj_type: str,
+                            obj_instance: int,
+                            process_id: int,
+                            lifetime: int,
+                            confirmed: bool=False,
+                            timeout: float=None,
+                            ):
+        """ Start subscribing to the changes of an object for `lifetime` seconds.
+            returns a Future that resolves to True once the device accepts the subscription.
+        """
+        request = SubscribeCOVRequest(
+            subscriberProcessIdentifier=process_id,
+            monitoredObjectIdentifier=ObjectIdentifier(make_obj_id(obj_type, obj_instance)).value,
+            issueConfirmedNotifications=confirmed,
+            lifetime=lifetime,
+            )
+        request.pduDestination = Address(dev_addr)
+
+        return self.submit(request, self._decode_simple_ack, timeout)
+
+    def _decode_simple_ack(self, iocb):
+        if iocb.ioError:
+            if isinstance(iocb.ioError, (ErrorPDU, RejectPDU)):
+                raise RequestRefused("REFUSED:" + str(iocb.ioError))
+            raise Exception("ioError: " + str(iocb.ioError))
+
+        if not isinstance(iocb.ioResponse, SimpleAckPDU):
+            raise Exception("Response Not an ACK")
+
+        return True
+
+    def do_UnconfirmedCOVNotificationRequest(self, apdu):
+        self._notify_cov(apdu)
+
+    def do_ConfirmedCOVNotificationRequest(self, apdu):
+        self._notify_cov(apdu)
+        self.response(SimpleAckPDU(context=apdu))
+
+    def _notify_cov(self, apdu):
+        if self.cov_callback is None:
+            return
+        obj_type, obj_instance = apdu.monitoredObjectIdentifier
+        values = {}
+        for element in apdu.listOfValues:
+            prop_id = element.propertyIdentifier
+            try:
+                values[prop_id] = self._cast_value(obj_type, prop_id,
+                                                   element.propertyArrayIndex, element.value)
+            except Exception as e:
+                values[prop_id] = e
+        self.cov_callback(str(apdu.pduSource), apdu.initiatingDeviceIdentifier[1],
+                          obj_type, obj_instance, values)
+
+    def _cast_value(self, obj_type, prop_id, array_index, property_value):
+        """ decode a property value received in an ACK into a python value. """
+        datatype = get_datatype(obj_type, prop_id)
+        if not datatype:
+            raise Exception("unknown datatype")
+
+        # special case for array parts, others are managed by cast_out
+        if issubclass(datatype, Array) and (array_index is not None):
+            if array_index == 0:
+                value = property_value.cast_out(Unsigned)
+            else:
+                value = property_value.cast_out(datatype.subtype)
+        else:
+            value = property_value.cast_out(datatype)
+
+        if type(value) in [Enumerated, Unsigned]:
+            return value.__dict__["value"]
+
+        return value
+
+
+
+class BacnetWrapper(BacnetClient):
     """ The class that wraps over the underlying bacnet library (bacpypes).
         Provide simple read and write functions.
     """
 
-    def __init__(self, ini_file, overriding_port: int=None):
+    def __init__(self, ini_file, overriding_port: int=None, max_inflight: int=1,
+                 adaptive_pacing: bool=False, retries: int=2, hedge: bool=False):
         self.args = ConfigArgumentParser().parse_args(["--ini", ini_file])
         #addr = Address(self.args.ini.address)
         #if overriding_port:
@@ -52,7 +627,8 @@ class BacnetWrapper(BIPSimpleApplication):
             ip, port = self.args.ini['address'].split(':')
             self.args.ini['address'] = ip + ':' + str(overriding_port)
         self.this_device = LocalDeviceObject(ini=self.args.ini)
-        BIPSimpleApplication.__init__(self, self.this_device, self.args.ini['address'])
+        BacnetClient.__init__(self, self.this_device, self.args.ini['address'], max_inflight,
+                              adaptive_pacing, retries, hedge)
         self.taskman = TaskManager()
         self.datatype_map = {
                 'b': Boolean,
@@ -88,74 +664,17 @@ class BacnetWrapper(BIPSimpleApplication):
         """ read a property of a specific object from a device at `dev_addr`.
             if read fails, raise exception
         """
-        obj_id = make_obj_id(obj_type, obj_instance)
-        obj_id = ObjectIdentifier(obj_id).value
-        datatype = get_datatype(obj_id[0], prop_id)
-        if not datatype:
-            raise Exception(f"{prop_id}:invalid property for object type '{obj_type}'")
-
-        # build a request
-        request = ReadPropertyRequest(
-            objectIdentifier=obj_id,
-            propertyIdentifier=prop_id,
-            )
-        request.pduDestination = Address(dev_addr)
-
-        if indx is not None:
-            request.propertyArrayIndex = indx
-
-        iocb = IOCB(request)
-        self.request_io(iocb)
-
-        iocb.set_timeout(3)
-        iocb.wait()
-
-        if iocb.ioError:
-            raise Exception("READ ERROR:" + str(iocb.ioError))
-
-        if iocb.ioResponse:
-            apdu = iocb.ioResponse
-            #print("read resp %s"%apdu)
-            if not isinstance(apdu, ReadPropertyACK): #should be an ack to our request
-                raise Exception("Response not an ACK")
-
-            datatype = get_datatype(apdu.objectIdentifier[0], apdu.propertyIdentifier)
-            if not datatype:
-                raise Exception("unknown datatype")
-
-            # special case for array parts, others are managed by cast_out
-            if issubclass(datatype, Array) and (apdu.propertyArrayIndex is not None):
-                if apdu.propertyArrayIndex == 0:
-                    value = apdu.propertyValue.cast_out(Unsigned)
-                else:
-                    value = apdu.propertyValue.cast_out(datatype.subtype)
-            else:
-                value = apdu.propertyValue.cast_out(datatype)
-
-            if type(value) in [Enumerated, Unsigned]:
-                return value.__dict__["value"]
-
-            return value
-
-        else:
-            raise Exception("ioError or ioResponse expected")
-
+        return self.read_async(dev_addr, obj_type, obj_instance, prop_id, indx).result()
 
-    def do_write(self, device_id, object_type, object_instance, prop_id, value, \
-                 prop_type='invalid prop_type', indx=None, priority=None):
-        """ do_write( <object id>, <type>, <instance>, <property_id>, <value>,
-                      <optional property type>, <optional index>, <optional priority> )
-            write a property to a specific object.
-            return Nothing if successful, else Raise an exception which can be logged.
+    def encode_value(self, obj_type, prop_id, value, prop_type='invalid prop_type', indx=None):
+        """ The bacpypes value to write to a property of an object type.
+            `prop_type` is the key in `datatype_map` of the type of a property that can take any
+            atomic value, and 'null' relinquishes a commanded value.
+            raise an exception if the value cannot be encoded.
         """
-        addrlist = device_id["mac"] #4 bytes of address, 2 bytes of port
-        if len(addrlist) != 6:
-            raise IOError('invalid address')
-        addr = ".".join(str(x) for x in addrlist[:4])  + ":" + str((addrlist[4]<<8) + addrlist[5])
-
-        obj_id = str(object_type) + ":" + str(object_instance)
-        obj_id = ObjectIdentifier(obj_id).value
-        datatype = get_datatype(obj_id[0], prop_id)
+        datatype = get_datatype(obj_type, prop_id)
+        if not datatype:
+            raise Exception(f"{prop_id}:invalid property for object type '{obj_type}'")
 
         # change atomic values into something encodeable, null is a special case
         if value == 'null':
@@ -184,13 +703,32 @@ class BacnetWrapper(BIPSimpleApplication):
                 raise TypeError("invalid result datatype, expecting %s" % (datatype.subtype.__name__,))
         elif not isinstance(value, datatype):
             raise TypeError("invalid result datatype, expecting %s" % (datatype.__name__,))
+        return value
+
+    def write_async(self,
+                    dev_addr: str,
+                    obj_type: str,
+                    obj_instance: int,
+                    prop_id: str,
+                    value,
+                    prop_type: str='invalid prop_type',
+                    indx: int=None,
+                    priority: int=None,
+                    timeout: float=None,
+                    ):
+        """ Start writing a property of a specific object in a device at `dev_addr`, ahead of
+            the reads queued to the device.
+            returns a Future that resolves to True once the device acknowledges the write.
+        """
+        obj_id = ObjectIdentifier(make_obj_id(obj_type, obj_instance)).value
+        value = self.encode_value(obj_id[0], prop_id, value, prop_type, indx)
 
         # build request & save the value
         request = WritePropertyRequest(
             objectIdentifier=obj_id,
             propertyIdentifier=prop_id
             )
-        request.pduDestination = Address(addr)
+        request.pduDestination = Address(dev_addr)
 
         request.propertyValue = Any()
         request.propertyValue.cast_in(value)
@@ -201,19 +739,76 @@ class BacnetWrapper(BIPSimpleApplication):
         if priority is not None:
             request.priority = priority
 
-        # make an IOCB
-        iocb = IOCB(request)
-        self.request_io(iocb)
-        iocb.set_timeout(3)
-        iocb.wait()
+        return self.submit(request, self._decode_simple_ack, timeout, urgent=True)
 
-        if iocb.ioResponse:
-            if not isinstance(iocb.ioResponse, SimpleAckPDU):
-                raise Exception("Response Not an ACK")
+    def write_multiple_async(self, dev_addr: str, writes: list, timeout: float=None):
+        """ Start writing several properties in a device at `dev_addr` with a single
+            WritePropertyMultiple request, ahead of the reads queued to the device.
+            `writes` is a list of dicts of the arguments of `write_async` after `dev_addr`.
+            returns a Future of the result of each write, in order: True if it was written,
+            its Exception if the device refused it, or None if the device stopped before it.
+            The Future raises WpmNotSupported if the device does not support the service.
+        """
+        write_access_specs = []
+        for write in writes:
+            obj_id = ObjectIdentifier(make_obj_id(write['obj_type'], write['obj_instance'])).value
+            value = self.encode_value(obj_id[0], write['prop_id'], write['value'],
+                                      write.get('prop_type', 'invalid prop_type'),
+                                      write.get('indx'))
+            prop_value = PropertyValue(propertyIdentifier=write['prop_id'], value=Any())
+            prop_value.value.cast_in(value)
+            if write.get('indx') is not None:
+                prop_value.propertyArrayIndex = write['indx']
+            if write.get('priority') is not None:
+                prop_value.priority = write['priority']
+            # Consecutive writes to the same object share its specification.
+            if write_access_specs and write_access_specs[-1].objectIdentifier == obj_id:
+                write_access_specs[-1].listOfProperties.append(prop_value)
+            else:
+                write_access_specs.append(WriteAccessSpecification(objectIdentifier=obj_id,
+                                                                   listOfProperties=[prop_value],
+                                                                   ))
+        request = WritePropertyMultipleRequest(listOfWriteAccessSpecs=write_access_specs)
+        request.pduDestination = Address(dev_addr)
 
-            return # write success
+        return self.submit(request, lambda iocb: self._decode_write_multiple(iocb, writes),
+                           timeout, urgent=True)
 
+    def _decode_write_multiple(self, iocb, writes):
         if iocb.ioError:
-            raise Exception("ioError: %s"+str(iocb.ioError))
+            err = iocb.ioError
+            dev_addr = iocb.args[0].pduDestination
+            if (isinstance(err, RejectPDU) and err.apduAbortRejectReason in RPM_REJECT_REASONS) or \
+               (isinstance(err, AbortPDU) and err.apduAbortRejectReason in RPM_ABORT_REASONS):
+                raise WpmNotSupported(f"{dev_addr} does not support WritePropertyMultiple: {err}")
+            if not isinstance(err, WritePropertyMultipleError):
+                return self._decode_simple_ack(iocb)
+            # The writes before the first failed one took effect, and the rest were not tried.
+            failed = err.firstFailedWriteAttempt
+            failed_ref = (failed.objectIdentifier, failed.propertyIdentifier,
+                          failed.propertyArrayIndex)
+            error = RequestRefused("REFUSED:{0}: {1}".format(err.errorType.errorClass,
+                                                            err.errorType.errorCode))
+            for i, write in enumerate(writes):
+                obj_id = ObjectIdentifier(make_obj_id(write['obj_type'], write['obj_instance']))
+                if (obj_id.value, write['prop_id'], write.get('indx')) == failed_ref:
+                    return [True] * i + [error] + [None] * (len(writes) - i - 1)
+            raise error
+
+        self._decode_simple_ack(iocb)
+        return [True] * len(writes)
+
+    def do_write(self, device_id, object_type, object_instance, prop_id, value, \
+                 prop_type='invalid prop_type', indx=None, priority=None):
+        """ do_write( <object id>, <type>, <instance>, <property_id>, <value>,
+                      <optional property type>, <optional index>, <optional priority> )
+            write a property to a specific object.
+            return Nothing if successful, else Raise an exception which can be logged.
+        """
+        addrlist = device_id["mac"] #4 bytes of address, 2 bytes of port
+        if len(addrlist) != 6:
+            raise IOError('invalid address')
+        addr = ".".join(str(x) for x in addrlist[:4])  + ":" + str((addrlist[4]<<8) + addrlist[5])
 
-        raise Exception("do_write failed")
+        self.write_async(addr, object_type, object_instance, prop_id, value, prop_type, indx,
+                         priority).result()
@@ -0,0 +1,157 @@
+""" End-to-end benchmarks on a simulated device farm.
+    The farm, discovery and the connector each run in their own process with their own BACnet
+    port, as they do in a deployment, so the connector's CPU time and memory are its own.
+    Reports discovery time, points read per second, the time to read every point once, and the
+    connector's CPU time and peak RSS.
+"""
+
+import os
+import time
+import uuid
+import asyncio
+import resource
+import tempfile
+import threading
+import multiprocessing
+
+from bacpypes.core import run as bacpypes_run
+
+from .simulator import run_farm
+from .sqlite_wrapper import SqliteWrapper
+
+
+CLIENT_INI_TEMPLATE = """[BACpypes]
+objectName: Benchmark
+address: 127.0.0.1:{port}
+objectIdentifier: 599
+maxApduLengthAccepted: 1476
+segmentationSupported: segmentedBoth
+vendorIdentifier: 15
+"""
+
+
+class CountingDs(object):
+    """ A data service that only counts the datapoints uploaded to it. """
+
+    def __init__(self):
+        self.num_datapoints = 0
+
+    def put_timeseries_data(self, datapoints):
+        self.num_datapoints += len(datapoints)
+
+
+def run_discovery(bacpypes_ini, sqlite_db, device_ids, discovery_config, results):
+    from .discovery import BacnetDiscovery
+    db = SqliteWrapper(sqlite_db)
+    config = {'object_custom_fields': {}, 'discovery': discovery_config}
+    discovery = BacnetDiscovery(bacpypes_ini, config, db)
+    threading.Thread(target=bacpypes_run, daemon=True).start()
+    t0 = time.time()
+    devices = discovery.discover_devices(target_device_ids=device_ids)
+    device_objs = discovery.discover_objects(devices)
+    results.put({
+        'discovery_time': time.time() - t0,
+        'discovered_devices': len(devices),
+        'discovered_objects': sum(len(objs) for objs in device_objs.values()),
+    })
+    results.close()
+    results.join_thread()
+    os._exit(0) # The BACnet stack does not stop by itself.
+
+
+def run_connector(bacpypes_ini, sqlite_db, device_ids, duration, connector_params, logdir,
+                  results):
+    from .connector import Connector
+    connector = Connector(bacpypes_ini, CountingDs(), device_ids, sqlite_db, logdir=logdir,
+                          **connector_params)
+    num_points = sum(len(connector.get_poll_plan(dev_id).points) for dev_id in device_ids)
+    cpu0 = time.process_time()
+
+    async def read_for_duration():
+        try:
+            await asyncio.wait_for(connector.read_all_devices_forever_async(), duration)
+        except asyncio.TimeoutError:
+            pass
+    asyncio.run(read_for_duration())
+
+    cpu_time = time.process_time() - cpu0
+    upload_stats = connector.uploader.stats()
+    num_read = upload_stats['uploaded_rows'] + upload_stats['queued_rows']
+    results.put({
+        'points': num_points,
+        'points_read': num_read,
+        'points_per_second': num_read / duration,
+        'cycle_time': duration * num_points / num_read if num_read else None,
+        'cpu_time': cpu_time,
+        'cpu_utilization': cpu_time / duration,
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    })
+    results.close()
+    results.join_thread()
+    os._exit(0)
+
+
+def run_benchmark(num_devices=10, num_objects=100, duration=30, farm_params=None,
+                  discovery_config=None, connector_params=None, client_port=47808,
+                  base_port=47809, first_device_id=1000, workdir=None):
+    """ Simulate `num_devices` devices with `num_objects` objects each, discover them, poll
+        them for `duration` seconds, and return the measurements.
+        `farm_params` are passed to DeviceFarm and `connector_params` to Connector. By
+        default, the connector polls every point as fast as it can.
+    """
+    workdir = workdir or tempfile.mkdtemp(prefix='b2b_benchmark_')
+    os.makedirs(workdir, exist_ok=True)
+    bacpypes_ini = os.path.join(workdir, 'benchmark.ini')
+    with open(bacpypes_ini, 'w') as fp:
+        fp.write(CLIENT_INI_TEMPLATE.format(port=client_port))
+    sqlite_db = os.path.join(workdir, 'benchmark.db')
+    device_ids = [first_device_id + i for i in range(num_devices)]
+    connector_params = dict({'min_interval': 0, 'read_sleeptime': 0}, **(connector_params or {}))
+
+    ready = multiprocessing.Event()
+    farm = multiprocessing.Process(target=run_farm, kwargs=dict(
+        farm_params or {}, num_devices=num_devices, num_objects=num_objects,
+        base_port=base_port, first_device_id=first_device_id, ready=ready), daemon=True)
+    farm.start()
+    report = {
+        'devices': num_devices,
+        'objects_per_device': num_objects,
+        'duration': duration,
+    }
+    try:
+        ready.wait(60)
+        # Discovery asks the devices at their known addresses, since loopback has no broadcast.
+        db = SqliteWrapper(sqlite_db)
+        for i, dev_id in enumerate(device_ids):
+            db.write_device_properties({
+                'device_id': dev_id,
+                'description': '',
+                'jci_name': '',
+                'name': '',
+                'addr': f'127.0.0.1:{base_port + i}',
+                'max_apdu': 0,
+                'vendor_id': 0,
+            })
+
+        results = multiprocessing.Queue()
+        discovery = multiprocessing.Process(target=run_discovery, args=(
+            bacpypes_ini, sqlite_db, device_ids, discovery_config or {}, results))
+        discovery.start()
+        report.update(results.get())
+        discovery.join()
+
+        # Registration gives the objects their uuids, without which they are not polled.
+        for dev_id in device_ids:
+            db.update_obj_properties(dev_id, 'uuid', {
+                (obj['object_type'], obj['instance']): str(uuid.uuid4())
+                for obj in db.read_objects(dev_id)})
+
+        connector = multiprocessing.Process(target=run_connector, args=(
+            bacpypes_ini, sqlite_db, device_ids, duration, connector_params,
+            os.path.join(workdir, 'logs'), results))
+        connector.start()
+        report.update(results.get())
+        connector.join()
+    finally:
+        farm.terminate()
+    return report
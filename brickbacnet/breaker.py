@@ -0,0 +1,72 @@
+""" Circuit breakers that stop reading devices and objects that keep failing.
+    After `threshold` consecutive failures, the breaker of a device or an object opens and it is
+    no longer read, except for a probe once `retry_interval` seconds pass. The interval doubles
+    after each failed probe, up to `max_interval`, and a successful read closes the breaker.
+"""
+
+
+class CircuitBreaker(object):
+    __slots__ = ('failures', 'retry_interval', 'next_probe_time')
+
+    def __init__(self):
+        self.failures = 0 # consecutive failures.
+        self.retry_interval = None # set while the breaker is open.
+        self.next_probe_time = None
+
+    @property
+    def is_open(self):
+        return self.retry_interval is not None
+
+
+class CircuitBreakers(object):
+    """ The breakers of a kind of thing, such as devices or objects, by key. """
+
+    def __init__(self, threshold=3, base_interval=60, max_interval=3600):
+        self.threshold = threshold
+        self.base_interval = base_interval
+        self.max_interval = max_interval
+        self.breakers = {} # key -> CircuitBreaker, only for the keys that failed.
+
+    def is_open(self, key):
+        breaker = self.breakers.get(key)
+        return breaker is not None and breaker.is_open
+
+    def allow(self, key, now):
+        """ Whether to read `key` now: always while its breaker is closed, and only when a probe
+            is due while it is open.
+        """
+        breaker = self.breakers.get(key)
+        return breaker is None or not breaker.is_open or now >= breaker.next_probe_time
+
+    def on_success(self, key):
+        """ returns True if this closed an open breaker. """
+        breaker = self.breakers.pop(key, None)
+        return breaker is not None and breaker.is_open
+
+    def on_failure(self, key, now):
+        """ returns True if this opened the breaker. """
+        breaker = self.breakers.get(key)
+        if breaker is None:
+            breaker = self.breakers[key] = CircuitBreaker()
+        breaker.failures += 1
+        if breaker.is_open:
+            breaker.retry_interval = min(breaker.retry_interval * 2, self.max_interval)
+            breaker.next_probe_time = now + breaker.retry_interval
+            return False
+        if breaker.failures < self.threshold:
+            return False
+        breaker.retry_interval = self.base_interval
+        breaker.next_probe_time = now + breaker.retry_interval
+        return True
+
+    def retry_interval(self, key):
+        breaker = self.breakers.get(key)
+        return breaker.retry_interval if breaker else None
+
+    def next_probe_time(self, key):
+        """ When `key` may be probed next, or None while its breaker is closed. """
+        breaker = self.breakers.get(key)
+        return breaker.next_probe_time if breaker else None
+
+    def num_open(self):
+        return sum(1 for breaker in list(self.breakers.values()) if breaker.is_open)
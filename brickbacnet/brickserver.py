@@ -1,21 +1,40 @@
 import requests
 import time
+import json
+import gzip
+import random
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 from pdb import set_trace as bp
 
 from rdflib import Namespace
 
-from .ds_iface import DsIface
+from .ds_iface import DsIface, PartialUpload
 from .namespaces import BRICK_NS_TEMPLATE, BACNET
+from .ntriples import chunk_lines
+from .metrics import METRICS
 
 
+COMPRESS_MIN_BYTES = 1024
+RETRIED_STATUS_CODES = {429, 502, 503, 504}
+RETRY_BASE_DELAY = 0.5 # seconds
+
+HTTP_REQUEST_SECONDS = METRICS.histogram(
+    'b2b_http_request_seconds', 'Time of requests to Brick Server', ['method', 'status'])
+HTTP_SENT_BYTES = METRICS.counter(
+    'b2b_http_sent_bytes_total', 'Bytes of request bodies sent to Brick Server', ['method'])
+
 
 class BrickServer(DsIface):
     def __init__(self, hostname: str,
                  jwt_token: str,
                  brick_version: str,
                  srcid_uuid_map: dict={},
+                 compress: bool=True,
+                 max_connections: int=10,
+                 max_retries: int=3,
+                 timeout: float=30,
                  ):
         self.brick_version = brick_version
         self.BRICK = Namespace(BRICK_NS_TEMPLATE.format(version=self.brick_version))
@@ -30,6 +49,16 @@ class BrickServer(DsIface):
             'Authorization': 'Bearer ' + self.jwt_token
         }
         self.srcid_uuid_map = srcid_uuid_map
+        self.compress = compress # gzip the request bodies larger than COMPRESS_MIN_BYTES.
+        self.max_retries = max_retries
+        self.timeout = timeout
+        # Connections are kept alive and reused across requests and threads.
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max_connections,
+                                                pool_maxsize=max_connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.post_executor = ThreadPoolExecutor(max_connections)
         self.type_map = {
             'analogInput': 'number',
             'analogValue': 'number',
@@ -48,17 +77,50 @@ class BrickServer(DsIface):
         self.default_headers['Authorization'] = 'Bearer ' + self.jwt_token
 
     def _get(self, url, headers={}, params={}):
-        headers = headers.update(self.default_headers)
-        resp = requests.get(url, headers=headers, params=params)
-        return resp
-
-    def _post(self, url, **kwargs):
-        if 'headers' in kwargs:
-            kwargs['headers'].update(self.default_headers)
-        else:
-            kwargs['headers'] = self.default_headers
-        resp = requests.post(url, **kwargs)
-        return resp
+        headers = dict(headers, **self.default_headers)
+        return self._request('GET', url, idempotent=True, headers=headers, params=params)
+
+    def _post(self, url, idempotent=False, **kwargs):
+        """ POST requests are retried only if they are `idempotent`, such as queries. """
+        kwargs['headers'] = dict(kwargs.get('headers', {}), **self.default_headers)
+        if self.compress:
+            self._compress_body(kwargs)
+        return self._request('POST', url, idempotent=idempotent, **kwargs)
+
+    def _compress_body(self, kwargs):
+        if 'json' in kwargs:
+            kwargs['data'] = json.dumps(kwargs.pop('json')).encode('utf-8')
+            kwargs['headers'].setdefault('Content-Type', 'application/json')
+        data = kwargs.get('data')
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if isinstance(data, bytes) and len(data) >= COMPRESS_MIN_BYTES:
+            kwargs['data'] = gzip.compress(data, compresslevel=5)
+            kwargs['headers']['Content-Encoding'] = 'gzip'
+
+    def _request(self, method, url, idempotent=False, **kwargs):
+        """ Send a request over the pooled session. Idempotent requests are retried with jittered
+            exponential backoff when the connection fails or the server is temporarily unavailable.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        num_tries = self.max_retries + 1 if idempotent else 1
+        for i in range(num_tries):
+            last_try = i == num_tries - 1
+            t0 = time.time()
+            try:
+                resp = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                HTTP_REQUEST_SECONDS.observe(method, 'error', value=time.time() - t0)
+                if last_try:
+                    raise
+            else:
+                HTTP_REQUEST_SECONDS.observe(method, resp.status_code, value=time.time() - t0)
+                body = kwargs.get('data')
+                if isinstance(body, (bytes, str)):
+                    HTTP_SENT_BYTES.inc(method, amount=len(body))
+                if resp.status_code not in RETRIED_STATUS_CODES or last_try:
+                    return resp
+            time.sleep(random.uniform(0, RETRY_BASE_DELAY * 2 ** i))
 
     def register_graph(self, g):
         serialized = g.serialize(format='turtle')
@@ -69,7 +131,23 @@ class BrickServer(DsIface):
                           )
         assert resp.status_code == 200
 
-    def _authorize_headers(self, headers={}):
+    def register_triples(self, lines, chunk_bytes=4*1024*1024):
+        """ Upload N-Triples lines in chunks of up to `chunk_bytes`, as they are generated.
+            N-Triples is a subset of Turtle, so the chunks go to the same endpoint as graphs.
+        """
+        headers = {'Content-Type': 'text/turtle'}
+        num_chunks = 0
+        for chunk in chunk_lines(lines, chunk_bytes):
+            resp = self._post(self.ttl_upload_url,
+                              data=chunk,
+                              headers=dict(headers),
+                              )
+            assert resp.status_code == 200
+            num_chunks += 1
+        return num_chunks
+
+    def _authorize_headers(self, headers=None):
+        headers = dict(headers or {})
         headers.update(self.default_headers)
         return headers
 
@@ -77,26 +155,41 @@ class BrickServer(DsIface):
         return src_id #TODO: Implement this
 
     def put_timeseries_data(self, datapoints):
-
-        object_types = set([datapoint['object_type'] for datapoint in datapoints])
+        """ Post the datapoints of each data type concurrently. If some of the posts fail, raise
+            PartialUpload with the datapoints of the failed types, so that the types already
+            stored are not posted again.
+        """
         datapoints_per_type = defaultdict(list)
         for dp in datapoints:
             obj_type = self.type_map.get(dp['object_type'], None)
             if not obj_type:
                 continue
-            datapoints_per_type[obj_type].append([dp['uuid'], dp['timestamp'], dp['value']])
-        datapoints_per_type = dict(datapoints_per_type)
-        data_per_type = {
-        }
-        t0 = time.time()
+            datapoints_per_type[obj_type].append(dp)
+        futures = {}
         for data_type, dps in datapoints_per_type.items():
-            body = {
-                'columns': ['uuid', 'timestamp'] + [data_type],
-                'data': dps
-            }
-            resp = self._post(self.ts_url, json=body)
-        t1 = time.time()
-        print('post took: {0} seconds'.format(t1 - t0))
+            rows = [[dp['uuid'], dp['timestamp'], dp['value']] for dp in dps]
+            futures[data_type] = self.post_executor.submit(self._post_timeseries, data_type, rows)
+        failed = []
+        errors = []
+        for data_type, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                failed += datapoints_per_type[data_type]
+                errors.append(str(e))
+        if errors:
+            raise PartialUpload('; '.join(errors), failed)
+
+    def _post_timeseries(self, data_type, dps):
+        body = {
+            'columns': ['uuid', 'timestamp'] + [data_type],
+            'data': dps
+        }
+        resp = self._post(self.ts_url, json=body)
+        if not 200 <= resp.status_code < 300:
+            # Let the caller keep the datapoints and retry.
+            raise Exception('Uploading {0} datapoints failed with status {1}: {2}'
+                            .format(len(dps), resp.status_code, resp.text[:200]))
 
     def get_timeseries_metadata(self, sensor):
         raise NotImplementedError('Method not implemented!')
@@ -105,8 +198,14 @@ class BrickServer(DsIface):
         raise NotImplementedError('Method not implemented!')
 
     def create_entity(self, entity_type):
+        return self.create_entities(entity_type, 1)[0]
+
+    def create_entities(self, entity_type, count):
+        """ Create `count` entities in one request and return their identifiers. """
+        if count == 0:
+            return []
         body = {
-            entity_type: 1,
+            entity_type: count,
         }
         headers = self._authorize_headers()
         resp = self._post(self.entities_url,
@@ -114,7 +213,37 @@ class BrickServer(DsIface):
                           headers=headers,
                           )
         assert resp.status_code == 200
-        return resp.json()[entity_type][0]
+        entity_ids = resp.json()[entity_type]
+        assert len(entity_ids) == count
+        return entity_ids
+
+    def query_device_points(self, device_id):
+        """ The entities of the points of a device, keyed by their (object_type, instance), in one
+            query.
+        """
+        qstr = """
+        prefix bacnet: <{BACNET}>
+        prefix brick: <{BRICK}>
+        prefix xsd: <http://www.w3.org/2001/XMLSchema#>
+        select ?entity ?object_type ?instance where {{
+            ?dev bacnet:device_id "{device_id}"^^xsd:integer.
+            ?dev brick:hasPoint ?entity.
+            ?entity bacnet:object_type ?object_type.
+            ?entity bacnet:instance ?instance.
+        }}
+        """.format(BRICK=self.BRICK, BACNET=BACNET, device_id=int(device_id))
+        headers = self._authorize_headers({'Content-Type': 'application/sparql-query'})
+        resp = self._post(self.sparql_url,
+                          idempotent=True,
+                          data=qstr,
+                          headers=headers,
+                          )
+        assert resp.status_code == 200
+        entities = defaultdict(list)
+        for row in resp.json()['results']['bindings']:
+            obj_key = (row['object_type']['value'], int(row['instance']['value']))
+            entities[obj_key].append(row['entity']['value'])
+        return dict(entities)
 
     def query_entities(self, props):
         qstr = """
@@ -142,6 +271,7 @@ class BrickServer(DsIface):
         qstr += '\n}'
         headers = self._authorize_headers({'Content-Type': 'application/sparql-query'})
         resp = self._post(self.sparql_url,
+                          idempotent=True,
                           data=qstr,
                           headers=headers,
                           )
@@ -1,3 +1,8 @@
+# Sizes used to estimate how many objects fit in a ReadPropertyMultiple ACK.
+DEFAULT_MAX_APDU = 480  # The largest APDU every BACnet/IP and MS/TP device has to accept.
+RPM_ACK_HEADER = 8
+RPM_OBJECT_OVERHEAD = 7
+RPM_PROPERTY_BYTES = 12
 
 
 def make_src_id(device_id, obj_id):
@@ -18,3 +23,16 @@ def striding_window(l, w_size):
     while curr_idx < len(l):
         yield l[curr_idx:curr_idx + w_size]
         curr_idx += w_size
+
+def rpm_batch_size(max_apdu, props_per_object=1, property_bytes=RPM_PROPERTY_BYTES):
+    """ The number of objects that fit in one ReadPropertyMultiple exchange with a device
+        accepting `max_apdu` bytes. The ACK is the larger of the two messages, so it is sized
+        with a conservative estimate of the encoded bytes per property (object identifier,
+        property reference and a primitive value).
+    """
+    try:
+        max_apdu = int(max_apdu)
+    except (TypeError, ValueError):
+        max_apdu = DEFAULT_MAX_APDU
+    bytes_per_object = RPM_OBJECT_OVERHEAD + property_bytes * props_per_object
+    return max(1, (max_apdu - RPM_ACK_HEADER) // bytes_per_object)
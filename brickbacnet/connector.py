@@ -10,14 +10,67 @@ from concurrent import futures
 from datetime import datetime
 from pdb import set_trace as bp
 import traceback
+import asyncio
 
-#import grpc
-
-from .bacnet_wrapper import  BacnetWrapper, get_static_object_types
-#from .actuation_server import ActuationServer
-from .common import make_src_id, make_obj_id, striding_window
+from .bacnet_wrapper import  BacnetWrapper, RpmNotSupported, DeviceUnreachable, \
+    get_static_object_types, is_permanent_error
+from .actuation_server import Actuator, start_actuation_server
+from .snapshot import LastValues, start_snapshot_server
+from .common import make_src_id, make_obj_id, striding_window, rpm_batch_size
 from .brickserver import BrickServer
 from .sqlite_wrapper import SqliteWrapper
+from .poll_plan import PollPlan
+from .scheduler import PollIntervals, PollSchedule
+from .cov import CovSubscriptions
+from .deadband import Deadband
+from .breaker import CircuitBreakers
+from .uploader import Uploader, MemoryBuffer
+from .outbox import Outbox
+from .metrics import METRICS, start_metrics_server, write_metrics_file
+
+
+READ_WINDOW_SECONDS = METRICS.histogram(
+    'b2b_read_window_seconds', 'Time to read a window of points from a device', ['device'])
+POINTS_READ = METRICS.counter('b2b_points_read_total', 'Points read from a device', ['device'])
+READ_ERRORS = METRICS.counter('b2b_read_errors_total', 'Failed reads of an object',
+                              ['device', 'object', 'kind'])
+POLL_LAG_SECONDS = METRICS.histogram(
+    'b2b_poll_lag_seconds', 'How long after they are due points are read', ['device'])
+POLL_OVERRUNS = METRICS.counter(
+    'b2b_poll_overruns_total', 'Reads of points more than a polling interval late', ['device'])
+CYCLE_SECONDS = METRICS.gauge(
+    'b2b_cycle_seconds', 'Time the last read of every point of a device took', ['device'])
+MIN_INTERVAL_SECONDS = METRICS.gauge(
+    'b2b_min_interval_seconds', 'The interval between polling cycles')
+INFLIGHT_LIMIT = METRICS.gauge(
+    'b2b_inflight_limit', 'Requests a device is allowed to have in flight', ['device'])
+REQUEST_GAP_SECONDS = METRICS.gauge(
+    'b2b_request_gap_seconds', 'Time between the requests to a device', ['device'])
+OPEN_BREAKERS = METRICS.gauge(
+    'b2b_open_breakers', 'Devices and objects that are only probed after failing', ['kind'])
+QUARANTINED_OBJECTS = METRICS.counter(
+    'b2b_quarantined_objects_total', 'Objects that stopped being polled', ['device'])
+
+
+def get_error_kind(e):
+    return 'timeout' if isinstance(e, TimeoutError) else type(e).__name__
+
+def is_unanswered(e):
+    return isinstance(e, (TimeoutError, DeviceUnreachable))
+
+
+async def gather_async(futures):
+    """ Await futures of BACnet requests. A failed request yields its exception. """
+    return await asyncio.gather(*[asyncio.wrap_future(future) for future in futures],
+                                return_exceptions=True)
+
+
+def get_logfile_name(bacnet_device_ids):
+    device_ids = sorted(set(str(row) for row in bacnet_device_ids))
+    if len(device_ids) <= 5:
+        return '_'.join(device_ids) + '.log'
+    # A long list of devices does not fit in a file name.
+    return 'connector_{0}_devices_from_{1}.log'.format(len(device_ids), device_ids[0])
 
 
 def create_logger(logfile):
@@ -42,44 +95,346 @@ class Connector(object):
                  overriding_bacnet_port=None,
                  logdir="logs",
                  min_interval=120,
-                 read_sleeptime=0.05,
+                 read_sleeptime=0,
                  num_rpc_workers=10,
                  read_batch_size=20,
+                 use_rpm=True,
+                 max_inflight=4,
+                 adaptive_pacing=True,
+                 pacing_save_interval=60,
+                 read_retries=2,
+                 hedge_reads=False,
+                 breaker_threshold=3,
+                 breaker_interval=60,
+                 breaker_max_interval=3600,
+                 use_cov=False,
+                 cov_lifetime=300,
+                 cov_object_types=None,
+                 cov_flush_interval=1,
+                 poll_intervals=None,
+                 deadband=None,
+                 upload_queue_rows=100000,
+                 upload_batch_rows=1000,
+                 upload_interval=5,
+                 outbox=None,
+                 upload_replay_rate=None,
+                 metrics_port=None,
+                 metrics_file=None,
+                 metrics_file_interval=15,
+                 actuation_port=None,
+                 write_batch_size=16,
+                 snapshot_port=None,
+                 snapshot_max_age=600,
                  ):
         #Initialize logging
         if not os.path.isdir(logdir):
             os.makedirs(logdir)
-        logfile = logdir + '/' + '_'.join(set(str(row) for row in bacnet_device_ids)) + '.log'
+        logfile = logdir + '/' + get_logfile_name(bacnet_device_ids)
         self.logger = create_logger(logfile)
 
         self.min_interval = min_interval
+        # Points are polled every `min_interval` seconds unless `poll_intervals` sets otherwise.
+        self.poll_intervals = PollIntervals.from_config(poll_intervals, min_interval)
+        # Only the values that moved out of their deadband are uploaded if `deadband` is given.
+        self.deadband = Deadband.from_config(deadband)
         self.read_sleeptime = read_sleeptime
         self.rpc_workers = num_rpc_workers
         self.read_batch_size = read_batch_size
+        self.use_rpm = use_rpm
+        self.rpm_unsupported_devices = set() # Devices that rejected ReadPropertyMultiple.
         self.btype_dtype_map = {
         } # BAcnet type to data type map.
         #self.skip_object_types = ['program']
         self.skip_object_types = ['program'] + get_static_object_types()
 
-        self.bacnet = BacnetWrapper(bacpypes_ini, overriding_bacnet_port)
+        # With `adaptive_pacing`, the requests in flight to each device grow up to `max_inflight`
+        # while it keeps up, and back off when it times out or reports that it is busy.
+        # Reads time out based on each device's round-trip times and are retried `read_retries`
+        # times. With `hedge_reads`, a duplicate is sent for the reads slower than most.
+        self.bacnet = BacnetWrapper(bacpypes_ini, overriding_bacnet_port, max_inflight,
+                                    adaptive_pacing, read_retries, hedge_reads)
+        self.adaptive_pacing = adaptive_pacing
+        self.pacing_save_interval = pacing_save_interval
         self.ds_if = ds_if
+        # Datapoints are uploaded by a worker thread so that slow uploads do not delay reads.
+        # With `outbox`, they are kept on disk until the data service accepts them.
+        if outbox:
+            upload_buffer = Outbox(outbox['path'], outbox.get('max_bytes', 1024**3))
+        else:
+            upload_buffer = MemoryBuffer(upload_queue_rows)
+        self.uploader = Uploader(ds_if, upload_buffer, upload_batch_rows, upload_interval,
+                                 self.logger, upload_replay_rate)
+        MIN_INTERVAL_SECONDS.set(value=min_interval)
+        if metrics_port:
+            start_metrics_server(metrics_port)
+        self.metrics_file = metrics_file
+        self.metrics_file_interval = metrics_file_interval
+        self.cov = None
+        if use_cov:
+            self.cov = CovSubscriptions(os.getpid(), cov_lifetime, cov_object_types)
+            self.cov_flush_interval = cov_flush_interval
+            self.bacnet.cov_callback = self.cov.on_notification
 
         self.logger.info("Initialized BACnet")
         self.bacnet_device_ids = bacnet_device_ids
         self.sqlite_db = SqliteWrapper(sqlite_db)
         # read device data from the SQLite database. Updates to device data can be handled without
         # restarting connector.
+        self.poll_plans = {} # dev_id -> PollPlan
+        # With `actuation_port`, writes to the points are accepted over HTTP and sent ahead of
+        # the pending reads of their devices, up to `write_batch_size` in one request.
+        self.actuator = None
+        if actuation_port:
+            self.start_actuator(actuation_port, write_batch_size)
+        # The last value read of each point. With `snapshot_port`, it is served over HTTP, and
+        # only the points older than `snapshot_max_age` seconds are read from their devices.
+        self.last_values = LastValues()
+        self.loop = None # the event loop that polls, which reads the stale points too.
+        self.snapshot_max_age = snapshot_max_age
+        if snapshot_port:
+            start_snapshot_server(self.get_last_values, snapshot_port)
+        # A device whose windows fail `breaker_threshold` times in a row, or an object whose reads
+        # do, is only probed, every `breaker_interval` seconds doubling up to
+        # `breaker_max_interval`, until it answers. Objects that keep failing with an error
+        # that does not go away are quarantined in the database instead.
+        self.device_breakers = CircuitBreakers(breaker_threshold, breaker_interval,
+                                               breaker_max_interval)
+        self.object_breakers = CircuitBreakers(breaker_threshold, breaker_interval,
+                                               breaker_max_interval)
+        METRICS.add_collector(self.collect_breaker_metrics)
+        if adaptive_pacing:
+            METRICS.add_collector(self.collect_pacing_metrics)
 
 
     def read_all_devices_forever(self):
+        """ Poll every device in `bacnet_device_ids` from this process. All the devices share one
+            BACnet port and are multiplexed by an event loop, where each device waits for its
+            own responses without blocking the others.
+        """
+        asyncio.run(self.read_all_devices_forever_async())
+
+    async def read_all_devices_forever_async(self):
+        """ Same as `read_all_devices_forever` in a running event loop, e.g. next to other
+            tasks of the process.
+        """
+        self.loop = asyncio.get_running_loop()
+        num_devices = len(self.bacnet_device_ids)
+        # The points of every device are known to the snapshot before their first cycles.
         for dev_id in self.bacnet_device_ids:
-            prev_time = time.time()
-            self.read_device_once(dev_id)
-            curr_time = time.time()
-            delta_time = curr_time - prev_time
-            if delta_time < self.min_interval:
-                print('wait: {0}'.format(self.min_interval - delta_time))
-                time.sleep(self.min_interval - delta_time)
+            try:
+                self.get_poll_plan(dev_id)
+            except Exception as e:
+                self.logger.error('Loading the points of Device {0} failed because "{1}"'
+                                  .format(dev_id, e))
+        tasks = [
+            self.read_device_forever_async(dev_id, self.min_interval * i / num_devices)
+            for i, dev_id in enumerate(self.bacnet_device_ids)
+        ]
+        if self.cov:
+            tasks += [self.subscribe_device_forever(dev_id) for dev_id in self.bacnet_device_ids]
+            tasks.append(self.upload_cov_forever())
+        if self.metrics_file:
+            tasks.append(self.write_metrics_forever())
+        if self.adaptive_pacing:
+            tasks.append(self.save_pacing_forever())
+        await asyncio.gather(*tasks)
+
+    def restore_pacing(self, plan):
+        """ Start pacing a device where it was left, instead of probing it again from one
+            request at a time.
+        """
+        if not self.adaptive_pacing:
+            return
+        pacing = self.sqlite_db.read_pacing(plan.dev['device_id'])
+        if pacing:
+            self.bacnet.set_pacing(plan.dev['addr'], *pacing)
+
+    def save_pacing(self):
+        for dev_id, plan in list(self.poll_plans.items()):
+            pacing = self.bacnet.get_pacing(plan.dev['addr'])
+            if pacing:
+                self.sqlite_db.write_pacing(dev_id, *pacing)
+
+    async def save_pacing_forever(self):
+        """ Store the pacing learned for each device every `pacing_save_interval` seconds.
+            Writing it does not change the data version the poll plans are checked against.
+        """
+        while True:
+            await asyncio.sleep(self.pacing_save_interval)
+            try:
+                self.save_pacing()
+            except Exception as e:
+                self.logger.error('Saving the pacing failed because "{0}"'.format(e))
+
+    def collect_breaker_metrics(self):
+        OPEN_BREAKERS.set('device', value=self.device_breakers.num_open())
+        OPEN_BREAKERS.set('object', value=self.object_breakers.num_open())
+
+    async def probe_device(self, plan, now):
+        """ Whether to read a device now: always while its breaker is closed, and once a probe
+            of its device object succeeds while it is open.
+        """
+        dev_id = plan.dev['device_id']
+        if not self.device_breakers.is_open(dev_id):
+            return True
+        if not self.device_breakers.allow(dev_id, now):
+            return False
+        try:
+            await asyncio.wrap_future(self.bacnet.read_async(plan.dev['addr'], 'device', dev_id,
+                                                             'objectName'))
+        except Exception as e:
+            self.device_breakers.on_failure(dev_id, time.time())
+            self.logger.warning('Device {0} is still not answering because "{1}". Probing it '
+                                'again in {2} seconds'
+                                .format(dev_id, e, self.device_breakers.retry_interval(dev_id)))
+            return False
+        self.device_breakers.on_success(dev_id)
+        self.logger.info('Device {0} is answering again'.format(dev_id))
+        return True
+
+    def update_breakers(self, dev, objs, errors, now):
+        """ Count the failures of a window of objects, where `errors` maps the uuids of the
+            objects that failed to their exceptions.
+        """
+        dev_id = dev['device_id']
+        if objs and len(errors) == len(objs) and any(is_unanswered(e) for e in errors.values()):
+            # Nothing answered, so the objects are not to blame.
+            if self.device_breakers.on_failure(dev_id, now):
+                self.logger.warning('Device {0} stopped answering. Only probing it every {1} '
+                                    'seconds from now'
+                                    .format(dev_id, self.device_breakers.retry_interval(dev_id)))
+            else:
+                self.logger.warning('Device {0} did not answer a window of {1} objects'
+                                    .format(dev_id, len(objs)))
+            return
+        self.device_breakers.on_success(dev_id)
+        for obj in objs:
+            e = errors.get(obj.uuid)
+            if e is None:
+                if self.object_breakers.on_success(obj.uuid):
+                    self.logger.info('Object {0} at Device {1} is read again'
+                                     .format(obj.instance, dev_id))
+                continue
+            if not self.object_breakers.on_failure(obj.uuid, now):
+                continue
+            if is_permanent_error(e):
+                self.object_breakers.on_success(obj.uuid)
+                self.sqlite_db.quarantine_object(dev_id, obj.object_type, obj.instance, str(e))
+                self.poll_plans.pop(dev_id, None) # recompiled without the object.
+                QUARANTINED_OBJECTS.inc(dev_id)
+                self.logger.warning('Object {0} at Device {1} is quarantined because "{2}"'
+                                    .format(obj.instance, dev_id, e))
+            else:
+                self.logger.warning('Object {0} at Device {1} keeps failing because "{2}". Only '
+                                    'probing it every {3} seconds from now'
+                                    .format(obj.instance, dev_id, e,
+                                            self.object_breakers.retry_interval(obj.uuid)))
+
+    def collect_pacing_metrics(self):
+        for dev_id, plan in list(self.poll_plans.items()):
+            pacing = self.bacnet.get_pacing(plan.dev['addr'])
+            if pacing:
+                INFLIGHT_LIMIT.set(dev_id, value=pacing[0])
+                REQUEST_GAP_SECONDS.set(dev_id, value=pacing[1])
+
+    async def write_metrics_forever(self):
+        """ Write the metrics to `metrics_file` every `metrics_file_interval` seconds. """
+        while True:
+            try:
+                write_metrics_file(self.metrics_file)
+            except Exception as e:
+                self.logger.error('Writing metrics failed because "{0}"'.format(e))
+            await asyncio.sleep(self.metrics_file_interval)
+
+    async def subscribe_device_forever(self, dev_id):
+        """ Subscribe to the changes of a device's objects and renew the subscriptions before
+            they expire. Subscribed objects are left out of the polling cycles.
+        """
+        while True:
+            try:
+                await self.subscribe_device(dev_id)
+            except Exception as e:
+                self.logger.error('Subscribing to Device {0} failed because "{1}"'
+                                  .format(dev_id, e))
+            await asyncio.sleep(self.cov.renewal_interval)
+
+    async def subscribe_device(self, dev_id):
+        plan = self.get_poll_plan(dev_id)
+        points = self.cov.candidates(dev_id, plan.points)
+        futures = [self.bacnet.subscribe_cov_async(plan.dev['addr'], point.object_type,
+                                                   point.instance, self.cov.process_id,
+                                                   self.cov.lifetime, self.cov.confirmed)
+                   for point in points]
+        results = await gather_async(futures)
+        num_subscribed = self.cov.update(dev_id, points, results)
+        self.logger.info('Subscribed to {0} of {1} objects in Device {2}'
+                         .format(num_subscribed, len(plan.points), dev_id))
+
+    async def upload_cov_forever(self):
+        """ Queue the notified changes for upload every `cov_flush_interval` seconds. """
+        while True:
+            await asyncio.sleep(self.cov_flush_interval)
+            self.publish(self.cov.take_pending())
+
+    async def read_device_forever_async(self, dev_id, phase=0):
+        """ Poll each point of a device at its own interval, starting after `phase` seconds so
+            that devices sharing the process do not all start their cycles at the same time.
+            The points due at the same time are read together.
+        """
+        await asyncio.sleep(phase)
+        schedule = None
+        while True:
+            try:
+                plan = self.get_poll_plan(dev_id)
+                if schedule is None:
+                    self.restore_pacing(plan)
+                if schedule is None or schedule.plan is not plan:
+                    schedule = PollSchedule(plan, self.read_batch_size, time.time(), schedule)
+                now = time.time()
+                due_groups = schedule.pop_due(now)
+                for due, group in due_groups:
+                    lag = now - due
+                    POLL_LAG_SECONDS.observe(dev_id, value=lag)
+                    if group.interval and lag > group.interval:
+                        POLL_OVERRUNS.inc(dev_id)
+                points = []
+                polled = await self.probe_device(plan, now)
+                if polled:
+                    points = [point for _, group in due_groups for point in group.points
+                              if self.object_breakers.allow(point.uuid, now)]
+                for objs in striding_window(self.get_points_to_poll(plan, points),
+                                            self.read_batch_size):
+                    t0 = time.time()
+                    errors = {}
+                    datapoints = await self.read_window_async(plan.dev, objs, errors=errors)
+                    self.update_breakers(plan.dev, objs, errors, time.time())
+                    READ_WINDOW_SECONDS.observe(dev_id, value=time.time() - t0)
+                    await asyncio.sleep(self.read_sleeptime)
+                    self.publish(datapoints)
+                    self.logger.debug('A window of Device {0} took: {1} seconds'
+                                      .format(dev_id, time.time() - t0))
+                    if self.device_breakers.is_open(dev_id):
+                        polled = False
+                        break
+                now = time.time()
+                for due, group in due_groups:
+                    schedule.reschedule(due, group, now)
+                    cycle_seconds = schedule.complete(group, now) if polled else None
+                    if cycle_seconds is not None:
+                        CYCLE_SECONDS.set(dev_id, value=cycle_seconds)
+            except Exception as e:
+                self.logger.error('Reading Device {0} failed because "{1}"\n{2}'
+                                  .format(dev_id, e, traceback.format_exc()))
+                schedule = None
+                await asyncio.sleep(self.min_interval)
+                continue
+            next_due = schedule.next_due()
+            if next_due is None: # Nothing to poll until the discovery data changes.
+                await asyncio.sleep(self.min_interval)
+            else:
+                if not polled: # Nothing is read from the device until its next probe.
+                    next_due = max(next_due, self.device_breakers.next_probe_time(dev_id) or 0)
+                await asyncio.sleep(max(0, next_due - time.time()))
 
     def read_object(self, dev, obj_type, obj_instance, obj_property='presentValue'):
         value = self.bacnet.do_read(dev['addr'], obj_type, obj_instance, prop_id=obj_property)
@@ -89,59 +444,189 @@ class Connector(object):
             'value': value,
         }
 
-    def get_uuid(self, dev_ref, obj_instance):
-        uuid = self.sqlite_db.find_obj_uuid(def_ref, obj_instance)
+    def get_uuid(self, dev_ref, obj_type, obj_instance):
+        uuid = self.sqlite_db.find_obj_uuid(dev_ref, obj_type, obj_instance)
         return uuid
 
-    def read_device_once(self, dev_id):
-        dev = self.sqlite_db.read_device_properties(dev_id)
-        object_ids = dev["objects"]
-        for window_obj_ids in striding_window(object_ids, self.read_batch_size):
-            t0 = time.time()
-            datapoints = []
-            for obj_instance in window_obj_ids:
-                obj = self.sqlite_db.read_obj_properties(device_id=dev_id, instance=obj_instance)
-                if obj['object_type'] in self.skip_object_types:
+    def get_poll_plan(self, dev_id):
+        """ The compiled poll plan of a device, rebuilt only when the discovery data changes. """
+        plan = self.poll_plans.get(dev_id)
+        if plan is None or plan.data_version != self.sqlite_db.data_version():
+            plan = PollPlan.compile(self.sqlite_db, dev_id, self.skip_object_types, self.logger,
+                                    self.poll_intervals)
+            self.poll_plans[dev_id] = plan
+            self.last_values.set_points(dev_id, plan.points)
+        return plan
+
+    def get_points_to_poll(self, plan, points=None):
+        """ The points in a poll plan, or `points` of it, that are not reported by COV
+            notifications.
+        """
+        if points is None:
+            points = plan.points
+        if not self.cov:
+            return points
+        dev_id = plan.dev['device_id']
+        return [point for point in points if self.cov.is_polled(dev_id, point)]
+
+    def publish(self, datapoints):
+        """ Queue the datapoints of a batch that are to be uploaded. """
+        self.last_values.update(datapoints)
+        if self.deadband is not None:
+            datapoints = self.deadband.filter(datapoints)
+        self.uploader.put(datapoints)
+
+    def get_last_values(self, uuids=None, device_ids=None, max_age=None):
+        """ The last values of the points with `uuids` and in `device_ids`. The points last read
+            more than `max_age` seconds ago (`snapshot_max_age` if None) are read from their
+            devices first by the event loop, see `read_stale_points`. Runs in the threads of the
+            snapshot server.
+        """
+        max_age = self.snapshot_max_age if max_age is None else max_age
+        slots, unknown = self.last_values.find_slots(uuids, device_ids)
+        stale = self.last_values.stale_points(slots, max_age, time.time())
+        errors = {}
+        if stale and self.loop is not None:
+            asyncio.run_coroutine_threadsafe(self.read_stale_points(stale, errors),
+                                             self.loop).result()
+        entries = self.last_values.get(slots, max_age, time.time())
+        for entry in entries:
+            if entry['uuid'] in errors:
+                entry['error'] = str(errors[entry['uuid']])
+        return {'values': entries, 'unknown': unknown}
+
+    async def read_stale_points(self, stale, errors):
+        """ Read the points in `stale` ({device_id: [PollPoint]}) like the polls do, in windows
+            of `read_batch_size` that count towards the breakers. The devices and objects whose
+            breakers are open are not read. The exceptions of failed points go in `errors`.
+        """
+        async def read_device(dev_id, points):
+            plan = self.poll_plans.get(dev_id)
+            if plan is None or self.device_breakers.is_open(dev_id):
+                return
+            points = [point for point in points if not self.object_breakers.is_open(point.uuid)]
+            for objs in striding_window(points, self.read_batch_size):
+                window_errors = {}
+                datapoints = await self.read_window_async(plan.dev, objs, errors=window_errors)
+                self.update_breakers(plan.dev, objs, window_errors, time.time())
+                self.last_values.update(datapoints)
+                errors.update(window_errors)
+                if self.device_breakers.is_open(dev_id):
+                    break
+
+        await asyncio.gather(*[read_device(dev_id, points) for dev_id, points in stale.items()])
+
+    def _uses_rpm(self, dev):
+        return self.use_rpm and dev['device_id'] not in self.rpm_unsupported_devices
+
+    def _fall_back_to_single_reads(self, dev, e):
+        self.logger.warning('Device {0} falls back to single reads because "{1}"'
+                            .format(dev['device_id'], e))
+        self.rpm_unsupported_devices.add(dev['device_id'])
+
+    async def read_window_async(self, dev, objs, obj_property='presentValue', errors=None):
+        """ Read the present values of a window of objects in a device.
+            The objects that fail are left out, and their exceptions are put in `errors` by uuid.
+        """
+        if self._uses_rpm(dev):
+            batches, futures = self.submit_objects_multiple(dev, objs, obj_property)
+            results = await gather_async(futures)
+            try:
+                return self.collect_objects_multiple(dev, batches, results, obj_property, errors)
+            except RpmNotSupported as e:
+                self._fall_back_to_single_reads(dev, e)
+                if errors:
+                    errors.clear()
+        futures = self.submit_objects_single(dev, objs, obj_property)
+        values = await gather_async(futures)
+        return self.collect_objects_single(dev, objs, values, errors)
+
+    def submit_objects_single(self, dev, objs, obj_property='presentValue'):
+        return [self.bacnet.read_async(dev['addr'], obj.object_type, obj.instance, obj_property)
+                for obj in objs]
+
+    def collect_objects_single(self, dev, objs, values, errors=None):
+        dev_id = dev['device_id']
+        timestamp = time.time()
+        datapoints = []
+        for obj, value in zip(objs, values):
+            if isinstance(value, Exception):
+                READ_ERRORS.inc(dev_id, make_obj_id(obj.object_type, obj.instance),
+                                get_error_kind(value))
+                if 'invalid property for object type' in str(value):
+                    self.logger.warning('Object {0} at Device {1} is not read because "{2}"'
+                                        .format(obj.instance, dev_id, value))
+                    value = None
+                else:
+                    # The object is read again in its next cycle. Objects that are not answered
+                    # are reported with their device instead.
+                    if not is_unanswered(value):
+                        self.logger.warning('Object {0} at Device {1} failed because "{2}"'
+                                            .format(obj.instance, dev_id, value))
+                    if errors is not None:
+                        errors[obj.uuid] = value
                     continue
-                try:
-                    datapoint = self.read_object(dev, obj['object_type'], obj_instance)
-                except Exception as e:
-                    if 'invalid property for object type' in str(e):
-                        self.logger.warning('Object {0} at Device {1} is not read because "{2}"'
-                                            .format(obj['instance'], dev_id, e))
-                        datapoint = {
-                            'timestamp': time.time(),
-                            'value': None,
-                        }
-                    else:
-                        raise e
-                uuid = self.sqlite_db.find_obj_uuid(dev_id, obj_instance)
-                assert uuid, 'UUID not found for the object {0} in device {1}'.format(obj_instance, dev_id)
-                datapoint['uuid'] = uuid
-                datapoint['object_type'] = obj['object_type']
-                datapoints.append(datapoint)
-                time.sleep(self.read_sleeptime)
-            self.ds_if.put_timeseries_data(datapoints) # TODO: Make this async later.
-            t1 = time.time()
-            print('A window took: {0} seconds'.format(t1 - t0))
-
-    def read_device_forever(self, dev_id):
-        while True:
-            prev_time = time.time()
-            self.read_device_once(dev_id)
-            curr_time = time.time()
-            self.logger.info(f'Read all points for {dev_id}')
-            delta_time = curr_time - prev_time
-            if delta_time < self.min_interval:
-                time.sleep(self.min_interval - delta_time)
-
-    def start_rpc_server(self):
-        rpc_server = grpc.server(futures.ThreadPoolExecutor(self.rpc_workers))
-        dsrpc_mtd.add_DataserviceServicer_to_server(ActuationServer(), rpc_server)
-        rpc_server.add_insecure_port('[::]:70000')
-        rpc_server.start()
-
-
-def run_read_daemon(connector_params, target_device_id):
-    conn = Connector(**connector_params)
-    conn.read_device_forever(target_device_id)
+            datapoint = {
+                'timestamp': timestamp,
+                'value': value,
+            }
+            datapoints.append(self._add_object_metadata(obj, datapoint))
+        POINTS_READ.inc(dev_id, amount=len(datapoints))
+        return datapoints
+
+    def submit_objects_multiple(self, dev, objs, obj_property='presentValue'):
+        batches = list(striding_window(objs, rpm_batch_size(dev['max_apdu'])))
+        futures = [self.bacnet.read_multiple_async(
+                       dev['addr'],
+                       {(obj.object_type, obj.instance): [obj_property] for obj in batch})
+                   for batch in batches]
+        return batches, futures
+
+    def collect_objects_multiple(self, dev, batches, results, obj_property='presentValue',
+                                 errors=None):
+        dev_id = dev['device_id']
+        timestamp = time.time()
+        datapoints = []
+        for batch, batch_results in zip(batches, results):
+            if isinstance(batch_results, Exception):
+                if isinstance(batch_results, RpmNotSupported):
+                    raise batch_results
+                for obj in batch:
+                    READ_ERRORS.inc(dev_id, make_obj_id(obj.object_type, obj.instance),
+                                    get_error_kind(batch_results))
+                    if errors is not None:
+                        errors[obj.uuid] = batch_results
+                if not is_unanswered(batch_results):
+                    self.logger.warning('A batch of {0} objects at Device {1} failed because "{2}"'
+                                        .format(len(batch), dev_id, batch_results))
+                continue
+            for obj in batch:
+                value = batch_results.get((obj.object_type, obj.instance), {}).get(obj_property)
+                if isinstance(value, Exception):
+                    READ_ERRORS.inc(dev_id, make_obj_id(obj.object_type, obj.instance),
+                                    get_error_kind(value))
+                    self.logger.warning('Object {0} at Device {1} is not read because "{2}"'
+                                        .format(obj.instance, dev_id, value))
+                    if 'invalid property for object type' not in str(value):
+                        if errors is not None:
+                            errors[obj.uuid] = value
+                        continue
+                    value = None
+                datapoint = {
+                    'timestamp': timestamp,
+                    'value': value,
+                }
+                datapoints.append(self._add_object_metadata(obj, datapoint))
+        POINTS_READ.inc(dev_id, amount=len(datapoints))
+        return datapoints
+
+    def _add_object_metadata(self, obj, datapoint):
+        datapoint['uuid'] = obj.uuid
+        datapoint['object_type'] = obj.object_type
+        return datapoint
+
+    def start_actuator(self, port, max_batch=16):
+        self.actuator = Actuator(self.bacnet, self.sqlite_db, self.logger, max_batch,
+                                 device_ids=self.bacnet_device_ids)
+        start_actuation_server(self.actuator, port)
+        self.logger.info('Accepting writes at port {0}'.format(port))
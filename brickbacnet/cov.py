@@ -0,0 +1,93 @@
+""" Change-of-value (COV) ingestion: objects that accept a SubscribeCOV request push their
+    changes to the connector, which then stops polling them. Objects that refuse subscriptions
+    keep being polled.
+"""
+
+import time
+import threading
+
+from .bacnet_wrapper import RequestRefused
+
+# Object types that are required to support COV reporting on their present value.
+DEFAULT_COV_OBJECT_TYPES = [
+    'analogInput', 'analogOutput', 'analogValue',
+    'binaryInput', 'binaryOutput', 'binaryValue',
+    'multiStateInput', 'multiStateOutput', 'multiStateValue',
+]
+
+# Subscriptions are renewed when this fraction of their lifetime has passed.
+COV_RENEWAL_FRACTION = 0.8
+
+
+class CovSubscriptions(object):
+    """ The COV subscriptions of a connector and the datapoints notified but not uploaded yet.
+        Notifications arrive in the bacpypes thread, so the state is guarded by a lock.
+    """
+
+    def __init__(self, process_id, lifetime=300, object_types=None, confirmed=False):
+        self.process_id = process_id
+        self.lifetime = lifetime
+        self.object_types = set(object_types or DEFAULT_COV_OBJECT_TYPES)
+        self.confirmed = confirmed
+        self.lock = threading.Lock()
+        self.subscribed = {} # dev_id -> {(obj_type, instance): PollPoint}
+        # Points being subscribed to, whose initial notifications may arrive before the result.
+        self.notified = {} # dev_id -> {(obj_type, instance): PollPoint}
+        self.refused = {} # dev_id -> {(obj_type, instance)}
+        self.pending = [] # datapoints to upload
+
+    @property
+    def renewal_interval(self):
+        return self.lifetime * COV_RENEWAL_FRACTION
+
+    def candidates(self, dev_id, points):
+        """ The points of a device to (re)subscribe to. """
+        refused = self.refused.get(dev_id, set())
+        candidates = [point for point in points
+                      if point.object_type in self.object_types
+                      and (point.object_type, point.instance) not in refused]
+        notified = dict(self.subscribed.get(dev_id, {}))
+        notified.update({(point.object_type, point.instance): point for point in candidates})
+        with self.lock:
+            self.notified[dev_id] = notified
+        return candidates
+
+    def is_polled(self, dev_id, point):
+        return (point.object_type, point.instance) not in self.subscribed.get(dev_id, {})
+
+    def update(self, dev_id, points, results):
+        """ Record the results of subscription requests for `points`.
+            returns the number of points subscribed.
+        """
+        subscribed = {}
+        refused = self.refused.setdefault(dev_id, set())
+        for point, result in zip(points, results):
+            key = (point.object_type, point.instance)
+            if isinstance(result, RequestRefused):
+                refused.add(key)
+            elif not isinstance(result, Exception):
+                subscribed[key] = point
+            # Other failures, like timeouts, are polled and retried at the next renewal.
+        with self.lock:
+            self.subscribed[dev_id] = subscribed
+            self.notified[dev_id] = subscribed
+        return len(subscribed)
+
+    def on_notification(self, dev_addr, dev_id, obj_type, obj_instance, values):
+        point = self.notified.get(dev_id, {}).get((obj_type, obj_instance))
+        value = values.get('presentValue')
+        if point is None or value is None or isinstance(value, Exception):
+            return
+        datapoint = {
+            'timestamp': time.time(),
+            'value': value,
+            'uuid': point.uuid,
+            'object_type': point.object_type,
+        }
+        with self.lock:
+            self.pending.append(datapoint)
+
+    def take_pending(self):
+        with self.lock:
+            datapoints, self.pending = self.pending, []
+        return datapoints
@@ -0,0 +1,52 @@
+""" Change-only publishing.
+    A point's value is published only when it moves out of the deadband around the value last
+    published for it, or when it has not been published for `heartbeat` seconds.
+"""
+
+from itertools import compress
+from numbers import Number
+
+
+class Deadband(object):
+    """ The deadband of a value is the larger of `absolute` and `percent` of the value last
+        published. Values that are not numbers are published whenever they change.
+    """
+
+    def __init__(self, absolute=0, percent=0, heartbeat=None):
+        self.absolute = absolute
+        self.ratio = percent / 100
+        self.heartbeat = heartbeat
+        self.published = {} # uuid -> (value, timestamp) last published.
+
+    @classmethod
+    def from_config(cls, config):
+        """ `config` is the `deadband` entry of the connector configuration. None disables
+            the filtering.
+        """
+        if config is None:
+            return None
+        return cls(config.get('absolute', 0), config.get('percent', 0), config.get('heartbeat'))
+
+    def filter(self, datapoints):
+        """ The datapoints of a batch that are to be published. They become the values the
+            next batches are compared against.
+        """
+        published = self.published
+        previous = [published.get(datapoint['uuid']) for datapoint in datapoints]
+        mask = [self.is_changed(datapoint['value'], datapoint['timestamp'], last)
+                for datapoint, last in zip(datapoints, previous)]
+        datapoints = list(compress(datapoints, mask))
+        published.update((datapoint['uuid'], (datapoint['value'], datapoint['timestamp']))
+                         for datapoint in datapoints)
+        return datapoints
+
+    def is_changed(self, value, timestamp, last):
+        if last is None:
+            return True
+        last_value, last_timestamp = last
+        if self.heartbeat is not None and timestamp - last_timestamp >= self.heartbeat:
+            return True
+        if isinstance(value, Number) and isinstance(last_value, Number) \
+                and not isinstance(value, bool):
+            return abs(value - last_value) > max(self.absolute, self.ratio * abs(last_value))
+        return value != last_value
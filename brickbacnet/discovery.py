@@ -10,6 +10,7 @@ import time
 import threading
 import json
 import configparser
+from concurrent.futures import ThreadPoolExecutor
 
 from pdb import set_trace as bp
 
@@ -17,19 +18,24 @@ from bacpypes.core import run
 from bacpypes.pdu import Address
 from bacpypes.consolelogging import ConfigArgumentParser
 from bacpypes.iocb import IOCB
-from bacpypes.apdu import WhoIsRequest, IAmRequest, ReadPropertyRequest, ReadPropertyACK
+from bacpypes.apdu import WhoIsRequest, IAmRequest
 from bacpypes.local.device import LocalDeviceObject
 from bacpypes.app import BIPSimpleApplication
-from bacpypes.primitivedata import Unsigned, ObjectIdentifier
-from bacpypes.object import get_datatype
-from bacpypes.constructeddata import Array
+from bacpypes.primitivedata import ObjectIdentifier
 from bacpypes.task import TaskManager
 
-from .common import make_src_id
+from .bacnet_wrapper import BacnetClient, RpmNotSupported, gather_result
+from .common import make_src_id, rpm_batch_size, striding_window
 from .sqlite_wrapper import SqliteWrapper
 
+MAX_DEVICE_INSTANCE = 4194302 # 4194303 is reserved as the wildcard instance.
+GLOBAL_BROADCAST = "255.255.255.255"
 
-class BacnetDiscovery(BIPSimpleApplication):
+# Metadata properties are mostly strings, so a property takes more room in an ACK than a value.
+DISCOVERY_PROPERTY_BYTES = 40
+
+
+class BacnetDiscovery(BacnetClient):
     def __init__(
         self, bacpypes_inifile, brickbacnet_config, sqlite_db,
     ):
@@ -49,9 +55,37 @@ class BacnetDiscovery(BIPSimpleApplication):
         )
         self.sqlite_db = sqlite_db
 
-        BIPSimpleApplication.__init__(self, self.this_device, config["address"])
+        discovery_config = brickbacnet_config.get('discovery', {})
+        # With `adaptive_pacing`, the requests in flight to a device adapt to how fast it answers,
+        # up to `max_inflight`, starting from what was learned in earlier runs.
+        self.adaptive_pacing = discovery_config.get('adaptive_pacing', True)
+        BacnetClient.__init__(self, self.this_device, config["address"],
+                              discovery_config.get('max_inflight', 4), self.adaptive_pacing,
+                              discovery_config.get('read_retries', 2),
+                              discovery_config.get('hedge_reads', False))
         self.taskman = TaskManager()
         self.object_custom_fields = brickbacnet_config['object_custom_fields']
+        self.max_workers = discovery_config.get('max_workers', 4) # devices discovered at once.
+        self.use_rpm = discovery_config.get('use_rpm', True)
+        # seconds per attempt of a read, or None for a timeout derived from the device's RTTs.
+        self.read_timeout = discovery_config.get('read_timeout')
+        # Who-Is is sent to `whois_range` of device instances in shards of `whois_shard_size`
+        # instances. A shard is done once no I-Am arrives for `whois_quiet_time` seconds.
+        self.whois_range = discovery_config.get('whois_range', [0, MAX_DEVICE_INSTANCE])
+        self.whois_shard_size = discovery_config.get('whois_shard_size', MAX_DEVICE_INSTANCE + 1)
+        self.whois_quiet_time = discovery_config.get('whois_quiet_time', 1)
+        self.devices = {}
+        self.unchanged_devices = set() # ids of the devices whose objects did not change.
+        self.last_iam_time = 0
+        self.incremental = discovery_config.get('incremental', False)
+        self.object_fields = {
+            "object_type": "objectType",
+            "description": "description",
+            "jci_name": "jciName",
+            "name": "objectName",
+            "unit": "units",
+        }
+        self.object_fields.update(self.object_custom_fields)
 
     def indication(self, apdu):
         """ function called as indication that an apdu was received """
@@ -67,6 +101,7 @@ class BacnetDiscovery(BIPSimpleApplication):
             dev_data["segmentationSupported"] = str(apdu.segmentationSupported)
             dev_data["vendor_id"] = str(apdu.vendorID)
             self.devices[apdu.iAmDeviceIdentifier[1]] = dev_data
+            self.last_iam_time = time.time()
 
         BIPSimpleApplication.indication(self, apdu)
 
@@ -75,147 +110,274 @@ class BacnetDiscovery(BIPSimpleApplication):
             read a property from a specific object.
             if read fails return None.
         """
-        try:
-            obj_id = ObjectIdentifier(obj_id).value
-
-            datatype = get_datatype(obj_id[0], prop_id)
-            if not datatype:
-                self.logger.info("%s: invalid property for object type" % prop_id)
-                return None
-
-            # build a request
-            request = ReadPropertyRequest(
-                objectIdentifier=obj_id, propertyIdentifier=prop_id,
-            )
-            request.pduDestination = Address(addr)
-
-            if indx is not None:
-                request.propertyArrayIndex = indx
-
-            iocb = IOCB(request)
-            self.request_io(iocb)
-            # time.sleep(3)
-
-            iocb.set_timeout(5)
-            iocb.wait()
-
-            if iocb.ioError:
-                self.logger.error("READ ERROR:" + str(iocb.ioError) + "\n")
-
-            elif iocb.ioResponse:
-                apdu = iocb.ioResponse
-                if not isinstance(
-                    apdu, ReadPropertyACK
-                ):  # should be an ack to our request
-                    self.logger.error("Response not an ACK")
-                    return None
-
-                datatype = get_datatype(
-                    apdu.objectIdentifier[0], apdu.propertyIdentifier
-                )
-                if not datatype:
-                    self.logger.info("unknown datatype")
-                    return None
-
-                # special case for array parts, others are managed by cast_out
-                if issubclass(datatype, Array) and (
-                    apdu.propertyArrayIndex is not None
-                ):
-                    if apdu.propertyArrayIndex == 0:
-                        value = apdu.propertyValue.cast_out(Unsigned)
-                    else:
-                        value = apdu.propertyValue.cast_out(datatype.subtype)
-                else:
-                    value = apdu.propertyValue.cast_out(datatype)
-                return value
-
+        return self.value_or_none(self.read_object_async(addr, obj_id, prop_id, indx))
+
+    def read_object_async(self, addr, obj_id, prop_id, indx=None):
+        obj_type, obj_instance = ObjectIdentifier(obj_id).value
+        return self.read_async(addr, obj_type, obj_instance, prop_id, indx, self.read_timeout)
+
+    def value_or_none(self, future):
+        """ The value of a finished read, or None if the read failed. """
+        value = gather_result(future)
+        if isinstance(value, Exception):
+            if 'invalid property for object type' in str(value):
+                self.logger.info(str(value))
             else:
-                self.logger.error("ioError or ioResponse expected")
-        except Exception as error:
-            self.logger.error("exception:", error)
+                self.logger.error(str(value))
+            return None
+        return value
+
+    def discover_devices(self, timeout=5, target_device_ids=None):
+        """ Find devices with Who-Is requests and read their metadata.
+            If `target_device_ids` is given, only those devices are asked with directed Who-Is
+            requests, and the discovery ends as soon as all of them answer. Otherwise the
+            instance range is swept shard by shard, where each shard waits for I-Am responses
+            until they go quiet, or for `timeout` seconds at most.
+        """
+        self.devices = {}
+        if target_device_ids:
+            self.who_is_targets(target_device_ids, timeout)
+        else:
+            low, high = self.whois_range
+            for shard_low in range(low, high + 1, self.whois_shard_size):
+                shard_high = min(shard_low + self.whois_shard_size - 1, high)
+                self.who_is(shard_low, shard_high)
+                self.wait_for_quiet(timeout)
 
-        return None
+        self.update_device_metadata(self.devices)
+        return self.devices
 
-    def discover_devices(self, timeout=5):
-        """ Send a WhoIsRequest and wait for timeout seconds to receive all responses.  """
-        self.devices = {}
-        req = WhoIsRequest() # How does this know it needs to store at devices?
-        req.pduDestination = Address("255.255.255.255")  # Global Broadcast address
+    def who_is(self, low=None, high=None, addr=GLOBAL_BROADCAST):
+        """ Send a WhoIsRequest for the device instances between `low` and `high`. """
+        req = WhoIsRequest() # The I-Am responses are stored at self.devices by `indication`.
+        if low is not None:
+            req.deviceInstanceRangeLowLimit = low
+            req.deviceInstanceRangeHighLimit = high
+        req.pduDestination = Address(addr)
 
         iocb = IOCB(req)
         self.request_io(iocb)
         iocb.set_timeout(5)
         iocb.wait()
-        time.sleep(timeout)  # wait for 5 seconds so all the responses are received.
 
-        self.update_device_metadata(self.devices)
-        return self.devices
+    def wait_for_quiet(self, timeout, done=lambda: False):
+        """ Wait until no I-Am arrives for `whois_quiet_time` seconds, `done()` holds,
+            or `timeout` seconds pass.
+        """
+        start_time = time.time()
+        while not done():
+            now = time.time()
+            if now - start_time >= timeout:
+                break
+            if now - max(start_time, self.last_iam_time) >= self.whois_quiet_time:
+                break
+            time.sleep(0.05)
+
+    def who_is_targets(self, target_device_ids, timeout):
+        """ Send a directed Who-Is to each target device, to its last known address if any. """
+        known_addrs = self.sqlite_db.get_device_addresses()
+        for dev_id in target_device_ids:
+            self.who_is(dev_id, dev_id, known_addrs.get(dev_id) or GLOBAL_BROADCAST)
+        start_time = time.time()
+        all_found = lambda: all(dev_id in self.devices for dev_id in target_device_ids)
+        self.wait_for_quiet(timeout, all_found)
+        missing = [dev_id for dev_id in target_device_ids if dev_id not in self.devices]
+        if missing and any(dev_id in known_addrs for dev_id in missing):
+            # Devices may have moved since they were stored. Ask them again by broadcast.
+            for dev_id in missing:
+                self.who_is(dev_id, dev_id)
+            self.wait_for_quiet(max(0, timeout - (time.time() - start_time)), all_found)
+        for dev_id in target_device_ids:
+            if dev_id not in self.devices:
+                self.logger.warning(f"Device {dev_id} did not answer Who-Is.")
 
     def update_device_metadata(self, devices):
+        futures = {}
         for dev in devices.values():
-            dev["name"] = self.do_read(
-                dev["addr"], dev["device_identifier"], "objectName",
-            )
-            dev["description"] = self.do_read(
-                dev["addr"], dev["device_identifier"], "description",
-            )
-            dev["obj_count"] = self.do_read(
-                dev["addr"], dev["device_identifier"], "objectList", 0
-            )
-            dev["jci_name"] = self.do_read(
-                dev["addr"], dev["device_identifier"], "jci_name", 0
-            )
+            futures[dev["device_id"]] = {
+                "name": self.read_object_async(
+                    dev["addr"], dev["device_identifier"], "objectName",
+                ),
+                "description": self.read_object_async(
+                    dev["addr"], dev["device_identifier"], "description",
+                ),
+                "obj_count": self.read_object_async(
+                    dev["addr"], dev["device_identifier"], "objectList", 0
+                ),
+                "jci_name": self.read_object_async(
+                    dev["addr"], dev["device_identifier"], "jci_name", 0
+                ),
+                "database_revision": self.read_object_async(
+                    dev["addr"], dev["device_identifier"], "databaseRevision",
+                ),
+            }
+        for dev in devices.values():
+            for prop, future in futures[dev["device_id"]].items():
+                dev[prop] = self.value_or_none(future)
+
+            # A device whose databaseRevision and object count match the stored ones has not
+            # changed its objects since the last discovery.
+            stored = self.sqlite_db.read_device_revision(dev["device_id"])
+            if stored is not None and dev["database_revision"] is not None \
+                    and stored == (dev["database_revision"], dev["obj_count"]):
+                self.unchanged_devices.add(dev["device_id"])
+            else:
+                self.unchanged_devices.discard(dev["device_id"])
 
             self.sqlite_db.write_device_properties(dev)
 
     def discover_objects(self, target_devices):
         """ input_device_id_list specifies the objects to collect data from.
             if input_device_id_list is empty, data is collected from all devices discovered by whois
+            Up to `max_workers` devices are discovered at the same time.
         """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {device_id: executor.submit(self.discover_device_objects, device_id, dev)
+                       for device_id, dev in target_devices.items()}
         device_objs = {}
-        for device_id, dev in target_devices.items():
-            objs = {}
-            if not dev["obj_count"]:
-                self.logger.warning(f'Device {device_id} does not have any objects.')
-                continue
-            # read properties of the objects
-            for obj_idx in range(1, int(dev["obj_count"]) + 1): #TODO: Remove this
-                time.sleep(0.05) # TODO: Configure this.
-                obj = self.do_read(
-                    dev["addr"], dev["device_identifier"], "objectList", obj_idx
-                )
-                if obj is None:
-                    self.logger.warning(f"Object {obj_idx} in Device {device_id} does not exist.")
-                    continue
-                obj_type = obj[0]
-                if obj_type in ['device']:
-                    continue
-                obj_id = ":".join([str(x) for x in obj])
-                if obj_id in objs:
-                    self.logger.warning(f"Object {obj_id} already exists in Device {device_id}.")
-                obj_res = {
-                    "index": obj_idx,
-                    "device_ref": device_id,
-                    "instance": obj[1],
-                    "object_identifier": ":".join([str(x) for x in obj]),
-                    "object_type": self.do_read(dev["addr"], obj, "objectType"),
-                    "description": self.do_read(dev["addr"], obj, "description"),
-                    "jci_name":    self.do_read(dev["addr"], obj, "jciName"),
-                    "name":    self.do_read(dev["addr"], obj, "objectName"),
-                    "unit": self.do_read(dev["addr"], obj, "units"),
-                    "source_identifier": make_src_id(device_id, obj_id),
-                }
-                obj_res["uuid"] = None
-
-                for field, prop in self.object_custom_fields.items():
-                    obj_res[field] = self.do_read(dev['addr'], obj, prop)
-
-                self.sqlite_db.write_obj_properties(obj_res)
-
-                objs[obj_id] = obj_res
-            device_objs[device_id] = objs
+        for device_id, future in futures.items():
+            try:
+                device_objs[device_id] = future.result()
+            except Exception as e:
+                self.logger.error(f"Discovering objects in Device {device_id} failed: {e}")
+                device_objs[device_id] = {}
         return device_objs
 
+    def discover_device_objects(self, device_id, dev):
+        """ Read the objects of a device and store them.
+            In the incremental mode, an unchanged device is not read at all, and only the
+            objects added to a changed device are read. Stored objects keep their uuids.
+        """
+        objs = {}
+        if not dev["obj_count"]:
+            self.logger.warning(f'Device {device_id} does not have any objects.')
+            return objs
+        stored_objs = {}
+        if self.incremental:
+            stored_objs = {(obj["object_type"], obj["instance"]): obj
+                           for obj in self.sqlite_db.read_objects(device_id)}
+            if device_id in self.unchanged_devices and stored_objs:
+                self.logger.info(f'Device {device_id} has not changed since the last discovery.')
+                return {obj["object_identifier"]: obj for obj in stored_objs.values()}
+
+        if self.adaptive_pacing:
+            pacing = self.sqlite_db.read_pacing(device_id)
+            if pacing:
+                self.set_pacing(dev["addr"], *pacing)
+        listed = self.read_object_list(dev)
+        obj_list = [(obj_idx, obj) for obj_idx, obj in enumerate(listed, 1)
+                    if obj is not None and obj[0] not in ['device']]
+        new_obj_list = [(obj_idx, obj) for obj_idx, obj in obj_list if obj not in stored_objs]
+
+        # read properties of the objects
+        obj_props = self.read_object_properties(dev, [obj for _, obj in new_obj_list])
+        pacing = self.get_pacing(dev["addr"])
+        if pacing:
+            self.sqlite_db.write_pacing(device_id, *pacing)
+        for obj_idx, obj in obj_list:
+            obj_id = ":".join([str(x) for x in obj])
+            if obj_id in objs:
+                self.logger.warning(f"Object {obj_id} already exists in Device {device_id}.")
+            if obj in stored_objs:
+                objs[obj_id] = stored_objs[obj]
+                continue
+            obj_res = {
+                "index": obj_idx,
+                "device_ref": device_id,
+                "instance": obj[1],
+                "object_identifier": obj_id,
+                "source_identifier": make_src_id(device_id, obj_id),
+            }
+            obj_res.update(obj_props[obj])
+            if obj_res["object_type"] is None:
+                obj_res["object_type"] = obj[0]
+            obj_res["uuid"] = None
+
+            objs[obj_id] = obj_res
+        self.sqlite_db.write_objects([objs[":".join([str(x) for x in obj])]
+                                      for _, obj in new_obj_list])
+        if None in listed:
+            # The objects at the entries that failed to read are not known to be removed, so the
+            # stored objects are all kept, with their uuids.
+            self.logger.warning(f'The objectList of Device {device_id} was not read completely, '
+                                'so no objects are removed from it.')
+            for stored_obj in stored_objs.values():
+                objs.setdefault(stored_obj["object_identifier"], stored_obj)
+        else:
+            # Objects removed from the device since the last discovery.
+            removed = self.sqlite_db.delete_objects_except(device_id,
+                                                           [obj for _, obj in obj_list])
+            if removed:
+                self.logger.info(f'{removed} objects were removed from Device {device_id}.')
+        # Only once every object of this revision is stored can the next incremental discovery
+        # skip the device. objectName is required, so an object without one was not read.
+        if None not in listed and all(obj_props[obj]["name"] is not None for _, obj in new_obj_list):
+            self.sqlite_db.write_device_revision(device_id, dev["database_revision"],
+                                                 dev["obj_count"])
+        return objs
+
+    def read_object_list(self, dev):
+        """ The object identifiers in a device. The whole objectList is read in one (segmented)
+            request, or one entry at a time if the device cannot send it at once.
+        """
+        obj_list = self.do_read(dev["addr"], dev["device_identifier"], "objectList")
+        if obj_list is not None:
+            return [tuple(obj) for obj in obj_list]
+
+        futures = [self.read_object_async(dev["addr"], dev["device_identifier"], "objectList",
+                                          obj_idx)
+                   for obj_idx in range(1, int(dev["obj_count"]) + 1)]
+        obj_list = []
+        for obj_idx, future in enumerate(futures, 1):
+            obj = self.value_or_none(future)
+            if obj is None:
+                self.logger.warning(f"Object {obj_idx} in Device {dev['device_id']} does not exist.")
+            obj_list.append(tuple(obj) if obj is not None else None)
+        return obj_list
+
+    def read_object_properties(self, dev, objs):
+        """ Read `object_fields` of all `objs` in a device with ReadPropertyMultiple requests,
+            or with single reads if the device does not support them.
+            returns {obj: {field: value}}, where a value is None if it could not be read.
+        """
+        props = list(self.object_fields.values())
+        batch_size = rpm_batch_size(dev["max_apdu"], len(props), DISCOVERY_PROPERTY_BYTES)
+        batches = list(striding_window(objs, batch_size)) if self.use_rpm else [objs]
+        if self.use_rpm:
+            futures = [self.read_multiple_async(dev["addr"], {obj: props for obj in batch},
+                                                self.read_timeout)
+                       for batch in batches]
+        else:
+            futures = [None]
+
+        obj_props = {}
+        use_rpm = self.use_rpm
+        for batch, future in zip(batches, futures):
+            results = gather_result(future) if future else None
+            if isinstance(results, RpmNotSupported):
+                self.logger.warning(f"Device {dev['device_id']} falls back to single reads: {results}")
+                use_rpm = False
+            if not use_rpm or isinstance(results, Exception):
+                results = self.read_properties_single(dev, batch, props)
+            for obj in batch:
+                obj_results = results.get(obj, {})
+                obj_props[obj] = {}
+                for field, prop in self.object_fields.items():
+                    value = obj_results.get(prop)
+                    if isinstance(value, Exception):
+                        self.logger.info(f"{prop} of {obj} in Device {dev['device_id']}: {value}")
+                        value = None
+                    obj_props[obj][field] = value
+        return obj_props
+
+    def read_properties_single(self, dev, objs, props):
+        futures = {obj: {prop: self.read_async(dev["addr"], obj[0], obj[1], prop,
+                                               timeout=self.read_timeout)
+                         for prop in props}
+                   for obj in objs}
+        return {obj: {prop: gather_result(future) for prop, future in prop_futures.items()}
+                for obj, prop_futures in futures.items()}
+
 
 def run_thread():
     """ bacpypes runs a async core, which processes incoming responses, before handing over to
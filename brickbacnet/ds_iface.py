@@ -13,12 +13,23 @@ class DsSensorData():
     """
 
 
+class PartialUpload(Exception):
+    """ Raised by put_timeseries_data when only some of the datapoints were stored.
+        `datapoints` are the ones that were not, and are the only ones to upload again.
+    """
+
+    def __init__(self, message, datapoints):
+        Exception.__init__(self, message)
+        self.datapoints = datapoints
+
+
 class DsIface(object):
 
     def put_timeseries_data(self, datapoints):
         """ Push a batch of datapoints.
             Overload if a more efficient way to PUT exists.
             Default is to call put_timeseries_datapoint() for each sensor, datapoint pair
+            Raise PartialUpload if only some of them were stored.
         """
         raise NotImplementedError('Method not implemented!')
 
@@ -40,3 +51,15 @@ class DsIface(object):
         """
         raise NotImplementedError('Method not implemented!')
 
+    def create_entities(self, entity_type, count):
+        """ get the identifiers of `count` newly created entities.
+            Overload if the data service can create them in one request.
+        """
+        return [self.create_entity(entity_type) for _ in range(count)]
+
+    def query_device_points(self, device_id):
+        """ get the identifiers of the existing points of a device
+            as {(object_type, instance): [identifiers]}
+        """
+        raise NotImplementedError('Method not implemented!')
+
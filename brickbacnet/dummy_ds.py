@@ -8,5 +8,11 @@ class DummyDs(DsIface):
     def create_entity(self, entity_type):
         return str(gen_uuid())
 
+    def create_entities(self, entity_type, count):
+        return [str(gen_uuid()) for _ in range(count)]
+
     def query_entities(self, props):
         return []
+
+    def query_device_points(self, device_id):
+        return {}
@@ -0,0 +1,166 @@
+""" Operational metrics in the Prometheus text format.
+    Metrics are registered in METRICS, served over HTTP by `start_metrics_server`, or written to a
+    file by `write_metrics_file` for a node exporter's textfile collector to pick up.
+"""
+
+import os
+import threading
+from bisect import bisect_left
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(names, values, extra=''):
+    pairs = ['{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                                   .replace('\n', '\\n'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """ A metric with a value per combination of its label values. """
+    type_name = None
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.type_name}']
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines += self.render_value(label_values, value)
+        return lines
+
+    def render_value(self, label_values, value):
+        return [self.name + format_labels(self.label_names, label_values) + ' '
+                + format_value(value)]
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    type_name = 'gauge'
+
+    def set(self, *label_values, value):
+        with self.lock:
+            self.values[label_values] = value
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help_text, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *label_values, value):
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                # counts per bucket, with the +Inf bucket last, then the sum.
+                counts = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def render_value(self, label_values, counts):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            labels = format_labels(self.label_names, label_values,
+                                   'le="{0}"'.format(format_value(bound)))
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = format_labels(self.label_names, label_values)
+        lines.append(f'{self.name}_sum{labels} {format_value(counts[-1])}')
+        lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class MetricsRegistry(object):
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = [] # functions called before rendering, to update gauges.
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """ Register a metric, or return the one already registered with its name. """
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help_text, label_names=()):
+        return self.register(Counter(name, help_text, label_names))
+
+    def gauge(self, name, help_text, label_names=()):
+        return self.register(Gauge(name, help_text, label_names))
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, label_names, buckets))
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        for collector in self.collectors:
+            collector()
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = MetricsRegistry()
+
+
+def start_metrics_server(port, registry=METRICS, host=''):
+    """ Serve the metrics at http://host:port/metrics from a daemon thread. """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+
+def write_metrics_file(path, registry=METRICS):
+    """ Replace the file at `path` with the metrics, so that readers never see half of them. """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fp:
+        fp.write(registry.render())
+    os.replace(tmp_path, path)
@@ -0,0 +1,84 @@
+""" N-Triples serialization of discovered devices and objects.
+    Triples are generated one line at a time from the discovery results, so that a whole site
+    can be written and uploaded without holding an rdflib Graph of it in memory.
+"""
+
+import math
+
+from .namespaces import BACNET, RDF
+
+
+XSD = 'http://www.w3.org/2001/XMLSchema#'
+
+
+def uri_term(uri):
+    return f'<{uri}>'
+
+
+def escape_literal(s):
+    return s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def literal_term(val):
+    """ A literal typed the same way rdflib's Literal types python values. """
+    if isinstance(val, bool):
+        return f'"{str(val).lower()}"^^<{XSD}boolean>'
+    if isinstance(val, int):
+        return f'"{val}"^^<{XSD}integer>'
+    if isinstance(val, float):
+        if math.isnan(val):
+            lexical = 'NaN'
+        elif math.isinf(val):
+            lexical = 'INF' if val > 0 else '-INF'
+        else:
+            lexical = repr(val)
+        return f'"{lexical}"^^<{XSD}double>'
+    return '"' + escape_literal(str(val)) + '"'
+
+
+def triple(s, p, o):
+    return f'{s} {p} {o} .\n'
+
+
+def brick_triples(BRICK, devices, device_objs, dev_uris, obj_uris, property_filters):
+    """ Lines of the triples of `devices` and their objects in `device_objs`.
+        `dev_uris` are the URIs of devices by their ids and `obj_uris` are the URIs of objects by
+        their device ids and (object_type, instance).
+    """
+    rdf_type = uri_term(RDF.type)
+    has_point = uri_term(BRICK.hasPoint)
+    is_point_of = uri_term(BRICK.isPointOf)
+    point = uri_term(BRICK.Point)
+    for dev_props in devices.values():
+        dev_id = dev_props['device_id']
+        dev_uri = uri_term(dev_uris[dev_id])
+        yield triple(dev_uri, rdf_type, uri_term(BACNET.BACnet_Device))
+        for prop, val in dev_props.items():
+            if prop in property_filters:
+                continue
+            yield triple(dev_uri, uri_term(BACNET[prop]), literal_term(val))
+        for obj_props in device_objs[dev_id].values():
+            obj_uri = uri_term(obj_uris[dev_id][(obj_props['object_type'], obj_props['instance'])])
+            yield triple(obj_uri, rdf_type, point)
+            yield triple(dev_uri, has_point, obj_uri)
+            yield triple(obj_uri, is_point_of, dev_uri)
+            for prop, val in obj_props.items():
+                if prop in property_filters:
+                    continue
+                yield triple(obj_uri, uri_term(BACNET[prop]), literal_term(val))
+
+
+def chunk_lines(lines, max_bytes):
+    """ Join lines into chunks of up to `max_bytes` bytes, unless a line is longer. """
+    chunk = []
+    size = 0
+    for line in lines:
+        line_size = len(line.encode('utf-8'))
+        if chunk and size + line_size > max_bytes:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+        chunk.append(line)
+        size += line_size
+    if chunk:
+        yield ''.join(chunk)
@@ -0,0 +1,89 @@
+""" A durable buffer of datapoints to upload.
+    Datapoints are appended to a SQLite table before they are uploaded and deleted only once the
+    data service accepts them, so they survive outages of the data service and restarts of the
+    connector. The table is kept under `max_bytes` by deleting the oldest datapoints.
+"""
+
+import json
+
+import sqlite3
+
+from .sqlite_wrapper import cursor_to_commit
+
+
+class Outbox(object):
+    """ Rows are keyed by an increasing id, which is what a batch is acknowledged by. Not thread
+        safe; Uploader serializes the calls.
+    """
+
+    def __init__(self, path, max_bytes=1024**3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with cursor_to_commit(self.conn) as c:
+            # AUTOINCREMENT keeps the ids of deleted rows from being reused while a batch
+            # with them is being uploaded.
+            c.execute("CREATE TABLE IF NOT EXISTS outbox (" +
+                      "id INTEGER PRIMARY KEY AUTOINCREMENT, " +
+                      "queued_time real NOT NULL, " +
+                      "uuid varchar(36), " +
+                      "object_type varchar(255), " +
+                      "timestamp real, " +
+                      "value text)")
+        self.page_size = self.conn.execute("PRAGMA page_size").fetchone()[0]
+        self.num_rows = self.conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def __len__(self):
+        return self.num_rows
+
+    def used_bytes(self):
+        page_count = self.conn.execute("PRAGMA page_count").fetchone()[0]
+        freelist_count = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return (page_count - freelist_count) * self.page_size
+
+    def append(self, datapoints, now):
+        """ Store datapoints, returning the number of old ones evicted to stay under quota. """
+        rows = [(now, datapoint['uuid'], datapoint['object_type'], datapoint['timestamp'],
+                 json.dumps(datapoint['value']))
+                for datapoint in datapoints]
+        with cursor_to_commit(self.conn) as c:
+            c.executemany("INSERT INTO outbox (queued_time, uuid, object_type, timestamp, value) " +
+                          "VALUES (?, ?, ?, ?, ?)", rows)
+        self.num_rows += len(rows)
+        num_evicted = 0
+        while self.num_rows and self.used_bytes() > self.max_bytes:
+            num_evicted += self.evict(max(len(rows), self.num_rows // 100))
+        return num_evicted
+
+    def evict(self, num_rows):
+        with cursor_to_commit(self.conn) as c:
+            c.execute("DELETE FROM outbox WHERE id IN " +
+                      "(SELECT id FROM outbox ORDER BY id LIMIT ?)", (num_rows,))
+            num_evicted = c.rowcount
+        self.num_rows -= num_evicted
+        return num_evicted
+
+    def oldest_time(self):
+        row = self.conn.execute("SELECT queued_time FROM outbox ORDER BY id LIMIT 1").fetchone()
+        return row[0] if row else None
+
+    def peek(self, num_rows):
+        """ The oldest datapoints, and the key to acknowledge them with. """
+        rows = self.conn.execute("SELECT id, uuid, object_type, timestamp, value FROM outbox " +
+                                 "ORDER BY id LIMIT ?", (num_rows,)).fetchall()
+        datapoints = [{
+            'uuid': uuid,
+            'object_type': object_type,
+            'timestamp': timestamp,
+            'value': json.loads(value),
+        } for _, uuid, object_type, timestamp, value in rows]
+        return (rows[-1][0] if rows else None), datapoints
+
+    def ack(self, key):
+        """ Delete the datapoints up to `key` once they are uploaded. """
+        with cursor_to_commit(self.conn) as c:
+            c.execute("DELETE FROM outbox WHERE id <= ?", (key,))
+            num_acked = c.rowcount
+        self.num_rows -= num_acked
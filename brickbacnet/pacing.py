@@ -0,0 +1,58 @@
+""" Adaptive pacing of the requests to a device.
+    The number of requests in flight grows additively while responses come back quickly and
+    without errors, and halves on a timeout or when the device reports that it is busy (AIMD).
+    Once a single request at a time is still too much, requests are also spaced apart.
+"""
+
+import time
+
+
+# A response that took longer than this many times the fastest one, plus the slack in seconds,
+# means requests are queueing up in the device or on the way to it.
+SLOW_RTT_FACTOR = 2
+SLOW_RTT_SLACK = 0.05
+MIN_GAP = 0.01 # seconds
+MAX_GAP = 2 # seconds
+
+
+class Pacer(object):
+    """ `limit` is the number of requests allowed in flight, between 1 and `max_limit`, and
+        `gap` is the time between sending requests.
+    """
+    __slots__ = ('max_limit', 'limit', 'gap', 'min_rtt', 'last_backoff_time')
+
+    def __init__(self, max_limit, limit=1, gap=0):
+        self.max_limit = max_limit
+        self.limit = min(max(1, limit), max_limit)
+        self.gap = gap
+        self.min_rtt = None
+        self.last_backoff_time = 0
+
+    @property
+    def size(self):
+        return int(self.limit)
+
+    def on_response(self, rtt):
+        """ A response arrived `rtt` seconds after its request was sent. """
+        if self.min_rtt is None or rtt < self.min_rtt:
+            self.min_rtt = rtt
+        if rtt > self.min_rtt * SLOW_RTT_FACTOR + SLOW_RTT_SLACK:
+            return
+        if self.gap > 0:
+            self.gap = self.gap * 0.9 if self.gap > MIN_GAP else 0
+        else:
+            # About one more request in flight for every `limit` quick responses.
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def on_congestion(self, sent_time):
+        """ A request sent at `sent_time` timed out or was refused because of load.
+            The requests sent before the last backoff do not back off again.
+        """
+        if sent_time < self.last_backoff_time:
+            return
+        self.last_backoff_time = time.time()
+        if self.limit >= 2:
+            self.limit = max(1, self.limit / 2)
+        else:
+            self.limit = 1
+            self.gap = min(MAX_GAP, max(MIN_GAP, self.gap * 2))
@@ -0,0 +1,46 @@
+""" The objects a connector polls in a device, compiled once from the SQLite database and reused
+    across cycles until the discovery data changes.
+"""
+
+
+class PollPoint(object):
+    __slots__ = ('uuid', 'object_type', 'instance', 'interval')
+
+    def __init__(self, uuid, object_type, instance, interval=None):
+        self.uuid = uuid
+        self.object_type = object_type
+        self.instance = instance
+        self.interval = interval # seconds between reads.
+
+    def __repr__(self):
+        return f'PollPoint({self.object_type}:{self.instance}, {self.uuid})'
+
+
+class PollPlan(object):
+    """ A device's properties and its points to poll, with skipped object types already removed.
+        `data_version` is the version of the database the plan is compiled from.
+    """
+    __slots__ = ('dev', 'points', 'data_version')
+
+    def __init__(self, dev, points, data_version):
+        self.dev = dev
+        self.points = points
+        self.data_version = data_version
+
+    @classmethod
+    def compile(cls, sqlite_db, dev_id, skip_object_types, logger=None, intervals=None):
+        """ `intervals` is a PollIntervals that sets the polling interval of each point. """
+        data_version = sqlite_db.data_version()
+        dev = sqlite_db.read_device_properties(dev_id)
+        skip_object_types = set(skip_object_types)
+        points = []
+        for uuid, instance, object_type, name, poll_interval in sqlite_db.read_poll_rows(dev_id):
+            if object_type in skip_object_types:
+                continue
+            if not uuid:
+                if logger:
+                    logger.warning(f'Object {instance} at Device {dev_id} is not polled because it does not have a UUID')
+                continue
+            interval = intervals.resolve(object_type, name, poll_interval) if intervals else None
+            points.append(PollPoint(uuid, object_type, instance, interval))
+        return cls(dev, points, data_version)
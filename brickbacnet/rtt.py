@@ -0,0 +1,57 @@
+""" Timeouts derived from the round-trip times of a device, as TCP does (RFC 6298).
+    The timeout is the smoothed RTT plus four times its mean deviation, doubled after each
+    timeout until a response arrives again.
+"""
+
+from collections import deque
+
+
+INITIAL_TIMEOUT = 3 # seconds, until the first response.
+MIN_TIMEOUT = 0.2 # seconds
+MAX_TIMEOUT = 10 # seconds
+RTT_GAIN = 1 / 8
+RTTVAR_GAIN = 1 / 4
+NUM_SAMPLES = 100 # recent RTTs kept for the percentiles.
+MIN_SAMPLES = 20 # RTTs needed before a percentile is trusted.
+
+
+class RttEstimator(object):
+    __slots__ = ('srtt', 'rttvar', 'backoff', 'samples', 'sorted_samples')
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.backoff = 1
+        self.samples = deque(maxlen=NUM_SAMPLES)
+        self.sorted_samples = None # cache of `samples` sorted, cleared by each new sample.
+
+    @property
+    def timeout(self):
+        if self.srtt is None:
+            timeout = INITIAL_TIMEOUT
+        else:
+            timeout = max(MIN_TIMEOUT, self.srtt + 4 * self.rttvar)
+        return min(MAX_TIMEOUT, timeout * self.backoff)
+
+    def on_response(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += RTTVAR_GAIN * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += RTT_GAIN * (rtt - self.srtt)
+        self.backoff = 1
+        self.samples.append(rtt)
+        self.sorted_samples = None
+
+    def on_timeout(self):
+        self.backoff = min(self.backoff * 2, MAX_TIMEOUT / MIN_TIMEOUT)
+
+    def percentile(self, q):
+        """ The `q` quantile of the recent RTTs, or None until there are enough of them. """
+        if len(self.samples) < MIN_SAMPLES:
+            return None
+        if self.sorted_samples is None:
+            self.sorted_samples = sorted(self.samples)
+        return self.sorted_samples[min(len(self.sorted_samples) - 1,
+                                       int(q * len(self.sorted_samples)))]
@@ -0,0 +1,124 @@
+""" Per-point polling intervals.
+    Points with the same interval are split into groups of a batch size, and the groups are
+    spread over their interval so the load on a device stays flat. The groups that are due come
+    out of a priority queue ordered by their due time.
+"""
+
+import re
+import heapq
+import itertools
+
+
+class PollIntervals(object):
+    """ Resolves the polling interval of a point from, in order of precedence,
+        its `poll_interval` in SQLite, the first of `name_patterns` (regular expressions)
+        matching its name, its type in `object_types`, and `default`.
+    """
+
+    def __init__(self, default, object_types=None, name_patterns=None):
+        self.default = default
+        self.object_types = object_types or {}
+        self.name_patterns = [(re.compile(pattern), interval)
+                              for pattern, interval in (name_patterns or {}).items()]
+
+    @classmethod
+    def from_config(cls, config, default):
+        """ `config` is the `poll_intervals` entry of the connector configuration. """
+        config = config or {}
+        return cls(config.get('default', default),
+                   config.get('object_types'),
+                   config.get('name_patterns'),
+                   )
+
+    def resolve(self, object_type, name, poll_interval=None):
+        if poll_interval:
+            return float(poll_interval)
+        if name:
+            for pattern, interval in self.name_patterns:
+                if pattern.search(name):
+                    return float(interval)
+        return float(self.object_types.get(object_type, self.default))
+
+
+class PollGroup(object):
+    __slots__ = ('interval', 'points', 'key')
+
+    def __init__(self, interval, points):
+        self.interval = interval
+        self.points = points
+        self.key = (interval, tuple(point.uuid for point in points))
+
+
+class PollSchedule(object):
+    """ The polling schedule of a device, built from its poll plan. When the plan is recompiled,
+        the groups that are the same as in the `previous` schedule keep their due times, so that
+        changes elsewhere in the database do not start the schedule over.
+    """
+
+    def __init__(self, plan, batch_size, now, previous=None):
+        self.plan = plan
+        self.queue = [] # (due time, sequence, PollGroup)
+        self.counter = itertools.count()
+        self.groups = []
+        previous_dues = {}
+        previous_pending = set()
+        # The current pass over every group, which the cycle time of the device is measured by.
+        self.pass_start = now
+        if previous is not None:
+            previous_dues = {group.key: due for due, _, group in previous.queue}
+            previous_pending = set(group.key for group in previous.pass_pending)
+            self.pass_start = previous.pass_start
+        points_per_interval = {}
+        for point in plan.points:
+            points_per_interval.setdefault(point.interval, []).append(point)
+        for interval, points in points_per_interval.items():
+            # Neighboring instances are kept together so that they share requests.
+            points.sort(key=lambda point: (point.object_type, point.instance))
+            groups = [points[i:i + batch_size] for i in range(0, len(points), batch_size)]
+            for i, group_points in enumerate(groups):
+                group = PollGroup(interval, group_points)
+                due = previous_dues.get(group.key)
+                if due is None:
+                    due = now + interval * i / len(groups)
+                self.groups.append(group)
+                self.push(due, group)
+        self.pass_pending = set(group for group in self.groups
+                                if group.key in previous_pending or group.key not in previous_dues)
+
+    def push(self, due, group):
+        heapq.heappush(self.queue, (due, next(self.counter), group))
+
+    def next_due(self):
+        return self.queue[0][0] if self.queue else None
+
+    def pop_due(self, now):
+        """ The groups due at `now`, with their due times. """
+        due_groups = []
+        while self.queue and self.queue[0][0] <= now:
+            due, _, group = heapq.heappop(self.queue)
+            due_groups.append((due, group))
+        return due_groups
+
+    def reschedule(self, due, group, now):
+        """ Schedule a group for its next interval, skipping the intervals already missed so
+            that it keeps its phase.
+        """
+        due += group.interval
+        if due <= now:
+            if group.interval > 0:
+                due += group.interval * ((now - due) // group.interval + 1)
+            else: # Polled as fast as possible.
+                due = now
+        self.push(due, group)
+
+    def complete(self, group, now):
+        """ Mark a group read in the current pass. returns how long the pass took once every
+            group was read in it, and starts the next pass, or None.
+        """
+        self.pass_pending.discard(group)
+        if self.pass_pending:
+            return None
+        duration = now - self.pass_start
+        self.pass_start = now
+        self.pass_pending = set(self.groups)
+        return duration
@@ -0,0 +1,189 @@
+""" Simulated BACnet devices for measuring discovery and connectors without a building network.
+    A DeviceFarm runs N devices with M objects each on loopback, one UDP port per device, with
+    injectable response latency, request loss, max APDU size, and ReadPropertyMultiple,
+    WritePropertyMultiple and COV support. Value objects are commandable, so they take writes at
+    a priority.
+"""
+
+import random
+import logging
+
+from bacpypes.core import run as bacpypes_run
+from bacpypes.app import BIPSimpleApplication
+from bacpypes.local.device import LocalDeviceObject
+from bacpypes.object import AnalogInputObject, BinaryValueObject, PropertyError, \
+    register_object_type
+from bacpypes.local.object import AnalogValueCmdObject, BinaryValueCmdObject
+from bacpypes.apdu import SimpleAckPDU, WritePropertyMultipleError
+from bacpypes.basetypes import ErrorType, ObjectPropertyReference
+from bacpypes.capability import Capability
+from bacpypes.constructeddata import Array
+from bacpypes.errors import ExecutionError
+from bacpypes.primitivedata import Null, Unsigned
+from bacpypes.service.object import ReadWritePropertyMultipleServices
+from bacpypes.service.cov import ChangeOfValueServices
+from bacpypes.task import FunctionTask, RecurringFunctionTask
+
+
+SIMULATED_VENDOR_ID = 15
+# bacpypes does not register its commandable objects, so their properties are only collected
+# once they are registered, here for the simulator's vendor.
+register_object_type(AnalogValueCmdObject, vendor_id=SIMULATED_VENDOR_ID)
+register_object_type(BinaryValueCmdObject, vendor_id=SIMULATED_VENDOR_ID)
+
+SIMULATED_OBJECT_TYPES = {
+    'analogInput': AnalogInputObject,
+    'analogValue': AnalogValueCmdObject,
+    'binaryValue': BinaryValueCmdObject,
+}
+
+
+class SimulatedDevice(BIPSimpleApplication):
+    """ A device that answers each request after `latency` seconds and ignores a `loss` fraction
+        of them, as if they were lost on the network.
+    """
+
+    def __init__(self, local_device, local_address, latency=0, loss=0):
+        BIPSimpleApplication.__init__(self, local_device, local_address)
+        self.latency = latency
+        self.loss = loss
+
+    def indication(self, apdu):
+        if self.loss and random.random() < self.loss:
+            return
+        BIPSimpleApplication.indication(self, apdu)
+
+    def response(self, apdu):
+        if not self.latency:
+            BIPSimpleApplication.response(self, apdu)
+            return
+        task = FunctionTask(BIPSimpleApplication.response, self, apdu)
+        task.install_task(delta=self.latency)
+
+
+class WritePropertyMultipleServices(Capability):
+    """ Writes the properties of a WritePropertyMultiple request in order, and stops at the
+        first one that fails, as the standard requires.
+    """
+
+    def do_WritePropertyMultipleRequest(self, apdu):
+        for spec in apdu.listOfWriteAccessSpecs:
+            obj = self.get_object_id(spec.objectIdentifier)
+            for prop_value in spec.listOfProperties:
+                try:
+                    if not obj:
+                        raise ExecutionError(errorClass='object', errorCode='unknownObject')
+                    self.write_property_value(obj, prop_value)
+                except ExecutionError as err:
+                    self.response(WritePropertyMultipleError(
+                        errorType=ErrorType(errorClass=err.errorClass, errorCode=err.errorCode),
+                        firstFailedWriteAttempt=ObjectPropertyReference(
+                            objectIdentifier=spec.objectIdentifier,
+                            propertyIdentifier=prop_value.propertyIdentifier,
+                            propertyArrayIndex=prop_value.propertyArrayIndex,
+                        ),
+                        context=apdu,
+                    ))
+                    return
+        self.response(SimpleAckPDU(context=apdu))
+
+    def write_property_value(self, obj, prop_value):
+        """ The same as a WriteProperty request of a single PropertyValue. """
+        prop_id = prop_value.propertyIdentifier
+        array_index = prop_value.propertyArrayIndex
+        try:
+            datatype = obj.get_datatype(prop_id)
+        except PropertyError:
+            raise ExecutionError(errorClass='property', errorCode='unknownProperty')
+        if prop_value.value.is_application_class_null():
+            datatype = Null
+        elif issubclass(datatype, Array) and array_index is not None:
+            datatype = Unsigned if array_index == 0 else datatype.subtype
+        obj.WriteProperty(prop_id, prop_value.value.cast_out(datatype), array_index,
+                          prop_value.priority)
+
+
+def get_device_class(rpm, cov, wpm=False):
+    capabilities = []
+    if rpm:
+        capabilities.append(ReadWritePropertyMultipleServices)
+    if wpm:
+        capabilities.append(WritePropertyMultipleServices)
+    if cov:
+        capabilities.append(ChangeOfValueServices)
+    if not capabilities:
+        return SimulatedDevice
+    return type('SimulatedDevice', (SimulatedDevice,) + tuple(capabilities), {})
+
+
+def make_object(object_type, instance):
+    obj_class = SIMULATED_OBJECT_TYPES[object_type]
+    props = {
+        'objectIdentifier': (object_type, instance),
+        'objectName': f'{object_type}_{instance}',
+        'description': f'Simulated {object_type} {instance}',
+        'statusFlags': [0, 0, 0, 0],
+    }
+    if object_type.startswith('binary'):
+        props['presentValue'] = 'inactive'
+    else:
+        props['presentValue'] = float(instance)
+        props['units'] = 'degreesFahrenheit'
+        props['covIncrement'] = 0.5
+    return obj_class(**props)
+
+
+class DeviceFarm(object):
+    """ `num_devices` devices with ids from `first_device_id`, listening at 127.0.0.1 from
+        `base_port`. Their objects cycle through `object_types`. Every `drift_interval` seconds,
+        a `drift_fraction` of the objects change their values.
+    """
+
+    def __init__(self, num_devices, num_objects, base_port=47809, first_device_id=1000,
+                 latency=0, loss=0, max_apdu=1476, rpm=True, wpm=True, cov=False,
+                 object_types=('analogInput', 'analogValue', 'binaryValue'),
+                 drift_interval=None, drift_fraction=0.1, host='127.0.0.1'):
+        self.logger = logging.getLogger('device_farm')
+        device_class = get_device_class(rpm, cov, wpm)
+        segmentation = 'segmentedBoth' if max_apdu >= 480 else 'noSegmentation'
+        self.devices = {}
+        self.objects = []
+        for i in range(num_devices):
+            dev_id = first_device_id + i
+            local_device = LocalDeviceObject(
+                objectName=f'simulated_{dev_id}',
+                objectIdentifier=dev_id,
+                maxApduLengthAccepted=max_apdu,
+                segmentationSupported=segmentation,
+                vendorIdentifier=SIMULATED_VENDOR_ID,
+            )
+            app = device_class(local_device, f'{host}:{base_port + i}', latency, loss)
+            for instance in range(num_objects):
+                obj = make_object(object_types[instance % len(object_types)], instance)
+                app.add_object(obj)
+                self.objects.append(obj)
+            self.devices[dev_id] = app
+        self.addrs = {dev_id: f'{host}:{base_port + i}' for i, dev_id in enumerate(self.devices)}
+        self.drift_fraction = drift_fraction
+        if drift_interval:
+            self.drift_task = RecurringFunctionTask(int(drift_interval * 1000), self.drift)
+            self.drift_task.install_task()
+        self.logger.info('Simulating {0} devices with {1} objects each'
+                         .format(num_devices, num_objects))
+
+    def drift(self):
+        for obj in random.sample(self.objects, int(len(self.objects) * self.drift_fraction)):
+            if isinstance(obj, BinaryValueObject):
+                obj.presentValue = 'active' if obj.presentValue == 'inactive' else 'inactive'
+            else:
+                obj.presentValue = obj.presentValue + random.uniform(-1, 1)
+
+
+def run_farm(ready=None, **farm_params):
+    """ Run a DeviceFarm until the process is killed. `ready` is an Event set once the devices
+        are listening.
+    """
+    farm = DeviceFarm(**farm_params)
+    if ready is not None:
+        ready.set()
+    bacpypes_run()
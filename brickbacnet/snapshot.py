@@ -0,0 +1,167 @@
+""" The last value read of each point, kept in the connector's memory and served over HTTP, so
+    that dashboards get current values without a BACnet round trip or a Brick Server query.
+"""
+
+import json
+import math
+import threading
+from array import array
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class LastValues(object):
+    """ Parallel arrays with a slot per point, found by its uuid or its device. The timestamp of
+        a point that was never read is NaN. Reads happen in the connector's event loop and
+        lookups in the server's threads, so the arrays are guarded by a lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.slots = {} # uuid -> slot
+        self.device_slots = {} # device_id -> slots of the device's points
+        self.points = [] # PollPoint
+        self.device_ids = array('q')
+        self.values = []
+        self.timestamps = array('d')
+        self.polled = array('b') # 0 for the points that left their device's poll plan.
+
+    def set_points(self, dev_id, points):
+        """ The points of a device, from its poll plan. The values of known points are kept,
+            and the points no longer in the plan, e.g. quarantined ones, are not read again.
+        """
+        with self.lock:
+            for slot in self.device_slots.get(dev_id, []):
+                self.polled[slot] = 0
+            slots = []
+            for point in points:
+                slot = self.slots.get(point.uuid)
+                if slot is None:
+                    slot = self.slots[point.uuid] = len(self.points)
+                    self.points.append(point)
+                    self.device_ids.append(dev_id)
+                    self.values.append(None)
+                    self.timestamps.append(math.nan)
+                    self.polled.append(1)
+                else:
+                    self.points[slot] = point
+                    self.device_ids[slot] = dev_id
+                    self.polled[slot] = 1
+                slots.append(slot)
+            self.device_slots[dev_id] = slots
+
+    def update(self, datapoints):
+        """ Record the values of datapoints read or notified. """
+        with self.lock:
+            for datapoint in datapoints:
+                slot = self.slots.get(datapoint['uuid'])
+                if slot is None:
+                    continue
+                # Values may arrive out of order from polling and COV notifications.
+                if not datapoint['timestamp'] < self.timestamps[slot]:
+                    self.values[slot] = datapoint['value']
+                    self.timestamps[slot] = datapoint['timestamp']
+
+    def find_slots(self, uuids=None, device_ids=None):
+        """ (slots of the points with `uuids` or in `device_ids`, the uuids that are unknown). """
+        slots = []
+        unknown = []
+        with self.lock:
+            for uuid in uuids or []:
+                slot = self.slots.get(uuid)
+                if slot is None:
+                    unknown.append(uuid)
+                else:
+                    slots.append(slot)
+            for dev_id in device_ids or []:
+                slots += self.device_slots.get(dev_id, [])
+        return slots, unknown
+
+    def stale_points(self, slots, max_age, now):
+        """ {device_id: [PollPoint]} of the polled points in `slots` last read more than
+            `max_age` seconds ago, or never.
+        """
+        stale = {}
+        with self.lock:
+            for slot in slots:
+                if self.polled[slot] and not now - self.timestamps[slot] <= max_age:
+                    stale.setdefault(self.device_ids[slot], []).append(self.points[slot])
+        return stale
+
+    def get(self, slots, max_age, now):
+        """ The entries of the points in `slots`, with their `age` in seconds and whether they
+            are `stale`, i.e. older than `max_age`.
+        """
+        entries = []
+        with self.lock:
+            for slot in slots:
+                point = self.points[slot]
+                timestamp = self.timestamps[slot]
+                read = not math.isnan(timestamp)
+                entries.append({
+                    'uuid': point.uuid,
+                    'device_id': self.device_ids[slot],
+                    'object_type': point.object_type,
+                    'instance': point.instance,
+                    'value': self.values[slot],
+                    'timestamp': timestamp if read else None,
+                    'age': now - timestamp if read else None,
+                    'stale': not now - timestamp <= max_age,
+                })
+        return entries
+
+
+def parse_list(values):
+    return [item for value in values for item in value.split(',') if item]
+
+
+def start_snapshot_server(get_values, port, host=''):
+    """ Serve the last values from a daemon thread, at
+        http://host:port/values?uuids=<uuid>,...&devices=<device id>,...&max_age=<seconds>
+        or in reply to a POST to /values of {"uuids": [...], "devices": [...], "max_age": ...}
+        for long lists. `get_values(uuids, device_ids, max_age)` returns the body of the reply.
+    """
+    class SnapshotHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != '/values':
+                self.send_error(404)
+                return
+            query = parse_qs(url.query)
+            try:
+                self.reply(parse_list(query.get('uuids', [])),
+                           [int(dev_id) for dev_id in parse_list(query.get('devices', []))],
+                           float(query['max_age'][0]) if 'max_age' in query else None)
+            except ValueError as e:
+                self.send_error(400, str(e))
+
+        def do_POST(self):
+            if urlparse(self.path).path != '/values':
+                self.send_error(404)
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length))
+                max_age = body.get('max_age')
+                self.reply([str(uuid) for uuid in body.get('uuids', [])],
+                           [int(dev_id) for dev_id in body.get('devices', [])],
+                           None if max_age is None else float(max_age))
+            except (ValueError, TypeError, AttributeError) as e:
+                self.send_error(400, str(e))
+
+        def reply(self, uuids, device_ids, max_age):
+            payload = json.dumps(get_values(uuids, device_ids, max_age), default=str)
+            payload = payload.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), SnapshotHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='snapshot', daemon=True).start()
+    return server
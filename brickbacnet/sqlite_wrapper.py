@@ -9,27 +9,57 @@
 # main DEVICE_TABLE: device_id, description, jci_name, name, addr, max_apdu, vendor_id
 #      contains high level devices and their data
 #
-# <device_id>_OBJ_TABLE: uuid, instance, object_type, desc, jci_name, sensor_type, units
-#      contains objects within device and their data
+# OBJECT_TABLE: version, device_ref, instance, object_type, uuid, description, jci_name, name, unit,
+#               poll_interval
+#      contains the objects of all devices, keyed by (device_ref, instance, object_type, version)
+#      and indexed by uuid. Databases with the older per-device `table_<device_id>_<version>`
+#      tables are migrated into it when they are opened.
+#
+# REVISION_TABLE: revision
+#      counts the changes to the objects and devices, kept by triggers on their tables.
 
 
+import os
+import re
 import json
 import csv
+import time
+import threading
 from pdb import set_trace as bp
 from contextlib import contextmanager
 
 import sqlite3
 
+from .common import make_obj_id, make_src_id
+
 
 @contextmanager
-def cursor_to_commit(db):
+def cursor_to_commit(conn):
+    """ A cursor whose statements are committed together, or rolled back on an exception. """
+    c = conn.cursor()
     try:
-        conn = sqlite3.connect(db)
-        c = conn.cursor()
         yield c
-        conn.commit
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
     finally:
-        pass
+        c.close()
+
+LEGACY_OBJECT_TABLE_PATTERN = re.compile(r'^table_(\d+)_(\w+)$')
+OBJECT_COLUMNS = ['uuid', 'device_ref', 'instance', 'object_type',
+                  'description', 'jci_name', 'name', 'unit']
+# The writes that change the objects to poll. The revision of a device's objects is left out,
+# and so is the quarantine of an object, which only the connector polling its device has to see.
+REVISED_TABLE_EVENTS = [
+    ("object_table", "INSERT"),
+    ("object_table", "UPDATE OF " + ", ".join(OBJECT_COLUMNS) + ", version, poll_interval"),
+    ("object_table", "DELETE"),
+    ("device_table", "INSERT"),
+    ("device_table", "DELETE"),
+    ("device_table", "UPDATE OF description, jci_name, name, ip_addr, max_apdu, uuid, vendor_id"),
+]
+
 
 class SqliteWrapper():
     """ The main wrapper through which data can be read/written.
@@ -39,82 +69,173 @@ class SqliteWrapper():
         """ provide the db from which data needs to be read from """
 
         self.db = db_name
-        conn = sqlite3.connect(self.db)
-
-        if not self.does_table_exist("device_table"):
-            c = conn.cursor()
-            c.execute("CREATE TABLE device_table ( version varchar(255)," +
-                                               "device_id int, " +
-                                               "description varchar(255), " +
-                                               "jci_name varchar(255), " +
-                                               "name varchar(255), " +
-                                               "ip_addr varchar(12), " +
-                                               "max_apdu int, "+
-                                               "uuid str, "+
-                                               "vendor_id int);"
-                                               )
-            conn.commit()
-
-        if not self.does_table_exist('uuid_table'):
-            c = conn.cursor()
-            c.execute("CREATE TABLE uuid_table (uuid, nae_id int, instance int)")
-            conn.commit()
+        self.local = threading.local()
+        self.tables = set()
+
+        with cursor_to_commit(self.conn) as c:
+            if not self.does_table_exist("device_table"):
+                c.execute("CREATE TABLE device_table ( version varchar(255)," +
+                                                   "device_id int, " +
+                                                   "description varchar(255), " +
+                                                   "jci_name varchar(255), " +
+                                                   "name varchar(255), " +
+                                                   "ip_addr varchar(12), " +
+                                                   "max_apdu int, "+
+                                                   "uuid str, "+
+                                                   "vendor_id int);"
+                                                   )
+                self.tables.add("device_table")
+
+            c.execute("CREATE INDEX IF NOT EXISTS device_table_device_id " +
+                      "ON device_table (device_id)")
+            self.add_missing_columns(c, "device_table", {"database_revision": "int",
+                                                         "obj_count": "int",
+                                                         })
+
+            if not self.does_table_exist("object_table"):
+                c.execute("CREATE TABLE object_table ( version varchar(255) NOT NULL, " +
+                                                    "device_ref int NOT NULL, " +
+                                                    "instance int NOT NULL, " +
+                                                    "object_type varchar(255) NOT NULL, " +
+                                                    "uuid varchar(36), " +
+                                                    "description varchar(255), " +
+                                                    "jci_name varchar(255), " +
+                                                    "name varchar(255), " +
+                                                    "unit varchar(255), " +
+                                                    "PRIMARY KEY (device_ref, instance, object_type, version)" +
+                                                    ") WITHOUT ROWID;")
+                c.execute("CREATE INDEX object_table_uuid ON object_table (uuid)")
+                self.tables.add("object_table")
+
+            self.migrate_legacy_tables(c)
+            # `quarantined` is why an object stopped being polled, or NULL while it is polled.
+            self.add_missing_columns(c, "object_table", {"poll_interval": "real",
+                                                         "quarantined": "varchar(255)",
+                                                         })
+
+            # Kept apart from device_table, whose rows are replaced whenever a device is discovered.
+            c.execute("CREATE TABLE IF NOT EXISTS pacing_table ( device_id int PRIMARY KEY, " +
+                                                               "inflight_limit real, " +
+                                                               "gap real, " +
+                                                               "updated real)")
+
+            # Bumped by every change to the objects and devices, including the ones made outside
+            # of this wrapper, but not by the pacing, which every connector writes. The poll
+            # plans are checked against it.
+            c.execute("CREATE TABLE IF NOT EXISTS revision_table ( id int PRIMARY KEY, " +
+                                                                "revision int)")
+            c.execute("INSERT OR IGNORE INTO revision_table (id, revision) VALUES (0, 0)")
+            for table_name, event in REVISED_TABLE_EVENTS:
+                trigger_name = f"{table_name}_{event.split()[0].lower()}_revision"
+                trigger_sql = (f"CREATE TRIGGER {trigger_name} AFTER {event} ON {table_name} " +
+                               "BEGIN UPDATE revision_table SET revision = revision + 1; END")
+                # Replace the triggers of older databases whose events were different.
+                existing = c.execute("SELECT sql FROM sqlite_master WHERE type='trigger' AND name=?",
+                                     (trigger_name,)).fetchone()
+                if existing and existing[0] != trigger_sql:
+                    c.execute(f"DROP TRIGGER {trigger_name}")
+                    existing = None
+                if not existing:
+                    c.execute(trigger_sql)
+
+    @property
+    def conn(self):
+        """ The connection of the current thread, opened once and reused.
+            A forked process opens its own connection instead of sharing its parent's.
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.db, timeout=30)
+            # WAL lets connectors keep reading while discovery writes, and only syncs at
+            # checkpoints instead of at every commit.
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def add_missing_columns(self, c, table_name, columns):
+        """ Add the columns introduced after a database was created. """
+        existing = set(row[1] for row in c.execute(f"PRAGMA table_info({table_name})"))
+        for column, column_type in columns.items():
+            if column not in existing:
+                c.execute(f"ALTER TABLE {table_name} ADD COLUMN {column} {column_type}")
+
+    def migrate_legacy_tables(self, c):
+        """ Move the objects of per-device `table_<device_id>_<version>` tables into
+            object_table and drop the old tables, including the unused uuid_table.
+        """
+        self.does_table_exist("object_table") # refresh the table list.
+        for table_name in list(self.tables):
+            match = LEGACY_OBJECT_TABLE_PATTERN.match(table_name)
+            if not match:
+                continue
+            version = match.group(2)
+            c.execute(("INSERT OR REPLACE INTO object_table (version, " + ", ".join(OBJECT_COLUMNS) + ") "
+                       + "SELECT ?, " + ", ".join(OBJECT_COLUMNS) + " FROM " + table_name
+                       + " WHERE instance IS NOT NULL AND object_type IS NOT NULL"),
+                      (version,))
+            c.execute("DROP TABLE " + table_name)
+            self.tables.discard(table_name)
+        if "uuid_table" in self.tables:
+            c.execute("DROP TABLE uuid_table")
+            self.tables.discard("uuid_table")
 
     def does_table_exist(self, name):
-        conn = sqlite3.connect(self.db)
-        c = conn.cursor()
-        for tbl in c.execute("SELECT name FROM sqlite_master"):
-            if tbl[0] == name:
-                return True
-
-        return False
+        if name in self.tables:
+            return True
+        # Another process may have created it since the tables were last listed.
+        self.tables = set(row[0] for row in
+                          self.conn.execute("SELECT name FROM sqlite_master WHERE type='table'"))
+        return name in self.tables
 
     def write_device_properties(self, device, version='v1'):
-        conn = sqlite3.connect(self.db)
-        c = conn.cursor()
-
-        c.execute(("DELETE FROM device_table WHERE device_id=?"), (device["device_id"],))
-        conn.commit()
-
-        c.execute(("INSERT INTO device_table (version, device_id, description, jci_name ,name ,ip_addr ,max_apdu, vendor_id) " +
-                    "VALUES (?, ?, ? ,?, ?, ?, ?, ?);"),
-                    (version,
-                     device["device_id"],
-                     device["description"],
-                     device["jci_name"],
-                     device["name"],
-                     device["addr"],
-                     device["max_apdu"],
-                     device["vendor_id"]
+        """ Write a device's properties. Its objects are kept; see `delete_objects_except`.
+            So is the revision its objects were last discovered at; see `write_device_revision`.
+        """
+        with cursor_to_commit(self.conn) as c:
+            stored = c.execute("SELECT database_revision, obj_count FROM device_table " +
+                               "WHERE device_id=? AND version=?",
+                               (device["device_id"], version)).fetchone() or (None, None)
+            c.execute(("DELETE FROM device_table WHERE device_id=?"), (device["device_id"],))
+
+            c.execute(("INSERT INTO device_table (version, device_id, description, jci_name ,name ,ip_addr ,max_apdu, vendor_id, " +
+                       "database_revision, obj_count) " +
+                        "VALUES (?, ?, ? ,?, ?, ?, ?, ?, ?, ?);"),
+                        (version,
+                         device["device_id"],
+                         device["description"],
+                         device["jci_name"],
+                         device["name"],
+                         device["addr"],
+                         device["max_apdu"],
+                         device["vendor_id"],
+                         stored[0],
+                         stored[1],
+                        )
                     )
-                )
-        conn.commit()
 
-        table_name = 'table_%s_%s'%(device["device_id"], version)
-        if self.does_table_exist((table_name)):
-            #flush the old data and read it afresh
-            c.execute("DROP TABLE "+ table_name);
-            conn.commit()
-
-        c.execute(("CREATE TABLE "+ table_name + " ( uuid varchar(36), " +
-                                                     "device_ref int, " +
-                                                     "instance int, " +
-                                                     "object_type int, " +
-                                                     "description varchar(255), " +
-                                                     "jci_name varchar(255), " +
-                                                     "name varchar(255), " +
-                                                     "unit varchar(255) " +
-                                                     ");"))
-        conn.commit()
+    def write_device_revision(self, device_id, database_revision, obj_count, version='v1'):
+        """ Record the databaseRevision and object count of a device whose objects were all
+            discovered and stored.
+        """
+        with cursor_to_commit(self.conn) as c:
+            c.execute("UPDATE device_table SET database_revision=?, obj_count=? " +
+                      "WHERE device_id=? AND version=?",
+                      (database_revision, obj_count, device_id, version))
+
+    def read_device_revision(self, device_id, version='v1'):
+        """ (database_revision, obj_count) stored for a device, or None for a new device. """
+        return self.conn.execute("SELECT database_revision, obj_count FROM device_table " +
+                                 "WHERE device_id=? AND version=?",
+                                 (device_id, version)).fetchone()
 
     def read_device_properties(self, device_id, version='v1'):
-        conn = sqlite3.connect(self.db)
-        c = conn.cursor()
-        table_name = 'table_%s_%s'%(str(device_id), version)
+        c = self.conn.cursor()
         res = c.execute("SELECT * FROM device_table WHERE device_id=?", (device_id,)).fetchone()
-        table_name = 'table_%s_%s'%(str(device_id), version)
         objects =[]
-        for obj in c.execute("SELECT instance FROM "+table_name):
+        for obj in c.execute("SELECT instance FROM object_table WHERE device_ref=? AND version=?",
+                             (device_id, version)):
             objects.append(obj[0])
 
 
@@ -129,29 +250,93 @@ class SqliteWrapper():
                 "objects"    : objects
                }
 
-    def get_device_ids(self, version='v1'):
-        with cursor_to_commit(self.db) as cursor:
-            res = cursor.execute(f"SELECT device_id FROM device_table where version = '{version}'").fetchall()
-        return [row[0] for row in res]
-
-
-    def read_obj_properties(self, uuid=None, device_id=None, instance=None, version='v1'):
-        if uuid is None and (instance is None or device_id is None):
-            raise Exception("Provide atleast one of uuid and instance")
+    def data_version(self):
+        """ A value that changes whenever the objects or devices in the database are modified,
+            by any connection. Writing the pacing does not change it.
+        """
+        return self.conn.execute("SELECT revision FROM revision_table").fetchone()[0]
 
-        conn = sqlite3.connect(self.db)
-        c = conn.cursor()
+    def read_poll_rows(self, device_id, version='v1'):
+        """ (uuid, instance, object_type, name, poll_interval) of the objects in a device that are
+            not quarantined, in one query. poll_interval overrides the configured interval of an
+            object.
+        """
+        return self.conn.execute("SELECT uuid, instance, object_type, name, poll_interval " +
+                                 "FROM object_table " +
+                                 "WHERE device_ref=? AND version=? AND quarantined IS NULL",
+                                 (device_id, version)).fetchall()
+
+    def quarantine_object(self, device_id, object_type, instance, reason, version='v1'):
+        """ Stop polling an object until it is discovered again or released. This does not change
+            `data_version`, so the caller recompiles the poll plan of the device itself.
+        """
+        with cursor_to_commit(self.conn) as c:
+            c.execute("UPDATE object_table SET quarantined=? " +
+                      "WHERE device_ref=? AND object_type=? AND instance=? AND version=?",
+                      (reason, device_id, object_type, instance, version))
+
+    def read_quarantined(self, device_id=None, version='v1'):
+        """ (device_ref, object_type, instance, quarantined) of the quarantined objects. """
+        query = ("SELECT device_ref, object_type, instance, quarantined FROM object_table " +
+                 "WHERE quarantined IS NOT NULL AND version=?")
+        args = (version,)
+        if device_id is not None:
+            query += " AND device_ref=?"
+            args += (device_id,)
+        return self.conn.execute(query, args).fetchall()
+
+    def release_quarantine(self, device_id=None, version='v1'):
+        """ Poll the quarantined objects of a device, or of every device, again. """
+        query = "UPDATE object_table SET quarantined=NULL WHERE quarantined IS NOT NULL AND version=?"
+        args = (version,)
+        if device_id is not None:
+            query += " AND device_ref=?"
+            args += (device_id,)
+        with cursor_to_commit(self.conn) as c:
+            c.execute(query, args)
+            if c.rowcount:
+                # Released objects are polled by whichever connector has the device.
+                c.execute("UPDATE revision_table SET revision = revision + 1")
+
+    def read_pacing(self, device_id):
+        """ (inflight_limit, gap) last learned for a device, or None. """
+        return self.conn.execute("SELECT inflight_limit, gap FROM pacing_table " +
+                                 "WHERE device_id=?", (device_id,)).fetchone()
+
+    def write_pacing(self, device_id, inflight_limit, gap):
+        with cursor_to_commit(self.conn) as c:
+            c.execute("INSERT OR REPLACE INTO pacing_table (device_id, inflight_limit, gap, updated) " +
+                      "VALUES (?, ?, ?, ?)", (device_id, inflight_limit, gap, time.time()))
+
+    def get_device_addresses(self, version='v1'):
+        """ {device_id: address} of the devices stored in the database. """
+        res = self.conn.execute("SELECT device_id, ip_addr FROM device_table where version = ?",
+                                (version,)).fetchall()
+        return {row[0]: row[1] for row in res}
 
-        device_id = int(device_id)
-        instance = int(instance)
+    def get_device_ids(self, version='v1'):
+        res = self.conn.execute("SELECT device_id FROM device_table where version = ?",
+                                (version,)).fetchall()
+        return [row[0] for row in res]
 
-        if device_id is None: # get device_id from uuid
-            res =  c.execute("SELECT * from uuid_table WHERE uuid=\""+uuid+"\";").fetchone()
-            device_id = res[1]
-            instance = res[2]
 
-        table_name = 'table_%s_%s'%(str(device_id), version)
-        res = c.execute("SELECT * FROM " + table_name + " WHERE instance=?", (instance,)).fetchone()
+    def read_obj_properties(self, uuid=None, device_id=None, object_type=None, instance=None,
+                            version='v1'):
+        """ The properties of the object with `uuid`, or of the object identified by `device_id`,
+            `object_type` and `instance`.
+        """
+        if uuid is None and (device_id is None or object_type is None or instance is None):
+            raise Exception("Provide either uuid or device_id, object_type and instance")
+
+        if device_id is None: # find the object by its uuid
+            res = self.conn.execute("SELECT " + ", ".join(OBJECT_COLUMNS) + " FROM object_table " +
+                                    "WHERE uuid=? AND version=?", (uuid, version)).fetchone()
+        else:
+            res = self.conn.execute("SELECT " + ", ".join(OBJECT_COLUMNS) + " FROM object_table " +
+                                    "WHERE device_ref=? AND object_type=? AND instance=? " +
+                                    "AND version=?",
+                                    (int(device_id), str(object_type), int(instance), version)
+                                    ).fetchone()
 
         return {"uuid":        res[0],
                 "device_ref":   res[1],
@@ -159,37 +344,65 @@ class SqliteWrapper():
                 "object_type": res[3],
                 "description": res[4],
                 "jci_name":    res[5],
-                "name":    res[5],
+                "name":    res[6],
                 "unit":        res[7] }
 
     def write_obj_properties(self, props, version='v1'):
-        table_name = 'table_%s_%s'%(str(props["device_ref"]), version)
+        self.write_objects([props], version)
 
-        if not self.does_table_exist(table_name):
-            raise Exception("Table %s does not exist" %table_name)
-
-        conn = sqlite3.connect(self.db)
-        c = conn.cursor()
-
-        # remove old entry and add a new one.
-        c.execute(("DELETE FROM "+ table_name + " WHERE device_ref=? AND instance=?;"),
-                    (int(props["device_ref"]), props["instance"]))
-        conn.commit()
-
-        c.execute(("INSERT INTO "+ table_name + "(uuid ,device_ref, instance, object_type, "
-                                              + "description, jci_name, name, unit) "
-                    + "VALUES (? ,? ,? ,? ,? ,? ,? ,?);" ),
-                    ( props["uuid"],
-                      props["device_ref"],
-                      props["instance"],
-                      props["object_type"],
-                      props["description"],
-                      props["jci_name"],
-                      props["name"],
-                      props["unit"]
-                    )
-                )
-        conn.commit()
+    def write_objects(self, objs, version='v1'):
+        """ Write the properties of many objects in one transaction.
+            An object written again keeps its uuid unless a new one is given, and is no longer
+            quarantined.
+        """
+        with cursor_to_commit(self.conn) as c:
+            c.executemany(("INSERT INTO object_table (version, uuid ,device_ref, instance, "
+                                                       + "object_type, description, jci_name, name, unit) "
+                            + "VALUES (?, ? ,? ,? ,? ,? ,? ,? ,?) "
+                            + "ON CONFLICT (device_ref, instance, object_type, version) DO UPDATE SET "
+                            + "uuid = COALESCE(excluded.uuid, uuid), description = excluded.description, "
+                            + "jci_name = excluded.jci_name, name = excluded.name, unit = excluded.unit, "
+                            + "quarantined = NULL;"),
+                          [( version,
+                             props["uuid"],
+                             int(props["device_ref"]),
+                             props["instance"],
+                             props["object_type"],
+                             props["description"],
+                             props["jci_name"],
+                             props["name"],
+                             props["unit"]
+                           ) for props in objs]
+                        )
+
+    def read_objects(self, device_id, version='v1'):
+        """ All the objects of a device, in the same format discovery produces them. """
+        rows = self.conn.execute("SELECT " + ", ".join(OBJECT_COLUMNS) + " FROM object_table " +
+                                 "WHERE device_ref=? AND version=?", (device_id, version))
+        objs = []
+        for row in rows:
+            obj = dict(zip(OBJECT_COLUMNS, row))
+            obj["object_identifier"] = make_obj_id(obj["object_type"], obj["instance"])
+            obj["source_identifier"] = make_src_id(device_id, obj["object_identifier"])
+            objs.append(obj)
+        return objs
+
+    def delete_objects_except(self, device_id, obj_keys, version='v1'):
+        """ Delete the objects of a device that are not in `obj_keys`, a list of
+            (object_type, instance). returns the number of deleted objects.
+        """
+        keep = set((str(obj_type), int(instance)) for obj_type, instance in obj_keys)
+        stored = self.conn.execute("SELECT object_type, instance FROM object_table " +
+                                   "WHERE device_ref=? AND version=?",
+                                   (device_id, version)).fetchall()
+        removed = [row for row in stored if (row[0], row[1]) not in keep]
+        if removed:
+            with cursor_to_commit(self.conn) as c:
+                c.executemany("DELETE FROM object_table WHERE device_ref=? AND object_type=? " +
+                              "AND instance=? AND version=?",
+                              [(device_id, obj_type, instance, version)
+                               for obj_type, instance in removed])
+        return len(removed)
 
     def update_dev_property(self, dev_id, prop, val, version='v1'):
         table_name = 'device_table'
@@ -197,64 +410,63 @@ class SqliteWrapper():
         if not self.does_table_exist(table_name):
             raise Exception("Table %s does not exist" %table_name)
 
-        conn = sqlite3.connect(self.db)
-        c = conn.cursor()
-
-        qstr = f"UPDATE {table_name} \n" + f"SET {prop} = {val}\n" + f"WHERE device_id= {dev_id}"
-
-        c.execute(f"UPDATE {table_name} \n" +
-                  f'SET {prop} = "{val}"\n' +
-                  f"WHERE device_id= {dev_id}"
-                  )
-        conn.commit()
-
-
+        with cursor_to_commit(self.conn) as c:
+            c.execute(f"UPDATE {table_name} SET {prop} = ? WHERE device_id = ?",
+                      (str(val), int(dev_id)))
 
-    def update_obj_property(self, dev_id, obj_instance, prop, val, version='v1'):
-        table_name = 'table_%s_%s'%(str(dev_id), version)
+    def update_obj_property(self, dev_id, obj_type, obj_instance, prop, val, version='v1'):
+        self.update_obj_properties(dev_id, prop, {(obj_type, obj_instance): val}, version)
 
-        if not self.does_table_exist(table_name):
-            raise Exception("Table %s does not exist" %table_name)
+    def update_obj_properties(self, dev_id, prop, values, version='v1'):
+        """ Set `prop` of many objects in a device in one transaction.
+            `values` maps (object_type, instance) pairs to their new values.
+        """
+        rows = [(str(val), int(dev_id), str(obj_type), int(obj_instance), version)
+                for (obj_type, obj_instance), val in values.items()]
 
-        conn = sqlite3.connect(self.db)
-        c = conn.cursor()
-
-        c.execute(f"UPDATE {table_name}\n" +
-                  f"SET {prop} = '{val}'\n" +
-                  f"WHERE instance = {obj_instance}"
-                  )
-        conn.commit()
+        with cursor_to_commit(self.conn) as c:
+            c.executemany(f"UPDATE object_table SET {prop} = ? " +
+                          "WHERE device_ref = ? AND object_type = ? AND instance = ? " +
+                          "AND version = ?",
+                          rows)
 
 
     def find_dev_uuid(self, dev_id):
-        qstr = f"""
+        qstr = """
         select uuid
         from device_table
         where
-        device_id = {dev_id}
+        device_id = ?
         """
-        with cursor_to_commit(self.db) as cursor:
-            res = cursor.execute(qstr)
-        row = res.fetchone()
+        row = self.conn.execute(qstr, (int(dev_id),)).fetchone()
         return row[0]
 
-    def find_obj_uuid(self, dev_ref: int, obj_instance: int, version: str='v1'):
-        table_name = 'table_{0}_{1}'.format(dev_ref, version)
-        qstr = f"""
+    def find_obj_uuid(self, dev_ref: int, obj_type: str, obj_instance: int, version: str='v1'):
+        qstr = """
         select uuid
-        from {table_name}
+        from object_table
         where
-        instance = {obj_instance}
+        device_ref = ? and object_type = ? and instance = ? and version = ?
         """
-        with cursor_to_commit(self.db) as cursor:
-            res = cursor.execute(qstr)
-        row = res.fetchone()
-        #TODO: Warn if there are more than one entry found.
-        return row[0]
+        row = self.conn.execute(qstr, (int(dev_ref), str(obj_type), int(obj_instance), version)
+                                ).fetchone()
+        return row[0] if row else None
+
+    def find_obj_uuids(self, dev_ref: int, version: str='v1'):
+        """ {(object_type, instance): uuid} of the objects of a device that have a uuid. """
+        rows = self.conn.execute("SELECT object_type, instance, uuid FROM object_table " +
+                                 "WHERE device_ref=? AND version=? AND uuid IS NOT NULL",
+                                 (int(dev_ref), version))
+        return {(obj_type, instance): uuid for obj_type, instance, uuid in rows}
+
+    def find_obj_by_uuid(self, uuid, version='v1'):
+        """ (device_ref, object_type, instance) of the object with `uuid`, or None. """
+        return self.conn.execute("SELECT device_ref, object_type, instance FROM object_table " +
+                                 "WHERE uuid=? AND version=?", (uuid, version)).fetchone()
 
     def export_devices(self, filename, version='v1'):
         table_name = 'device_table'
-        with cursor_to_commit(self.db) as cursor:
+        with cursor_to_commit(self.conn) as cursor:
             col_qstr = f"""
 PRAGMA table_info({table_name});
             """
@@ -262,26 +474,19 @@ PRAGMA table_info({table_name});
 
             columns = [row[1] for row in res if row[1] != 'version']
             export_qstr = """
-select {cols} from {table_name} where version = "{version}"
-            """.format(cols=', '.join(columns), table_name=table_name, version=version)
-            data_rows = cursor.execute(export_qstr).fetchall()
+select {cols} from {table_name} where version = ?
+            """.format(cols=', '.join(columns), table_name=table_name)
+            data_rows = cursor.execute(export_qstr, (version,)).fetchall()
         with open(filename, 'w') as f:
             writer = csv.writer(f)
             writer.writerow(columns)
             writer.writerows(data_rows)
 
     def export_objects(self, device_id, filename, version='v1'):
-        table_name = 'table_%s_%s'%(device_id, version)
-        with cursor_to_commit(self.db) as cursor:
-            col_qstr = f"""
-PRAGMA table_info({table_name});
-            """
-            res = cursor.execute(col_qstr).fetchall()
-
-            columns = [row[1] for row in res]
-            export_qstr = """select {cols} from {table_name}
-            """.format(cols=', '.join(columns), table_name=table_name)
-            data_rows = cursor.execute(export_qstr).fetchall()
+        columns = OBJECT_COLUMNS
+        export_qstr = """select {cols} from object_table where device_ref = ? and version = ?
+        """.format(cols=', '.join(columns))
+        data_rows = self.conn.execute(export_qstr, (int(device_id), version)).fetchall()
         with open(filename, 'w') as f:
             writer = csv.writer(f)
             writer.writerow(columns)
@@ -0,0 +1,454 @@
+""" Polling from several processes, so that decoding BACnet responses uses every CPU core.
+    A Supervisor splits the devices into shards of about the same load and runs a Connector for
+    each shard in a worker process. Workers report their liveness and statistics to the
+    supervisor, which restarts the ones that exit or stop reporting, with exponential backoff,
+    and moves devices between shards once the measured load is out of balance.
+"""
+
+import os
+import sys
+import time
+import queue
+import signal
+import asyncio
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from .connector import Connector, create_logger, CYCLE_SECONDS, POINTS_READ
+from .sqlite_wrapper import SqliteWrapper
+from .metrics import METRICS, start_metrics_server
+from .actuation_server import start_actuation_server
+from .snapshot import start_snapshot_server
+
+
+WORKER_UP = METRICS.gauge('b2b_worker_up', 'Whether a worker process is running', ['shard'])
+WORKER_RESTARTS = METRICS.counter(
+    'b2b_worker_restarts_total', 'Worker processes restarted after exiting or hanging', ['shard'])
+WORKER_DEVICES = METRICS.gauge('b2b_worker_devices', 'Devices polled by a worker', ['shard'])
+WORKER_CPU_UTILIZATION = METRICS.gauge(
+    'b2b_worker_cpu_utilization', 'CPU time of a worker per second', ['shard'])
+WORKER_POINTS_PER_SECOND = METRICS.gauge(
+    'b2b_worker_points_per_second', 'Points read by a worker per second', ['shard'])
+REBALANCES = METRICS.counter('b2b_rebalances_total', 'Devices moved between workers')
+
+# Ports of the connector that each worker offsets by its shard number.
+SHARDED_PORTS = ('metrics_port',)
+# Ports of the connector that the supervisor serves, forwarding each request to the worker that
+# polls its device. Worker k listens at the port plus 1 + k.
+ROUTED_PORTS = ('actuation_port', 'snapshot_port')
+# Seconds to wait for a worker to answer a forwarded request.
+FORWARD_TIMEOUT = 60
+# Files of the connector that each worker but the first one suffixes with its shard number.
+SHARDED_FILES = ('metrics_file',)
+# A worker that ran this long before failing starts its backoff over.
+STABLE_SECONDS = 60
+
+
+def assign_shards(weights, num_shards):
+    """ Split the devices in `weights` (device_id -> load) into `num_shards` lists of about the
+        same total load, placing the heaviest devices first.
+    """
+    shards = [[] for _ in range(num_shards)]
+    loads = [0] * num_shards
+    for dev_id in sorted(weights, key=lambda dev_id: (-weights[dev_id], dev_id)):
+        shard = loads.index(min(loads))
+        shards[shard].append(dev_id)
+        loads[shard] += weights[dev_id]
+    return shards
+
+
+def match_shards(old_shards, new_shards):
+    """ Reorder `new_shards` so that each keeps as many devices of the same old shard as it can,
+        which leaves more workers running through a rebalance.
+    """
+    matched = [None] * len(old_shards)
+    unmatched = list(new_shards)
+    for i in sorted(range(len(old_shards)), key=lambda i: -len(old_shards[i])):
+        old = set(old_shards[i])
+        best = max(unmatched, key=lambda shard: len(old.intersection(shard)))
+        matched[i] = best
+        unmatched.remove(best)
+    return matched
+
+
+def suffix_path(path, shard):
+    root, ext = os.path.splitext(path)
+    return f'{root}_{shard}{ext}'
+
+
+def get_worker_params(connector_params, shard, bacnet_port):
+    """ The Connector parameters of a shard: its own BACnet port and its own ports and files.
+        The first shard keeps the configured metrics port and files, and the routed ports are
+        left to the supervisor.
+    """
+    params = dict(connector_params)
+    params['overriding_bacnet_port'] = bacnet_port + shard
+    for key in SHARDED_PORTS:
+        if params.get(key):
+            params[key] += shard
+    for key in ROUTED_PORTS:
+        if params.get(key):
+            params[key] += 1 + shard
+    if shard:
+        for key in SHARDED_FILES:
+            if params.get(key):
+                params[key] = suffix_path(params[key], shard)
+        if params.get('outbox'):
+            params['outbox'] = dict(params['outbox'],
+                                    path=suffix_path(params['outbox']['path'], shard))
+    return params
+
+
+def get_worker_report(connector, shard):
+    """ The liveness and cumulative statistics of a worker's devices. """
+    devices = {}
+    for dev_id in connector.bacnet_device_ids:
+        plan = connector.poll_plans.get(dev_id)
+        devices[dev_id] = {
+            'points': len(plan.points) if plan else 0,
+            'points_read': POINTS_READ.values.get((dev_id,), 0),
+        }
+    return {
+        'shard': shard,
+        'pid': os.getpid(),
+        'time': time.time(),
+        'cpu_seconds': time.process_time(),
+        'devices': devices,
+        'uploader': connector.uploader.stats(),
+    }
+
+
+def run_worker(shard, device_ids, connector_params, reports, report_interval):
+    """ Poll a shard of devices and put a report in `reports` every `report_interval` seconds,
+        until the supervisor is gone.
+    """
+    parent_pid = os.getppid()
+    # A forked worker exports its own metrics, not the ones the supervisor had.
+    for metric in METRICS.metrics.values():
+        metric.values.clear()
+    connector = Connector(bacnet_device_ids=device_ids, **connector_params)
+
+    async def report_forever():
+        while True:
+            if os.getppid() != parent_pid:
+                os._exit(0) # The BACnet stack does not stop by itself.
+            reports.put(get_worker_report(connector, shard))
+            await asyncio.sleep(report_interval)
+
+    async def run():
+        await asyncio.gather(connector.read_all_devices_forever_async(), report_forever())
+
+    asyncio.run(run())
+
+
+class Worker(object):
+    __slots__ = ('shard', 'device_ids', 'process', 'started_time', 'report_time', 'report',
+                 'rates', 'failures', 'restart_time')
+
+    def __init__(self, shard, device_ids):
+        self.shard = shard
+        self.device_ids = device_ids
+        self.process = None
+        self.started_time = None
+        self.report_time = None # when the last report arrived.
+        self.report = None
+        self.rates = None # device_id -> points read per second, between the last two reports.
+        self.failures = 0 # exits and hangs in a row.
+        self.restart_time = 0 # when to start the process while it is not running.
+
+
+class Supervisor(object):
+    """ Runs `num_workers` worker processes (one per CPU core by default), each polling its shard
+        of `device_ids` with a Connector made of `connector_params`. Worker k talks BACnet from
+        `bacnet_port` + k and offsets the other ports of `connector_params` by k. The actuation
+        and snapshot ports are served by the supervisor, which forwards each request to the
+        worker polling its device, so that writes go ahead of that worker's reads.
+        A worker that exits, or does not report for `heartbeat_timeout` seconds, is started again
+        after `restart_backoff` seconds, doubling after each failure up to `max_restart_backoff`.
+        Every `rebalance_interval` seconds, the devices are reassigned by their measured points
+        read per second if the busiest worker's load exceeds the mean by `rebalance_threshold`.
+    """
+
+    def __init__(self,
+                 connector_params,
+                 device_ids,
+                 bacnet_port,
+                 num_workers=None,
+                 report_interval=10,
+                 heartbeat_timeout=120,
+                 restart_backoff=1,
+                 max_restart_backoff=300,
+                 rebalance_interval=3600,
+                 rebalance_threshold=1.25,
+                 metrics_port=None,
+                 ):
+        logdir = connector_params.get('logdir', 'logs')
+        if not os.path.isdir(logdir):
+            os.makedirs(logdir)
+        self.logger = create_logger(logdir + '/supervisor.log')
+        self.connector_params = connector_params
+        self.bacnet_port = bacnet_port
+        self.report_interval = report_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.restart_backoff = restart_backoff
+        self.max_restart_backoff = max_restart_backoff
+        self.rebalance_interval = rebalance_interval
+        self.rebalance_threshold = rebalance_threshold
+        num_workers = min(num_workers or os.cpu_count() or 1, len(device_ids)) or 1
+        # Until they are measured, devices are weighed by their points per polling interval.
+        self.default_interval = max(1, connector_params.get('min_interval') or 1)
+        self.sqlite_db = SqliteWrapper(connector_params['sqlite_db'])
+        self.points = {dev_id: len(self.sqlite_db.read_poll_rows(dev_id))
+                       for dev_id in device_ids}
+        self.workers = []
+        shards = assign_shards(self.get_weights(), num_workers)
+        self.workers = [Worker(shard, device_ids) for shard, device_ids in enumerate(shards)]
+        self.balanced_time = time.time()
+        # Workers are forked so that they inherit the data service client and the parameters.
+        self.context = multiprocessing.get_context('fork')
+        self.reports = self.context.Queue()
+        if metrics_port:
+            start_metrics_server(metrics_port)
+        self.actuation_port = connector_params.get('actuation_port')
+        self.snapshot_port = connector_params.get('snapshot_port')
+        # Requests to several workers are forwarded at once, and several requests at a time.
+        self.forward_executor = ThreadPoolExecutor(4 * len(self.workers))
+        if self.actuation_port:
+            start_actuation_server(self, self.actuation_port)
+        if self.snapshot_port:
+            start_snapshot_server(self.get_last_values, self.snapshot_port)
+
+    def get_weights(self):
+        """ device_id -> points read per second, measured or estimated. """
+        weights = {dev_id: points / self.default_interval
+                   for dev_id, points in self.points.items()}
+        for worker in self.workers:
+            if worker.rates:
+                weights.update(worker.rates)
+        return weights
+
+    def run_forever(self):
+        # A terminated supervisor stops its workers on the way out.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        self.logger.info('Polling {0} devices from {1} workers'
+                         .format(len(self.points), len(self.workers)))
+        try:
+            while True:
+                self.receive_reports(timeout=1)
+                now = time.time()
+                for worker in self.workers:
+                    self.check_worker(worker, now)
+                if now - self.balanced_time >= self.rebalance_interval:
+                    self.rebalance(now)
+        finally:
+            for worker in self.workers:
+                self.stop_worker(worker)
+
+    def start_worker(self, worker):
+        params = get_worker_params(self.connector_params, worker.shard, self.bacnet_port)
+        worker.process = self.context.Process(
+            target=run_worker, name=f'b2b-worker-{worker.shard}',
+            args=(worker.shard, worker.device_ids, params, self.reports, self.report_interval),
+            daemon=True)
+        worker.process.start()
+        worker.started_time = time.time()
+        worker.report_time = None
+        worker.report = None
+        worker.rates = None
+        WORKER_UP.set(worker.shard, value=1)
+        WORKER_DEVICES.set(worker.shard, value=len(worker.device_ids))
+        self.logger.info('Started worker {0} (pid {1}) for {2} devices'
+                         .format(worker.shard, worker.process.pid, len(worker.device_ids)))
+
+    def stop_worker(self, worker):
+        if worker.process is None:
+            return
+        if worker.process.is_alive():
+            worker.process.terminate()
+            worker.process.join(5)
+            if worker.process.is_alive():
+                worker.process.kill()
+        worker.process.join()
+        worker.process = None
+        WORKER_UP.set(worker.shard, value=0)
+
+    def check_worker(self, worker, now):
+        """ Start a worker that is due, and restart one that exited or stopped reporting. """
+        if worker.process is None:
+            if now >= worker.restart_time:
+                self.start_worker(worker)
+            return
+        if worker.process.is_alive():
+            last_seen = worker.report_time or worker.started_time
+            if now - last_seen <= self.heartbeat_timeout:
+                return
+            problem = 'did not report for {0:.0f} seconds'.format(now - last_seen)
+        else:
+            problem = 'exited with code {0}'.format(worker.process.exitcode)
+        if now - worker.started_time >= STABLE_SECONDS + self.heartbeat_timeout:
+            worker.failures = 0
+        delay = min(self.max_restart_backoff, self.restart_backoff * 2 ** worker.failures)
+        self.logger.error('Worker {0} {1}. Restarting it in {2} seconds'
+                          .format(worker.shard, problem, delay))
+        self.stop_worker(worker)
+        worker.failures += 1
+        worker.restart_time = time.time() + delay
+        WORKER_RESTARTS.inc(worker.shard)
+
+    def receive_reports(self, timeout):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                report = self.reports.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                return
+            worker = self.workers[report['shard']]
+            # Reports of a process that was replaced are late.
+            if worker.process is not None and worker.process.pid == report['pid']:
+                self.on_report(worker, report)
+
+    def on_report(self, worker, report):
+        last = worker.report
+        worker.report = report
+        worker.report_time = time.time()
+        if worker.failures and worker.report_time - worker.started_time >= STABLE_SECONDS:
+            worker.failures = 0
+        if last is None:
+            return
+        elapsed = report['time'] - last['time']
+        if elapsed <= 0:
+            return
+        rates = {}
+        for dev_id, stats in report['devices'].items():
+            points_read = stats['points_read'] - last['devices'][dev_id]['points_read']
+            rates[dev_id] = points_read / elapsed
+            if points_read:
+                # The time to read every point of the device once at the current rate.
+                CYCLE_SECONDS.set(dev_id, value=elapsed * stats['points'] / points_read)
+            self.points[dev_id] = stats['points']
+        worker.rates = rates
+        WORKER_CPU_UTILIZATION.set(worker.shard,
+                                   value=(report['cpu_seconds'] - last['cpu_seconds']) / elapsed)
+        WORKER_POINTS_PER_SECOND.set(worker.shard, value=sum(rates.values()))
+
+    def rebalance(self, now):
+        """ Reassign the devices if the load of the workers is out of balance, and restart the
+            workers whose devices changed.
+        """
+        self.balanced_time = now
+        if len(self.workers) < 2 or any(worker.rates is None for worker in self.workers):
+            return
+        weights = self.get_weights()
+        loads = [sum(weights[dev_id] for dev_id in worker.device_ids) for worker in self.workers]
+        mean_load = sum(loads) / len(loads)
+        if not mean_load or max(loads) <= mean_load * self.rebalance_threshold:
+            return
+        shards = match_shards([worker.device_ids for worker in self.workers],
+                              assign_shards(weights, len(self.workers)))
+        new_loads = [sum(weights[dev_id] for dev_id in shard) for shard in shards]
+        if max(new_loads) >= max(loads):
+            return
+        moved = 0
+        for worker, device_ids in zip(self.workers, shards):
+            if set(device_ids) == set(worker.device_ids):
+                continue
+            moved += len(set(device_ids) - set(worker.device_ids))
+            self.stop_worker(worker)
+            worker.device_ids = device_ids
+            worker.failures = 0
+            worker.restart_time = now
+        REBALANCES.inc(amount=moved)
+        self.logger.info('Moved {0} devices between workers. The busiest worker reads {1:.0f} '
+                         'points per second instead of {2:.0f}'
+                         .format(moved, max(new_loads), max(loads)))
+
+    def find_worker(self, dev_id):
+        """ The worker that polls a device, or None. """
+        for worker in self.workers:
+            if dev_id in worker.device_ids:
+                return worker
+        return None
+
+    def forward(self, worker, port, path, body):
+        """ POST `body` to `path` of a worker's server of the routed `port`. """
+        resp = requests.post('http://127.0.0.1:{0}{1}'.format(port + 1 + worker.shard, path),
+                             json=body, timeout=FORWARD_TIMEOUT)
+        resp.raise_for_status()
+        return resp.json()
+
+    def write(self, targets):
+        """ Forward each write in `targets` (see `Actuator.submit`) to the worker that polls its
+            device, the writes of a worker in one request. returns their results in order.
+        """
+        received_time = time.time()
+        results = [None] * len(targets)
+        def fail(i, error):
+            results[i] = {'status': 'error', 'latency': time.time() - received_time,
+                          'error': str(error)}
+        worker_writes = {} # worker -> indices of its writes in `targets`
+        for i, target in enumerate(targets):
+            try:
+                if 'uuid' in target:
+                    obj = self.sqlite_db.find_obj_by_uuid(target['uuid'])
+                    if obj is None:
+                        raise KeyError('unknown uuid {0}'.format(target['uuid']))
+                    dev_id = obj[0]
+                else:
+                    dev_id = int(target['device_id'])
+                worker = self.find_worker(dev_id)
+                if worker is None:
+                    raise KeyError('Device {0} is not polled by any worker'.format(dev_id))
+            except (KeyError, TypeError, ValueError) as e:
+                fail(i, e)
+                continue
+            worker_writes.setdefault(worker, []).append(i)
+
+        def forward_writes(worker, indices):
+            try:
+                body = self.forward(worker, self.actuation_port, '/write',
+                                    {'writes': [targets[i] for i in indices]})
+            except Exception as e:
+                for i in indices:
+                    fail(i, 'Worker {0} did not answer: {1}'.format(worker.shard, e))
+                return
+            for i, result in zip(indices, body['results']):
+                results[i] = result
+        list(self.forward_executor.map(lambda item: forward_writes(*item), worker_writes.items()))
+        return results
+
+    def get_last_values(self, uuids=None, device_ids=None, max_age=None):
+        """ The last values of the points with `uuids` and in `device_ids` (see
+            `Connector.get_last_values`), gathered from the workers that poll them.
+        """
+        unknown = []
+        worker_requests = {} # worker -> {'uuids': [...], 'devices': [...]}
+        def add(dev_id, key, item):
+            worker = self.find_worker(dev_id)
+            if worker is None:
+                return False
+            request = worker_requests.setdefault(worker, {'uuids': [], 'devices': []})
+            request[key].append(item)
+            return True
+        for uuid in uuids or []:
+            obj = self.sqlite_db.find_obj_by_uuid(uuid)
+            if obj is None or not add(obj[0], 'uuids', uuid):
+                unknown.append(uuid)
+        for dev_id in device_ids or []:
+            add(dev_id, 'devices', dev_id)
+
+        def forward_request(worker, request):
+            try:
+                return self.forward(worker, self.snapshot_port, '/values',
+                                    dict(request, max_age=max_age))
+            except Exception as e:
+                self.logger.error('Worker {0} did not answer a snapshot request because "{1}"'
+                                  .format(worker.shard, e))
+                return {'values': [], 'unknown': request['uuids']}
+        values = []
+        for body in self.forward_executor.map(lambda item: forward_request(*item),
+                                              worker_requests.items()):
+            values += body['values']
+            unknown += body['unknown']
+        return {'values': values, 'unknown': unknown}
@@ -0,0 +1,172 @@
+""" Background uploads of datapoints.
+    Readers put datapoints in a bounded buffer and return immediately. A worker thread uploads
+    them to the data service in batches of up to `flush_rows` rows, or whatever is buffered once
+    the oldest row has waited `flush_interval` seconds, so a slow data service does not slow reads.
+    Datapoints leave the buffer only once they are uploaded; failed uploads are retried.
+"""
+
+import time
+import threading
+from collections import deque
+
+from .ds_iface import PartialUpload
+from .metrics import METRICS
+
+
+UPLOAD_SECONDS = METRICS.histogram('b2b_upload_seconds', 'Time to upload a batch of rows')
+UPLOADED_ROWS = METRICS.counter('b2b_uploaded_rows_total', 'Rows uploaded')
+UPLOAD_FAILURES = METRICS.counter('b2b_upload_failures_total', 'Failed uploads of a batch')
+DROPPED_ROWS = METRICS.counter('b2b_dropped_rows_total', 'Rows dropped from a full buffer')
+QUEUED_ROWS = METRICS.gauge('b2b_upload_queue_rows', 'Rows waiting to be uploaded')
+OLDEST_QUEUED_AGE = METRICS.gauge('b2b_upload_queue_oldest_seconds',
+                                  'How long the oldest row has waited to be uploaded')
+
+
+class MemoryBuffer(object):
+    """ A buffer of up to `max_rows` datapoints in memory, which drops the oldest ones when full.
+        It has the interface of Outbox.
+    """
+
+    def __init__(self, max_rows=100000):
+        self.max_rows = max_rows
+        self.rows = deque() # (key, queued time, datapoint)
+        self.next_key = 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def append(self, datapoints, now):
+        for datapoint in datapoints:
+            self.rows.append((self.next_key, now, datapoint))
+            self.next_key += 1
+        num_evicted = max(0, len(self.rows) - self.max_rows)
+        for _ in range(num_evicted):
+            self.rows.popleft()
+        return num_evicted
+
+    def oldest_time(self):
+        return self.rows[0][1] if self.rows else None
+
+    def peek(self, num_rows):
+        rows = [self.rows[i] for i in range(min(num_rows, len(self.rows)))]
+        return (rows[-1][0] if rows else None), [row[2] for row in rows]
+
+    def ack(self, key):
+        while self.rows and self.rows[0][0] <= key:
+            self.rows.popleft()
+
+
+class Uploader(object):
+    """ `buffer` is a MemoryBuffer or an Outbox. After an outage, the backlog is uploaded at up to
+        `replay_rate` rows per second. `stats()` shows how far behind the data service is.
+    """
+
+    def __init__(self, ds_if, buffer, flush_rows=1000, flush_interval=5, logger=None,
+                 replay_rate=None, max_retry_interval=60):
+        self.ds_if = ds_if
+        self.buffer = buffer
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.logger = logger
+        self.replay_rate = replay_rate
+        self.max_retry_interval = max_retry_interval
+        self.cond = threading.Condition()
+        self.uploaded_rows = 0
+        self.failed_uploads = 0
+        self.dropped_rows = 0
+        self.max_queued_rows = 0 # high-water mark of the buffer.
+        self.last_upload_time = None # seconds the last upload took.
+        METRICS.add_collector(self.collect_metrics)
+        self.thread = threading.Thread(target=self.run, name='uploader', daemon=True)
+        self.thread.start()
+
+    def put(self, datapoints):
+        if not datapoints:
+            return
+        with self.cond:
+            num_dropped = self.buffer.append(datapoints, time.time())
+            self.dropped_rows += num_dropped
+            if num_dropped:
+                DROPPED_ROWS.inc(amount=num_dropped)
+            self.max_queued_rows = max(self.max_queued_rows, len(self.buffer))
+            self.cond.notify()
+        if num_dropped > 0 and self.logger:
+            self.logger.warning('Upload buffer is full. Dropped the oldest {0} rows ({1} so far)'
+                                .format(num_dropped, self.dropped_rows))
+
+    def stats(self):
+        with self.cond:
+            queued_rows = len(self.buffer)
+            oldest_time = self.buffer.oldest_time()
+        return {
+            'queued_rows': queued_rows,
+            'max_queued_rows': self.max_queued_rows,
+            'oldest_queued_age': time.time() - oldest_time if oldest_time else 0,
+            'uploaded_rows': self.uploaded_rows,
+            'failed_uploads': self.failed_uploads,
+            'dropped_rows': self.dropped_rows,
+            'last_upload_time': self.last_upload_time,
+        }
+
+    def collect_metrics(self):
+        stats = self.stats()
+        QUEUED_ROWS.set(value=stats['queued_rows'])
+        OLDEST_QUEUED_AGE.set(value=stats['oldest_queued_age'])
+
+    def peek_batch(self):
+        """ Wait until a batch is due and return it, still in the buffer. """
+        with self.cond:
+            while True:
+                if len(self.buffer) >= self.flush_rows:
+                    break
+                oldest_time = self.buffer.oldest_time()
+                if oldest_time is not None:
+                    wait_time = oldest_time + self.flush_interval - time.time()
+                    if wait_time <= 0:
+                        break
+                else:
+                    wait_time = None
+                self.cond.wait(wait_time)
+            return self.buffer.peek(self.flush_rows)
+
+    def run(self):
+        retry_interval = 1
+        retry = None # (key, datapoints) of a batch that was partly uploaded, and what is left.
+        while True:
+            key, batch = retry or self.peek_batch()
+            t0 = time.time()
+            try:
+                self.ds_if.put_timeseries_data(batch)
+            except Exception as e:
+                if isinstance(e, PartialUpload):
+                    # Only the rest of the batch is uploaded again, and it stays in the buffer
+                    # until then.
+                    num_uploaded = len(batch) - len(e.datapoints)
+                    UPLOADED_ROWS.inc(amount=num_uploaded)
+                    with self.cond:
+                        self.uploaded_rows += num_uploaded
+                    retry = key, e.datapoints
+                self.failed_uploads += 1
+                UPLOAD_FAILURES.inc()
+                if self.logger:
+                    self.logger.error('Uploading {0} rows failed because "{1}". Retrying in {2} seconds'
+                                      .format(len(batch), e, retry_interval))
+                time.sleep(retry_interval)
+                retry_interval = min(retry_interval * 2, self.max_retry_interval)
+                continue
+            retry_interval = 1
+            retry = None
+            self.last_upload_time = time.time() - t0
+            UPLOAD_SECONDS.observe(value=self.last_upload_time)
+            UPLOADED_ROWS.inc(amount=len(batch))
+            with self.cond:
+                self.buffer.ack(key)
+                self.uploaded_rows += len(batch)
+                backlog = len(self.buffer)
+            if backlog >= self.flush_rows:
+                # Another full batch waiting means that the data service is falling behind,
+                # or that a backlog is being replayed.
+                if self.logger:
+                    self.logger.info('Upload backlog: {0}'.format(self.stats()))
+                if self.replay_rate:
+                    time.sleep(max(0, len(batch) / self.replay_rate - (time.time() - t0)))
@@ -0,0 +1,102 @@
+""" Simulated devices, and BACnet clients that talk to them over loopback.
+    bacpypes keeps one stack per process, so each client runs in a forked process of its own,
+    and each test module listens at ports of its own.
+"""
+
+import os
+import traceback
+import multiprocessing
+
+import pytest
+
+from brickbacnet.benchmark import CLIENT_INI_TEMPLATE
+from brickbacnet.simulator import run_farm
+from brickbacnet.sqlite_wrapper import SqliteWrapper
+
+
+FIRST_DEVICE_ID = 1000
+OBJECT_TYPES = ('analogInput', 'analogValue', 'binaryValue')
+
+
+def farm_object_type(instance):
+    """ The type of an object of the simulated devices, which cycle through OBJECT_TYPES. """
+    return OBJECT_TYPES[instance % len(OBJECT_TYPES)]
+
+
+def farm_uuid(dev_id, instance):
+    return f'{dev_id}-{instance}'
+
+
+@pytest.fixture
+def start_farm():
+    """ Start `num_devices` simulated devices from `base_port`, with `farm_params` of
+        DeviceFarm, for the duration of a test. returns {device_id: address}.
+    """
+    farms = []
+
+    def start(base_port, num_devices=1, num_objects=12, **farm_params):
+        ready = multiprocessing.Event()
+        farm = multiprocessing.Process(target=run_farm, daemon=True, kwargs=dict(
+            farm_params, num_devices=num_devices, num_objects=num_objects,
+            base_port=base_port, first_device_id=FIRST_DEVICE_ID, ready=ready))
+        farm.start()
+        farms.append(farm)
+        assert ready.wait(60)
+        return {FIRST_DEVICE_ID + i: f'127.0.0.1:{base_port + i}' for i in range(num_devices)}
+
+    yield start
+    for farm in farms:
+        farm.kill()
+        farm.join()
+
+
+def write_client_ini(directory, port):
+    bacpypes_ini = os.path.join(str(directory), f'client_{port}.ini')
+    with open(bacpypes_ini, 'w') as fp:
+        fp.write(CLIENT_INI_TEMPLATE.format(port=port))
+    return bacpypes_ini
+
+
+def store_farm(sqlite_db, addrs, num_objects=12, max_apdu=1476):
+    """ Store the devices at `addrs` and their objects as discovery and registration would,
+        with the uuids of `farm_uuid`.
+    """
+    db = SqliteWrapper(sqlite_db)
+    for dev_id, addr in addrs.items():
+        db.write_device_properties({'device_id': dev_id, 'description': '', 'jci_name': '',
+                                    'name': f'simulated_{dev_id}', 'addr': addr,
+                                    'max_apdu': max_apdu, 'vendor_id': 15})
+        db.write_objects([{'uuid': farm_uuid(dev_id, instance), 'device_ref': dev_id,
+                           'instance': instance, 'object_type': farm_object_type(instance),
+                           'description': '', 'jci_name': '',
+                           'name': f'{farm_object_type(instance)}_{instance}', 'unit': ''}
+                          for instance in range(num_objects)])
+    return db
+
+
+def run_in_client(fn, *args, timeout=60):
+    """ `fn(*args)` in a forked process, where it may start a BACnet stack. returns what it
+        returns, which must be picklable, and fails the test with its traceback if it raises.
+    """
+    results = multiprocessing.Queue()
+
+    def run():
+        try:
+            results.put((True, fn(*args)))
+        except BaseException:
+            results.put((False, traceback.format_exc()))
+        results.close()
+        results.join_thread()
+        os._exit(0) # The BACnet stack does not stop by itself.
+
+    process = multiprocessing.get_context('fork').Process(target=run)
+    process.start()
+    try:
+        ok, result = results.get(timeout=timeout)
+    finally:
+        process.join(10)
+        if process.is_alive():
+            process.kill()
+    if not ok:
+        pytest.fail(result, pytrace=False)
+    return result
@@ -0,0 +1,134 @@
+""" Writes to a device go out one batch at a time, ahead of its reads. Writes queued meanwhile
+    replace the queued writes to the same points, and go out together in one
+    WritePropertyMultiple request, or one by one to devices that do not support it.
+"""
+
+import logging
+from concurrent.futures import Future
+
+from brickbacnet.actuation_server import Actuator
+from brickbacnet.bacnet_wrapper import BacnetWrapper, RequestRefused, WpmNotSupported
+from brickbacnet.sqlite_wrapper import SqliteWrapper
+
+from conftest import farm_uuid, run_in_client, store_farm, write_client_ini
+
+
+ADDR = '127.0.0.1:47809'
+FARM_PORT = 48070
+CLIENT_PORT = 47761
+
+
+class FakeBacnet(object):
+    """ Records the requests sent, as (kind, writes, Future), for the test to answer. """
+
+    def __init__(self):
+        self.requests = []
+
+    def encode_value(self, *args):
+        pass
+
+    def write_async(self, dev_addr, **write):
+        future = Future()
+        self.requests.append(('single', [write], future))
+        return future
+
+    def write_multiple_async(self, dev_addr, writes):
+        future = Future()
+        self.requests.append(('multiple', writes, future))
+        return future
+
+    def sent(self):
+        return [(kind, [(write['obj_instance'], write['value']) for write in writes])
+                for kind, writes, _ in self.requests]
+
+
+class FakeDb(object):
+    def get_device_addresses(self):
+        return {1000: ADDR}
+
+
+def make_actuator():
+    bacnet = FakeBacnet()
+    return Actuator(bacnet, FakeDb(), logging.getLogger('test_actuation')), bacnet
+
+
+def write_to(instance, value, priority=8):
+    return {'device_id': 1000, 'object_type': 'analogValue', 'instance': instance,
+            'value': value, 'priority': priority}
+
+
+def test_writes_queued_behind_a_batch_are_coalesced():
+    actuator, bacnet = make_actuator()
+    first = actuator.submit(write_to(1, 10.0))
+    queued = [actuator.submit(write_to(1, 11.0)), actuator.submit(write_to(4, 20.0)),
+              actuator.submit(write_to(1, 12.0)), actuator.submit(write_to(1, 0.0, priority=9))]
+
+    assert queued[0].result()['status'] == 'superseded'
+    assert bacnet.sent() == [('single', [(1, 10.0)])]
+    bacnet.requests[0][2].set_result(None)
+
+    assert first.result()['status'] == 'ok'
+    # The replacing write keeps the place of the one it replaced.
+    assert bacnet.sent()[1] == ('multiple', [(1, 12.0), (4, 20.0), (1, 0.0)])
+    bacnet.requests[1][2].set_result([True, True, True])
+    assert [future.result()['status'] for future in queued[1:]] == ['ok'] * 3
+
+
+def test_writes_after_a_failed_one_are_sent_again():
+    actuator, bacnet = make_actuator()
+    actuator.submit(write_to(1, 10.0))
+    queued = [actuator.submit(write_to(instance, 1.0)) for instance in (4, 7, 10)]
+    bacnet.requests[0][2].set_result(None)
+
+    bacnet.requests[1][2].set_result([True, RequestRefused('writeAccessDenied'), None])
+
+    assert [future.result()['status'] for future in queued[:2]] == ['ok', 'error']
+    assert bacnet.sent()[2] == ('single', [(10, 1.0)])
+    bacnet.requests[2][2].set_result(None)
+    assert queued[2].result()['status'] == 'ok'
+
+
+def test_devices_without_write_multiple_get_single_writes():
+    actuator, bacnet = make_actuator()
+    actuator.submit(write_to(1, 10.0))
+    queued = [actuator.submit(write_to(instance, 1.0)) for instance in (4, 7)]
+    bacnet.requests[0][2].set_result(None)
+
+    bacnet.requests[1][2].set_exception(WpmNotSupported('unrecognizedService'))
+
+    assert bacnet.sent()[2:] == [('single', [(4, 1.0)]), ('single', [(7, 1.0)])]
+    for _, _, future in bacnet.requests[2:]:
+        future.set_result(None)
+    assert [future.result()['status'] for future in queued] == ['ok', 'ok']
+    actuator.submit(write_to(1, 11.0))
+    actuator.submit(write_to(4, 2.0))
+    actuator.submit(write_to(7, 2.0))
+    bacnet.requests[4][2].set_result(None)
+    assert [kind for kind, _ in bacnet.sent()[5:]] == ['single', 'single']
+
+
+def write_and_read_back(bacpypes_ini, sqlite_db, targets):
+    bacnet = BacnetWrapper(bacpypes_ini)
+    db = SqliteWrapper(sqlite_db)
+    actuator = Actuator(bacnet, db, logging.getLogger('test_actuation'))
+    results = actuator.write(targets)
+    values = [bacnet.do_read(db.get_device_addresses()[1000], *db.find_obj_by_uuid(
+                  target['uuid'])[1:], 'presentValue') for target in targets]
+    return [result['status'] for result in results], values, bool(actuator.wpm_unsupported)
+
+
+def test_writes_reach_the_device(tmp_path, start_farm):
+    for i, wpm in enumerate((True, False)):
+        addrs = start_farm(FARM_PORT + i, wpm=wpm)
+        store_farm(str(tmp_path / f'b2b_{i}.db'), addrs)
+        targets = [{'uuid': farm_uuid(1000, 1), 'value': 42.5, 'priority': 8},
+                   {'uuid': farm_uuid(1000, 2), 'value': 'active', 'priority': 8},
+                   {'uuid': farm_uuid(1000, 4), 'value': 7.0, 'priority': 8}]
+
+        statuses, values, fell_back = run_in_client(write_and_read_back,
+                                         write_client_ini(tmp_path, CLIENT_PORT + i),
+                                         str(tmp_path / f'b2b_{i}.db'), targets)
+
+        assert statuses == ['ok'] * 3
+        assert values == [42.5, 'active', 7.0]
+        assert fell_back != wpm
@@ -0,0 +1,167 @@
+""" Devices and objects that keep failing are only probed, and objects whose errors do not go
+    away are quarantined without making every connector recompile its poll plans.
+"""
+
+import asyncio
+import collections
+import logging
+
+import pytest
+
+from brickbacnet.breaker import CircuitBreakers
+from brickbacnet.connector import Connector
+from brickbacnet.poll_plan import PollPoint
+from brickbacnet.snapshot import LastValues
+from brickbacnet.sqlite_wrapper import SqliteWrapper
+
+from conftest import run_in_client, store_farm, write_client_ini
+
+
+DEVICE_ID = 1000
+DEVICE = {'device_id': DEVICE_ID, 'addr': '127.0.0.1:47809'}
+FARM_PORT = 48060
+CLIENT_PORT = 47751
+
+
+def make_connector(sqlite_db, threshold=2):
+    """ A connector that only counts failures, without a BACnet stack. """
+    connector = object.__new__(Connector)
+    connector.logger = logging.getLogger('test_breakers')
+    connector.sqlite_db = sqlite_db
+    connector.skip_object_types = []
+    connector.poll_intervals = None
+    connector.poll_plans = {}
+    connector.last_values = LastValues()
+    connector.device_breakers = CircuitBreakers(threshold, 10, 40)
+    connector.object_breakers = CircuitBreakers(threshold, 10, 40)
+    return connector
+
+
+@pytest.fixture
+def sqlite_db(tmp_path):
+    db = SqliteWrapper(str(tmp_path / 'b2b.db'))
+    db.write_device_properties({'device_id': DEVICE_ID, 'description': '', 'jci_name': '',
+                                'name': '', 'addr': DEVICE['addr'], 'max_apdu': 1476,
+                                'vendor_id': 0})
+    db.write_objects([{'uuid': f'u{instance}', 'device_ref': DEVICE_ID, 'instance': instance,
+                       'object_type': 'analogInput', 'description': '', 'jci_name': '',
+                       'name': f'analogInput_{instance}', 'unit': ''}
+                      for instance in range(3)])
+    return db
+
+
+def test_quarantine_recompiles_only_the_plan_of_its_device(sqlite_db):
+    connector = make_connector(sqlite_db)
+    connector.get_poll_plan(DEVICE_ID)
+    data_version = sqlite_db.data_version()
+    points = [PollPoint(f'u{instance}', 'analogInput', instance) for instance in range(3)]
+    errors = {'u1': Exception('presentValue:object:unknownObject')}
+
+    connector.update_breakers(DEVICE, points, errors, 0)
+    connector.update_breakers(DEVICE, points, errors, 1)
+
+    assert sqlite_db.data_version() == data_version
+    assert [row[1] for row in sqlite_db.read_quarantined(DEVICE_ID)] == ['analogInput']
+    plan = connector.get_poll_plan(DEVICE_ID)
+    assert [point.uuid for point in plan.points] == ['u0', 'u2']
+
+
+def test_released_objects_are_polled_by_every_connector(sqlite_db):
+    sqlite_db.quarantine_object(DEVICE_ID, 'analogInput', 1, 'unknownObject')
+    connector = make_connector(sqlite_db)
+    connector.get_poll_plan(DEVICE_ID)
+
+    sqlite_db.release_quarantine(DEVICE_ID)
+
+    plan = connector.get_poll_plan(DEVICE_ID)
+    assert [point.uuid for point in plan.points] == ['u0', 'u1', 'u2']
+
+
+def test_breaker_opens_after_the_threshold_and_backs_off():
+    breakers = CircuitBreakers(threshold=3, base_interval=10, max_interval=40)
+
+    assert not breakers.on_failure('d', 0)
+    assert not breakers.on_failure('d', 1)
+    assert breakers.on_failure('d', 2)
+    assert breakers.is_open('d')
+    assert not breakers.allow('d', 11)
+    assert breakers.allow('d', 12)
+
+    # Failed probes double the interval, up to max_interval.
+    for now, interval in ((12, 20), (32, 40), (72, 40)):
+        assert not breakers.on_failure('d', now)
+        assert breakers.retry_interval('d') == interval
+        assert breakers.next_probe_time('d') == now + interval
+
+    assert breakers.on_success('d')
+    assert breakers.allow('d', 73)
+    assert breakers.num_open() == 0
+
+
+def test_an_unanswered_window_opens_the_breaker_of_its_device(sqlite_db):
+    connector = make_connector(sqlite_db)
+    points = [PollPoint(f'u{instance}', 'analogInput', instance) for instance in range(3)]
+    errors = {point.uuid: TimeoutError('READ ERROR: timed out') for point in points}
+
+    connector.update_breakers(DEVICE, points, errors, 0)
+    connector.update_breakers(DEVICE, points, errors, 1)
+
+    assert connector.device_breakers.is_open(DEVICE_ID)
+    # The objects are not blamed for their device.
+    assert connector.object_breakers.num_open() == 0
+    assert sqlite_db.read_quarantined(DEVICE_ID) == []
+
+
+def test_an_object_that_keeps_failing_is_only_probed(sqlite_db):
+    connector = make_connector(sqlite_db)
+    points = [PollPoint(f'u{instance}', 'analogInput', instance) for instance in range(3)]
+    errors = {'u1': Exception('READ ERROR: device busy')}
+
+    connector.update_breakers(DEVICE, points, errors, 0)
+    connector.update_breakers(DEVICE, points, errors, 1)
+
+    assert not connector.device_breakers.is_open(DEVICE_ID)
+    assert connector.object_breakers.is_open('u1')
+    assert sqlite_db.read_quarantined(DEVICE_ID) == []
+    connector.update_breakers(DEVICE, points, {}, 12)
+    assert not connector.object_breakers.is_open('u1')
+
+
+def poll_devices(bacpypes_ini, sqlite_db, logdir, device_ids, duration):
+    """ Poll devices for `duration` seconds. returns the points read per device and the
+        devices whose breakers are open.
+    """
+    connector = Connector(bacpypes_ini, None, device_ids, sqlite_db, logdir=logdir,
+                          min_interval=0.2, adaptive_pacing=False, read_retries=0,
+                          breaker_threshold=1, breaker_interval=60)
+    reads = collections.Counter()
+    read_window_async = connector.read_window_async
+
+    async def count_reads(dev, objs, *args, **kwargs):
+        reads[dev['device_id']] += len(objs)
+        return await read_window_async(dev, objs, *args, **kwargs)
+    connector.read_window_async = count_reads
+
+    async def poll():
+        try:
+            await asyncio.wait_for(connector.read_all_devices_forever_async(), duration)
+        except asyncio.TimeoutError:
+            pass
+    asyncio.run(poll())
+    return dict(reads), [dev_id for dev_id in device_ids
+                         if connector.device_breakers.is_open(dev_id)]
+
+
+def test_an_offline_device_does_not_stall_the_others(tmp_path, start_farm):
+    addrs = start_farm(FARM_PORT, num_objects=6)
+    addrs[1001] = f'127.0.0.1:{FARM_PORT + 1}' # nothing answers there.
+    store_farm(str(tmp_path / 'b2b.db'), addrs, 6)
+    bacpypes_ini = write_client_ini(tmp_path, CLIENT_PORT)
+
+    reads, open_breakers = run_in_client(poll_devices, bacpypes_ini, str(tmp_path / 'b2b.db'),
+                                         str(tmp_path / 'logs'), [1000, 1001], 5)
+
+    assert open_breakers == [1001]
+    # One window timed out, and the device is only probed from then on.
+    assert reads[1001] == 6
+    assert reads[1000] >= 6 * 10
@@ -0,0 +1,138 @@
+""" Requests to Brick Server go over pooled connections, with large bodies compressed. Only the
+    idempotent ones are retried, and only the data types that failed are posted again.
+"""
+
+import gzip
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from brickbacnet import brickserver
+from brickbacnet.brickserver import BrickServer
+from brickbacnet.ds_iface import PartialUpload
+
+
+class FakeBrickServer(object):
+    """ Records the requests it receives, and answers them with `respond(path, body)`: a status
+        code, (status code, JSON body), or None for 200.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.client_ports = set()
+        self.respond = lambda path, body: None
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' # keeps connections alive.
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                encoding = self.headers.get('Content-Encoding')
+                if encoding == 'gzip':
+                    body = gzip.decompress(body)
+                fake.requests.append((self.path, body, encoding))
+                fake.client_ports.add(self.client_address[1])
+                response = fake.respond(self.path, body) or 200
+                status, payload = response if isinstance(response, tuple) else (response, {})
+                payload = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def posts(self, path):
+        return [body for request_path, body, _ in self.requests
+                if request_path == '/brickapi/v1/' + path]
+
+    def timeseries_posts(self):
+        return [json.loads(body) for body in self.posts('data/timeseries')]
+
+
+@pytest.fixture
+def fake_server(monkeypatch):
+    monkeypatch.setattr(brickserver, 'RETRY_BASE_DELAY', 0.01)
+    server = FakeBrickServer()
+    yield server
+    server.server.shutdown()
+
+
+def make_datapoints(num_rows):
+    return [{'uuid': f'u{i}', 'object_type': 'analogInput', 'timestamp': float(i), 'value': i}
+            for i in range(num_rows)]
+
+
+BINDINGS = {'results': {'bindings': [
+    {'entity': {'value': 'e1'}, 'object_type': {'value': 'analogInput'},
+     'instance': {'value': '1'}}]}}
+
+
+def test_queries_are_retried_while_the_server_is_unavailable(fake_server):
+    brick_server = BrickServer(fake_server.url, 'token', '1.1')
+    statuses = [503, 502]
+    fake_server.respond = lambda path, body: statuses.pop(0) if statuses else (200, BINDINGS)
+
+    assert brick_server.query_device_points(1000) == {('analogInput', 1): ['e1']}
+    assert len(fake_server.posts('rawqueries/sparql')) == 3
+
+
+def test_queries_give_up_after_the_retries(fake_server):
+    brick_server = BrickServer(fake_server.url, 'token', '1.1', max_retries=2)
+    fake_server.respond = lambda path, body: 503
+
+    with pytest.raises(AssertionError):
+        brick_server.query_device_points(1000)
+    assert len(fake_server.posts('rawqueries/sparql')) == 3
+
+
+def test_requests_that_create_data_are_not_retried(fake_server):
+    brick_server = BrickServer(fake_server.url, 'token', '1.1')
+    fake_server.respond = lambda path, body: 503
+
+    with pytest.raises(AssertionError):
+        brick_server.create_entities('Point', 2)
+    with pytest.raises(PartialUpload):
+        brick_server.put_timeseries_data(make_datapoints(3))
+    assert len(fake_server.posts('entities')) == 1
+    assert len(fake_server.posts('data/timeseries')) == 1
+
+
+def test_large_bodies_are_compressed_over_one_connection(fake_server):
+    brick_server = BrickServer(fake_server.url, 'token', '1.1')
+
+    brick_server.put_timeseries_data(make_datapoints(1))
+    brick_server.put_timeseries_data(make_datapoints(200))
+
+    assert [encoding for _, _, encoding in fake_server.requests] == [None, 'gzip']
+    assert [len(post['data']) for post in fake_server.timeseries_posts()] == [1, 200]
+    assert len(fake_server.client_ports) == 1
+
+
+def test_a_failed_data_type_is_the_only_one_posted_again(fake_server):
+    brick_server = BrickServer(fake_server.url, 'token', '1.1')
+    brick_server.type_map['binaryValue'] = 'text'
+    failures = [500]
+    fake_server.respond = lambda path, body: \
+        failures.pop() if failures and b'"text"' in body else None
+    datapoints = [
+        {'uuid': 'u1', 'object_type': 'analogInput', 'timestamp': 1.0, 'value': 1.5},
+        {'uuid': 'u2', 'object_type': 'binaryValue', 'timestamp': 1.0, 'value': 'active'},
+    ]
+
+    with pytest.raises(PartialUpload) as excinfo:
+        brick_server.put_timeseries_data(datapoints)
+    brick_server.put_timeseries_data(excinfo.value.datapoints)
+
+    assert excinfo.value.datapoints == datapoints[1:]
+    posted = [row for post in fake_server.timeseries_posts() for row in post['data']]
+    assert sorted(row[0] for row in posted) == ['u1', 'u2', 'u2']
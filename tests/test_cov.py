@@ -0,0 +1,81 @@
+""" Objects that accept COV subscriptions push their changes and are no longer polled, while
+    the objects of devices that refuse them keep being polled.
+"""
+
+import time
+import asyncio
+import collections
+
+from brickbacnet.connector import Connector
+
+from conftest import farm_object_type, farm_uuid, run_in_client, store_farm, write_client_ini
+
+
+NUM_OBJECTS = 6
+FARM_PORT = 48030
+CLIENT_PORT = 47721
+
+
+class RecordingDs(object):
+    def __init__(self):
+        self.uuids = collections.Counter()
+
+    def put_timeseries_data(self, datapoints):
+        self.uuids.update(datapoint['uuid'] for datapoint in datapoints)
+
+
+def poll_with_cov(bacpypes_ini, sqlite_db, logdir, duration):
+    """ Poll a device with COV for `duration` seconds. returns how many times each point was
+        read and uploaded, and the points left to poll.
+    """
+    ds = RecordingDs()
+    connector = Connector(bacpypes_ini, ds, [1000], sqlite_db, logdir=logdir, min_interval=1,
+                          adaptive_pacing=False, use_cov=True, cov_flush_interval=0.2,
+                          upload_interval=0.2)
+    reads = collections.Counter()
+    read_window_async = connector.read_window_async
+
+    async def count_reads(dev, objs, *args, **kwargs):
+        reads.update(obj.uuid for obj in objs)
+        return await read_window_async(dev, objs, *args, **kwargs)
+    connector.read_window_async = count_reads
+
+    async def poll():
+        try:
+            await asyncio.wait_for(connector.read_all_devices_forever_async(), duration)
+        except asyncio.TimeoutError:
+            pass
+    asyncio.run(poll())
+    time.sleep(1) # for the uploader to take the last batch.
+    polled = [point.uuid for point in connector.get_points_to_poll(connector.get_poll_plan(1000))]
+    return dict(reads), dict(ds.uuids), polled
+
+
+def test_subscribed_objects_are_notified_instead_of_polled(tmp_path, start_farm):
+    addrs = start_farm(FARM_PORT, num_objects=NUM_OBJECTS, cov=True, drift_interval=0.5,
+                       drift_fraction=1.0)
+    store_farm(str(tmp_path / 'b2b.db'), addrs, NUM_OBJECTS)
+    bacpypes_ini = write_client_ini(tmp_path, CLIENT_PORT)
+
+    reads, uploads, polled = run_in_client(
+        poll_with_cov, bacpypes_ini, str(tmp_path / 'b2b.db'), str(tmp_path / 'logs'), 4)
+
+    assert polled == []
+    # Only the first cycle, which starts along with the subscriptions, may read them.
+    assert all(count <= 1 for count in reads.values())
+    for instance in range(NUM_OBJECTS):
+        if farm_object_type(instance) == 'binaryValue': # changes at every drift.
+            assert uploads[farm_uuid(1000, instance)] > 2
+
+
+def test_objects_of_devices_without_cov_are_polled(tmp_path, start_farm):
+    addrs = start_farm(FARM_PORT + 1, num_objects=NUM_OBJECTS, cov=False)
+    store_farm(str(tmp_path / 'b2b.db'), addrs, NUM_OBJECTS)
+    bacpypes_ini = write_client_ini(tmp_path, CLIENT_PORT + 1)
+
+    reads, uploads, polled = run_in_client(
+        poll_with_cov, bacpypes_ini, str(tmp_path / 'b2b.db'), str(tmp_path / 'logs'), 4)
+
+    uuids = [farm_uuid(1000, instance) for instance in range(NUM_OBJECTS)]
+    assert polled == uuids
+    assert all(reads[uuid] >= 3 and uploads[uuid] >= 3 for uuid in uuids)
@@ -0,0 +1,52 @@
+""" Only the values that leave the deadband around the value last published are uploaded,
+    besides a heartbeat for the values that do not change.
+"""
+
+from brickbacnet.deadband import Deadband
+
+
+def make_datapoint(value, timestamp, uuid='u1'):
+    return {'uuid': uuid, 'object_type': 'analogInput', 'timestamp': timestamp, 'value': value}
+
+
+def published_values(deadband, values):
+    """ The values out of `values`, read one a second, that are published. """
+    return [datapoint['value'] for timestamp, value in enumerate(values)
+            for datapoint in deadband.filter([make_datapoint(value, timestamp)])]
+
+
+def test_values_within_the_deadband_are_not_published():
+    deadband = Deadband(absolute=0.5)
+
+    # Compared with the value last published, so that slow drifts are published too.
+    assert published_values(deadband, [20.0, 20.3, 20.5, 20.6, 21.0, 21.2]) == [20.0, 20.6, 21.2]
+
+
+def test_the_deadband_is_the_larger_of_absolute_and_percent():
+    deadband = Deadband(absolute=0.5, percent=10)
+
+    assert published_values(deadband, [100.0, 109.0, 111.0, 2.0, 2.4, 2.6]) == [100.0, 111.0,
+                                                                               2.0, 2.6]
+
+
+def test_values_that_are_not_numbers_are_published_when_they_change():
+    deadband = Deadband(absolute=0.5)
+
+    assert published_values(deadband, ['inactive', 'inactive', 'active', True, True, False]) \
+        == ['inactive', 'active', True, False]
+
+
+def test_unchanged_values_are_published_at_the_heartbeat():
+    deadband = Deadband(absolute=0.5, heartbeat=3)
+
+    assert published_values(deadband, [20.0] * 8) == [20.0, 20.0, 20.0]
+
+
+def test_points_are_filtered_apart():
+    deadband = Deadband(absolute=0.5)
+    deadband.filter([make_datapoint(20.0, 0, 'u1'), make_datapoint(30.0, 0, 'u2')])
+
+    published = deadband.filter([make_datapoint(20.1, 1, 'u1'), make_datapoint(31.0, 1, 'u2'),
+                                 make_datapoint(5.0, 1, 'u3')])
+
+    assert [datapoint['uuid'] for datapoint in published] == ['u2', 'u3']
@@ -0,0 +1,146 @@
+""" Discovery of the objects of a device, and incremental re-discovery that reads only what
+    changed since the last discovery.
+"""
+
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pytest
+from bacpypes import core
+
+from brickbacnet.bacnet_wrapper import BacnetClient
+from brickbacnet.discovery import BacnetDiscovery
+from brickbacnet.sqlite_wrapper import SqliteWrapper
+
+
+DEVICE_ID = 1000
+DEVICE = {
+    'addr': '127.0.0.1:47809',
+    'device_id': DEVICE_ID,
+    'device_identifier': f'device:{DEVICE_ID}',
+    'max_apdu': '1476',
+    'obj_count': 4,
+    'database_revision': 7,
+}
+
+
+def make_discovery(sqlite_db, object_list):
+    """ A discovery that reads `object_list` from the device, without a BACnet stack. """
+    discovery = object.__new__(BacnetDiscovery)
+    discovery.logger = logging.getLogger('test_discovery')
+    discovery.sqlite_db = sqlite_db
+    discovery.incremental = True
+    discovery.unchanged_devices = set()
+    discovery.adaptive_pacing = False
+    discovery.read_object_list = lambda dev: list(object_list)
+    discovery.read_object_properties = lambda dev, objs: {
+        obj: {'object_type': obj[0], 'description': '', 'jci_name': '',
+              'name': f'{obj[0]}_{obj[1]}', 'unit': ''}
+        for obj in objs}
+    discovery.get_pacing = lambda addr: None
+    return discovery
+
+
+@pytest.fixture
+def sqlite_db(tmp_path):
+    db = SqliteWrapper(str(tmp_path / 'b2b.db'))
+    db.write_device_properties({'device_id': DEVICE_ID, 'description': '', 'jci_name': '',
+                                'name': '', 'addr': DEVICE['addr'], 'max_apdu': 1476,
+                                'vendor_id': 0})
+    return db
+
+
+def test_objects_are_kept_when_the_object_list_is_incomplete(sqlite_db):
+    listed = [('analogInput', 0), ('analogValue', 1), ('binaryValue', 2)]
+    make_discovery(sqlite_db, listed).discover_device_objects(DEVICE_ID, DEVICE)
+    sqlite_db.update_obj_properties(DEVICE_ID, 'uuid', {obj: f'u{obj[1]}' for obj in listed})
+
+    # The second and third entries of the objectList of the next revision time out.
+    partial = [('analogInput', 0), None, None]
+    objs = make_discovery(sqlite_db, partial).discover_device_objects(
+        DEVICE_ID, dict(DEVICE, database_revision=8))
+
+    assert sqlite_db.find_obj_uuids(DEVICE_ID) == {obj: f'u{obj[1]}' for obj in listed}
+    assert sorted(objs) == ['analogInput:0', 'analogValue:1', 'binaryValue:2']
+    assert sqlite_db.read_device_revision(DEVICE_ID) == (7, 4)
+
+
+def test_removed_objects_are_deleted_when_the_object_list_is_complete(sqlite_db):
+    listed = [('analogInput', 0), ('analogValue', 1), ('binaryValue', 2)]
+    make_discovery(sqlite_db, listed).discover_device_objects(DEVICE_ID, DEVICE)
+
+    objs = make_discovery(sqlite_db, listed[:2]).discover_device_objects(DEVICE_ID, DEVICE)
+
+    assert sorted(objs) == ['analogInput:0', 'analogValue:1']
+    assert set(sqlite_db.find_obj_uuids(DEVICE_ID)) == set()
+    assert len(sqlite_db.read_objects(DEVICE_ID)) == 2
+    assert sqlite_db.read_device_revision(DEVICE_ID) == (7, 4)
+
+
+
+def read_metadata(sqlite_db, database_revision, obj_count):
+    """ The devices after reading their metadata, with the device answering the given
+        databaseRevision and objectList length.
+    """
+    discovery = make_discovery(sqlite_db, [])
+    answers = {'objectName': 'ahu', 'description': '', 'objectList': obj_count,
+               'jci_name': '', 'databaseRevision': database_revision}
+
+    def read_object_async(addr, obj_id, prop_id, indx=None):
+        future = Future()
+        future.set_result(answers[prop_id])
+        return future
+    discovery.read_object_async = read_object_async
+    devices = {DEVICE_ID: dict(DEVICE, vendor_id=0)}
+    discovery.update_device_metadata(devices)
+    return discovery, devices
+
+
+def test_unchanged_devices_are_not_read_again(sqlite_db):
+    listed = [('analogInput', 0), ('analogValue', 1), ('binaryValue', 2)]
+    make_discovery(sqlite_db, listed).discover_device_objects(DEVICE_ID, DEVICE)
+
+    discovery, devices = read_metadata(sqlite_db, 7, 4)
+    discovery.read_object_list = None # fails if the device is read.
+    objs = discovery.discover_device_objects(DEVICE_ID, devices[DEVICE_ID])
+
+    assert discovery.unchanged_devices == {DEVICE_ID}
+    assert sorted(objs) == ['analogInput:0', 'analogValue:1', 'binaryValue:2']
+
+
+def test_only_the_objects_added_to_a_changed_device_are_read(sqlite_db):
+    listed = [('analogInput', 0), ('analogValue', 1), ('binaryValue', 2)]
+    make_discovery(sqlite_db, listed).discover_device_objects(DEVICE_ID, DEVICE)
+    sqlite_db.update_obj_properties(DEVICE_ID, 'uuid', {obj: f'u{obj[1]}' for obj in listed})
+
+    discovery, devices = read_metadata(sqlite_db, 8, 5)
+    added = listed + [('analogInput', 3)]
+    discovery.read_object_list = lambda dev: list(added)
+    read = []
+    read_object_properties = discovery.read_object_properties
+    discovery.read_object_properties = lambda dev, objs: \
+        read.extend(objs) or read_object_properties(dev, objs)
+    objs = discovery.discover_device_objects(DEVICE_ID, devices[DEVICE_ID])
+
+    assert discovery.unchanged_devices == set()
+    assert read == [('analogInput', 3)]
+    assert sorted(objs) == ['analogInput:0', 'analogInput:3', 'analogValue:1', 'binaryValue:2']
+    assert sqlite_db.find_obj_uuids(DEVICE_ID) == {obj: f'u{obj[1]}' for obj in listed}
+    assert sqlite_db.read_device_revision(DEVICE_ID) == (8, 5)
+
+def test_pacing_set_by_discovery_threads_is_applied_in_the_core_thread(monkeypatch):
+    monkeypatch.setattr(core, 'deferredFns', [])
+    client = object.__new__(BacnetClient)
+    client.max_inflight = 8
+    client.adaptive_pacing = True
+    client.windows = {}
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(lambda i: client.set_pacing(f'127.0.0.1:{47809 + i}', 4, 0.5),
+                          range(4)))
+    assert client.windows == {}
+
+    for fn, args, kwargs in core.deferredFns: # what the core thread runs next.
+        fn(*args, **kwargs)
+    assert client.get_pacing('127.0.0.1:47809') == (4, 0.5)
+    assert len(client.windows) == 4
@@ -0,0 +1,81 @@
+""" Objects of different types may share an instance number in a device, so they are told apart
+    by (object_type, instance) wherever their uuids are stored or looked up.
+"""
+
+import os
+import importlib.machinery
+import importlib.util
+
+import pytest
+from rdflib import Namespace
+
+from brickbacnet.dummy_ds import DummyDs
+from brickbacnet.ntriples import brick_triples
+from brickbacnet.sqlite_wrapper import SqliteWrapper
+
+
+DEVICE_ID = 1000
+
+
+def load_b2b():
+    path = os.path.join(os.path.dirname(__file__), '..', 'b2b')
+    loader = importlib.machinery.SourceFileLoader('b2b', path)
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader('b2b', loader))
+    loader.exec_module(module)
+    return module
+
+
+def make_obj(object_type, instance):
+    return {
+        'uuid': None,
+        'device_ref': DEVICE_ID,
+        'instance': instance,
+        'object_type': object_type,
+        'description': '',
+        'jci_name': '',
+        'name': f'{object_type} {instance}',
+        'unit': '',
+    }
+
+
+@pytest.fixture
+def sqlite_db(tmp_path):
+    db = SqliteWrapper(str(tmp_path / 'b2b.db'))
+    db.write_objects([make_obj('analogInput', 1), make_obj('binaryValue', 1)])
+    return db
+
+
+def test_uuids_are_kept_per_object_type(sqlite_db):
+    sqlite_db.update_obj_properties(DEVICE_ID, 'uuid', {('analogInput', 1): 'u-ai'})
+
+    assert sqlite_db.find_obj_uuids(DEVICE_ID) == {('analogInput', 1): 'u-ai'}
+    assert sqlite_db.find_obj_uuid(DEVICE_ID, 'analogInput', 1) == 'u-ai'
+    assert sqlite_db.find_obj_uuid(DEVICE_ID, 'binaryValue', 1) is None
+
+
+def test_obj_uris_are_distinct_per_object_type(sqlite_db):
+    b2b = load_b2b()
+    conn = object.__new__(b2b.BacnetConn)
+    conn.sqlite_db = sqlite_db
+    conn.ds_if = DummyDs()
+    sqlite_db.update_obj_properties(DEVICE_ID, 'uuid', {('analogInput', 1): 'u-ai'})
+
+    obj_keys = [('analogInput', 1), ('binaryValue', 1)]
+    uris = conn.get_obj_uris(DEVICE_ID, obj_keys, 'Point')
+
+    assert str(uris[('analogInput', 1)]) == 'u-ai'
+    assert str(uris[('binaryValue', 1)]) != 'u-ai'
+
+
+def test_brick_triples_keep_objects_apart():
+    devices = {DEVICE_ID: {'device_id': DEVICE_ID}}
+    device_objs = {DEVICE_ID: {'analogInput:1': make_obj('analogInput', 1),
+                               'binaryValue:1': make_obj('binaryValue', 1)}}
+    dev_uris = {DEVICE_ID: 'urn:dev'}
+    obj_uris = {DEVICE_ID: {('analogInput', 1): 'urn:ai', ('binaryValue', 1): 'urn:bv'}}
+    lines = list(brick_triples(Namespace('urn:brick#'), devices, device_objs, dev_uris, obj_uris,
+                               property_filters=[]))
+
+    assert any(line.startswith('<urn:ai> ') and '"analogInput"' in line for line in lines)
+    assert any(line.startswith('<urn:bv> ') and '"binaryValue"' in line for line in lines)
+    assert not any(line.startswith('<urn:ai> ') and '"binaryValue"' in line for line in lines)
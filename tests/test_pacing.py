@@ -0,0 +1,84 @@
+""" The requests in flight to a device grow additively while it answers quickly, and halve
+    when it times out or is busy (AIMD), down to one request at a time spaced apart.
+"""
+
+from brickbacnet import pacing
+from brickbacnet.bacnet_wrapper import BacnetWrapper
+from brickbacnet.pacing import Pacer
+
+from conftest import farm_object_type, run_in_client, write_client_ini
+
+
+FARM_PORT = 48040
+CLIENT_PORT = 47731
+
+
+def test_window_grows_by_about_one_per_window_of_quick_responses():
+    pacer = Pacer(max_limit=8)
+
+    pacer.on_response(0.01)
+    assert pacer.size == 2
+    for _ in range(2 + 3): # about a window of 2, then of 3 requests.
+        pacer.on_response(0.01)
+
+    assert 3.5 < pacer.limit < 4
+    for _ in range(100):
+        pacer.on_response(0.01)
+    assert pacer.size == 8
+
+
+def test_slow_responses_do_not_grow_the_window():
+    pacer = Pacer(max_limit=8, limit=2)
+    pacer.on_response(0.01)
+
+    for _ in range(10):
+        pacer.on_response(0.5)
+
+    assert pacer.size == 2
+
+
+def test_window_halves_once_per_round_of_congestion():
+    pacer = Pacer(max_limit=8, limit=8)
+    sent_time = pacer.last_backoff_time + 1
+
+    pacer.on_congestion(sent_time)
+    # The other requests sent before the backoff time out as well.
+    pacer.on_congestion(sent_time)
+    pacer.on_congestion(sent_time)
+
+    assert pacer.size == 4
+    pacer.on_congestion(pacer.last_backoff_time + 1)
+    assert pacer.size == 2
+
+
+def test_requests_are_spaced_apart_below_one_in_flight():
+    pacer = Pacer(max_limit=8, limit=1)
+
+    pacer.on_congestion(pacer.last_backoff_time + 1)
+    pacer.on_congestion(pacer.last_backoff_time + 1)
+
+    assert (pacer.size, pacer.gap) == (1, 2 * pacing.MIN_GAP)
+    # The gap shrinks by a tenth per quick response, and goes away below MIN_GAP.
+    for _ in range(8):
+        pacer.on_response(0.01)
+    assert (pacer.limit, pacer.gap) == (1, 0)
+    pacer.on_response(0.01)
+    assert pacer.limit > 1
+
+
+def read_paced(bacpypes_ini, addr, num_reads):
+    """ Read a device `num_reads` times, and return the values and the pacing learned. """
+    client = BacnetWrapper(bacpypes_ini, max_inflight=8, adaptive_pacing=True)
+    values = client.read_many([(addr, farm_object_type(i % 12), i % 12)
+                               for i in range(num_reads)])
+    return values, client.get_pacing(addr)
+
+
+def test_pacing_opens_up_to_a_device_that_keeps_up(tmp_path, start_farm):
+    addrs = start_farm(FARM_PORT, num_objects=12, latency=0.005)
+    bacpypes_ini = write_client_ini(tmp_path, CLIENT_PORT)
+
+    values, (limit, gap) = run_in_client(read_paced, bacpypes_ini, addrs[1000], 200)
+
+    assert not any(isinstance(value, Exception) for value in values)
+    assert (limit, gap) == (8, 0)
@@ -0,0 +1,77 @@
+""" A device's poll plan is compiled once and reused until the objects or devices in the
+    database change, whichever connection changes them.
+"""
+
+import logging
+
+import pytest
+
+from brickbacnet.connector import Connector
+from brickbacnet.snapshot import LastValues
+from brickbacnet.sqlite_wrapper import SqliteWrapper
+
+
+DEVICE_ID = 1000
+
+
+def make_object(instance, object_type='analogInput', uuid=None):
+    return {'uuid': uuid if uuid is not None else f'u{instance}', 'device_ref': DEVICE_ID,
+            'instance': instance, 'object_type': object_type, 'description': '',
+            'jci_name': '', 'name': f'{object_type}_{instance}', 'unit': ''}
+
+
+def make_connector(sqlite_db):
+    """ A connector that only compiles poll plans, without a BACnet stack. """
+    connector = object.__new__(Connector)
+    connector.logger = logging.getLogger('test_poll_plan')
+    connector.sqlite_db = sqlite_db
+    connector.skip_object_types = ['program']
+    connector.poll_intervals = None
+    connector.poll_plans = {}
+    connector.last_values = LastValues()
+    return connector
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    db_path = str(tmp_path / 'b2b.db')
+    db = SqliteWrapper(db_path)
+    db.write_device_properties({'device_id': DEVICE_ID, 'description': '', 'jci_name': '',
+                                'name': '', 'addr': '127.0.0.1:47809', 'max_apdu': 1476,
+                                'vendor_id': 0})
+    db.write_objects([make_object(0), make_object(1), make_object(2, 'program'),
+                      make_object(3, uuid='')])
+    return db_path
+
+
+def test_plan_has_the_points_to_poll(db_path):
+    plan = make_connector(SqliteWrapper(db_path)).get_poll_plan(DEVICE_ID)
+
+    assert plan.dev['addr'] == '127.0.0.1:47809'
+    assert [(point.uuid, point.instance) for point in plan.points] == [('u0', 0), ('u1', 1)]
+
+
+def test_plan_is_reused_until_the_objects_change(db_path):
+    connector = make_connector(SqliteWrapper(db_path))
+    plan = connector.get_poll_plan(DEVICE_ID)
+
+    assert connector.get_poll_plan(DEVICE_ID) is plan
+    SqliteWrapper(db_path).write_pacing(DEVICE_ID, 4, 0.1)
+    assert connector.get_poll_plan(DEVICE_ID) is plan
+
+    # Written by another process, e.g. a discovery.
+    SqliteWrapper(db_path).write_objects([make_object(4)])
+    recompiled = connector.get_poll_plan(DEVICE_ID)
+    assert recompiled is not plan
+    assert [point.uuid for point in recompiled.points] == ['u0', 'u1', 'u4']
+
+
+def test_plan_is_recompiled_when_the_device_changes(db_path):
+    connector = make_connector(SqliteWrapper(db_path))
+    plan = connector.get_poll_plan(DEVICE_ID)
+
+    SqliteWrapper(db_path).update_dev_property(DEVICE_ID, 'ip_addr', '127.0.0.1:47810')
+
+    recompiled = connector.get_poll_plan(DEVICE_ID)
+    assert recompiled is not plan
+    assert recompiled.dev['addr'] == '127.0.0.1:47810'
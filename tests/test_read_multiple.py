@@ -0,0 +1,130 @@
+""" Present values are read with ReadPropertyMultiple requests in batches that fit a device's
+    APDU, or one at a time from devices that reject them, and each object the device could not
+    read is reported as an error of its own rather than uploaded.
+"""
+
+import math
+import asyncio
+import logging
+from types import SimpleNamespace
+
+from bacpypes.apdu import ReadPropertyMultipleRequest, ReadPropertyMultipleACK, \
+    ReadAccessSpecification, ReadAccessResult, ReadAccessResultElement, \
+    ReadAccessResultElementChoice, PropertyReference
+from bacpypes.constructeddata import Any
+from bacpypes.primitivedata import Real
+
+from brickbacnet.bacnet_wrapper import BacnetClient, is_permanent_error
+from brickbacnet.common import rpm_batch_size
+from brickbacnet.connector import Connector
+from brickbacnet.poll_plan import PollPoint
+
+from conftest import farm_object_type, farm_uuid, run_in_client, store_farm, write_client_ini
+
+
+NUM_OBJECTS = 12
+SMALL_APDU = 206
+FARM_PORT = 48010
+CLIENT_PORT = 47701
+
+
+def make_request(obj_keys):
+    return ReadPropertyMultipleRequest(listOfReadAccessSpecs=[
+        ReadAccessSpecification(
+            objectIdentifier=obj_key,
+            listOfPropertyReferences=[PropertyReference(propertyIdentifier='presentValue')])
+        for obj_key in obj_keys])
+
+
+def make_ack(values):
+    return ReadPropertyMultipleACK(listOfReadAccessResults=[
+        ReadAccessResult(objectIdentifier=obj_key, listOfResults=[
+            ReadAccessResultElement(
+                propertyIdentifier='presentValue',
+                readResult=ReadAccessResultElementChoice(propertyValue=Any(Real(value))))])
+        for obj_key, value in values.items()])
+
+
+def decode(obj_keys, values):
+    iocb = SimpleNamespace(ioError=None, ioResponse=make_ack(values),
+                           args=(make_request(obj_keys),))
+    return object.__new__(BacnetClient)._decode_read_multiple(iocb)
+
+
+def test_objects_left_out_of_the_ack_are_errors():
+    results = decode([('analogInput', 1), ('analogInput', 2)], {('analogInput', 1): 1.5})
+
+    assert results[('analogInput', 1)] == {'presentValue': 1.5}
+    error = results[('analogInput', 2)]['presentValue']
+    assert isinstance(error, Exception)
+    assert is_permanent_error(error)
+
+
+def test_objects_left_out_of_the_ack_are_not_uploaded():
+    connector = object.__new__(Connector)
+    connector.logger = logging.getLogger('test_read_multiple')
+    points = [PollPoint('u1', 'analogInput', 1), PollPoint('u2', 'analogInput', 2)]
+    results = decode([('analogInput', 1), ('analogInput', 2)], {('analogInput', 1): 1.5})
+    errors = {}
+
+    datapoints = connector.collect_objects_multiple({'device_id': 1000}, [points], [results],
+                                                    errors=errors)
+
+    assert [(datapoint['uuid'], datapoint['value']) for datapoint in datapoints] == [('u1', 1.5)]
+    assert list(errors) == ['u2']
+
+
+def read_windows(bacpypes_ini, sqlite_db, logdir, dev_id, num_windows):
+    """ Read every point of a device `num_windows` times, counting the requests of each kind. """
+    connector = Connector(bacpypes_ini, None, [dev_id], sqlite_db, logdir=logdir,
+                          adaptive_pacing=False)
+    requests = {'multiple': 0, 'single': 0}
+    for kind, name in (('multiple', 'read_multiple_async'), ('single', 'read_async')):
+        def count(*args, _read=getattr(connector.bacnet, name), _kind=kind, **kwargs):
+            requests[_kind] += 1
+            return _read(*args, **kwargs)
+        setattr(connector.bacnet, name, count)
+    plan = connector.get_poll_plan(dev_id)
+    windows = []
+    for _ in range(num_windows):
+        errors = {}
+        datapoints = asyncio.run(connector.read_window_async(plan.dev, plan.points,
+                                                             errors=errors))
+        windows.append(({datapoint['uuid']: datapoint['value'] for datapoint in datapoints},
+                        dict(requests), list(errors)))
+    return windows
+
+
+def expected_values(dev_id, num_objects):
+    return {farm_uuid(dev_id, instance):
+            'inactive' if farm_object_type(instance) == 'binaryValue' else float(instance)
+            for instance in range(num_objects)}
+
+
+def test_present_values_are_read_in_batches_that_fit_the_apdu(tmp_path, start_farm):
+    addrs = start_farm(FARM_PORT, num_objects=NUM_OBJECTS)
+    store_farm(str(tmp_path / 'b2b.db'), addrs, NUM_OBJECTS, max_apdu=SMALL_APDU)
+    bacpypes_ini = write_client_ini(tmp_path, CLIENT_PORT)
+
+    [(values, requests, errors)] = run_in_client(
+        read_windows, bacpypes_ini, str(tmp_path / 'b2b.db'), str(tmp_path / 'logs'), 1000, 1)
+
+    assert values == expected_values(1000, NUM_OBJECTS)
+    assert errors == []
+    assert requests == {'multiple': math.ceil(NUM_OBJECTS / rpm_batch_size(SMALL_APDU)),
+                        'single': 0}
+
+
+def test_devices_without_read_multiple_fall_back_to_single_reads(tmp_path, start_farm):
+    addrs = start_farm(FARM_PORT + 1, num_objects=NUM_OBJECTS, rpm=False)
+    store_farm(str(tmp_path / 'b2b.db'), addrs, NUM_OBJECTS)
+    bacpypes_ini = write_client_ini(tmp_path, CLIENT_PORT + 1)
+
+    first, second = run_in_client(
+        read_windows, bacpypes_ini, str(tmp_path / 'b2b.db'), str(tmp_path / 'logs'), 1000, 2)
+
+    assert first[0] == second[0] == expected_values(1000, NUM_OBJECTS)
+    assert first[2] == second[2] == []
+    # The device is only asked for ReadPropertyMultiple once.
+    assert first[1] == {'multiple': 1, 'single': NUM_OBJECTS}
+    assert second[1] == {'multiple': 1, 'single': 2 * NUM_OBJECTS}
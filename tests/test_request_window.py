@@ -0,0 +1,45 @@
+""" Several confirmed requests are kept in flight to a device, up to the size of its window,
+    instead of one at a time.
+"""
+
+import time
+
+from brickbacnet.bacnet_wrapper import BacnetWrapper
+
+from conftest import farm_object_type, run_in_client, write_client_ini
+
+
+NUM_OBJECTS = 12
+LATENCY = 0.1
+FARM_PORT = 48020
+CLIENT_PORT = 47711
+
+
+def read_all(bacpypes_ini, addr, max_inflight):
+    """ Read every object of a device, recording the requests in flight as each is sent. """
+    client = BacnetWrapper(bacpypes_ini, max_inflight=max_inflight)
+    inflight = []
+    app_request = client._app_request
+
+    def record(apdu):
+        inflight.append(len(client.windows[apdu.pduDestination].inflight))
+        app_request(apdu)
+    client._app_request = record
+
+    t0 = time.time()
+    values = client.read_many([(addr, farm_object_type(instance), instance)
+                               for instance in range(NUM_OBJECTS)])
+    return values, max(inflight), time.time() - t0
+
+
+def test_reads_are_pipelined_up_to_the_window(tmp_path, start_farm):
+    addrs = start_farm(FARM_PORT, num_objects=NUM_OBJECTS, latency=LATENCY)
+    bacpypes_ini = write_client_ini(tmp_path, CLIENT_PORT)
+
+    values, max_inflight, elapsed = run_in_client(read_all, bacpypes_ini, addrs[1000], 3)
+
+    assert values == ['inactive' if farm_object_type(instance) == 'binaryValue'
+                      else float(instance) for instance in range(NUM_OBJECTS)]
+    assert max_inflight == 3
+    # Four round trips of three reads each, rather than twelve of one.
+    assert elapsed < NUM_OBJECTS * LATENCY / 2
@@ -0,0 +1,111 @@
+""" Reads time out after a timeout derived from the round-trip times of their device, are
+    retried when they are lost, and are hedged with a duplicate when they are slower than most.
+"""
+
+import time
+
+from brickbacnet import rtt
+from brickbacnet.bacnet_wrapper import BacnetWrapper
+from brickbacnet.rtt import RttEstimator
+
+from conftest import farm_object_type, run_in_client, write_client_ini
+
+
+NUM_OBJECTS = 12
+NUM_READS = 400
+LOSS = 0.02
+FARM_PORT = 48050
+CLIENT_PORT = 47741
+
+
+def test_timeout_follows_the_round_trip_times():
+    estimator = RttEstimator()
+    assert estimator.timeout == rtt.INITIAL_TIMEOUT
+
+    for _ in range(50):
+        estimator.on_response(0.5)
+    assert 0.5 < estimator.timeout < 0.6
+
+    for _ in range(50):
+        estimator.on_response(0.01)
+    assert estimator.timeout == rtt.MIN_TIMEOUT
+
+
+def test_timeout_backs_off_until_a_response():
+    estimator = RttEstimator()
+    for _ in range(50):
+        estimator.on_response(0.5)
+    timeout = estimator.timeout
+
+    estimator.on_timeout()
+    estimator.on_timeout()
+    assert estimator.timeout == 4 * timeout
+    for _ in range(10):
+        estimator.on_timeout()
+    assert estimator.timeout == rtt.MAX_TIMEOUT
+
+    estimator.on_response(0.5)
+    assert estimator.timeout < timeout * 1.1
+
+
+def test_percentiles_need_enough_samples():
+    estimator = RttEstimator()
+    for i in range(rtt.MIN_SAMPLES - 1):
+        estimator.on_response(i / 100)
+    assert estimator.percentile(0.95) is None
+
+    estimator.on_response(0.19)
+    assert estimator.percentile(0.95) == 0.19
+    assert estimator.percentile(0.5) == 0.1
+
+
+def read_lossy(bacpypes_ini, addr, num_reads, hedge):
+    """ Read a device that loses some requests. returns the values, and the number of attempts
+        of each read and the seconds from sending its first attempt to its result.
+    """
+    client = BacnetWrapper(bacpypes_ini, max_inflight=4, retries=5, hedge=hedge)
+    reads = [] # (Transaction, time it finished)
+    send_attempt = client._send_attempt
+
+    def record(txn):
+        if not txn.attempts:
+            read = [txn, None]
+            reads.append(read)
+            txn.future.add_done_callback(lambda future: read.__setitem__(1, time.time()))
+        send_attempt(txn)
+    client._send_attempt = record
+
+    values = client.read_many([(addr, farm_object_type(i % NUM_OBJECTS), i % NUM_OBJECTS)
+                               for i in range(num_reads)])
+    # A read that was never sent, e.g. to a device that stopped answering, took no time.
+    return values, [(len(txn.attempts), done - getattr(txn.attempts[0], 'sent_time', done))
+                    for txn, done in reads]
+
+
+def expected_values(num_reads):
+    return ['inactive' if farm_object_type(i % NUM_OBJECTS) == 'binaryValue'
+            else float(i % NUM_OBJECTS) for i in range(num_reads)]
+
+
+def test_lost_reads_are_retried(tmp_path, start_farm):
+    addrs = start_farm(FARM_PORT, num_objects=NUM_OBJECTS, loss=LOSS)
+    bacpypes_ini = write_client_ini(tmp_path, CLIENT_PORT)
+
+    values, reads = run_in_client(read_lossy, bacpypes_ini, addrs[1000], NUM_READS, False)
+
+    assert values == expected_values(NUM_READS)
+    assert any(num_attempts > 1 for num_attempts, _ in reads)
+    # Without hedging, a read is only sent again once it times out.
+    assert all(seconds >= rtt.MIN_TIMEOUT for num_attempts, seconds in reads
+               if num_attempts > 1)
+
+
+def test_slow_reads_are_hedged_before_they_time_out(tmp_path, start_farm):
+    addrs = start_farm(FARM_PORT + 1, num_objects=NUM_OBJECTS, loss=LOSS)
+    bacpypes_ini = write_client_ini(tmp_path, CLIENT_PORT + 1)
+
+    values, reads = run_in_client(read_lossy, bacpypes_ini, addrs[1000], NUM_READS, True)
+
+    assert values == expected_values(NUM_READS)
+    assert any(num_attempts > 1 and seconds < rtt.MIN_TIMEOUT
+               for num_attempts, seconds in reads)
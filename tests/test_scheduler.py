@@ -0,0 +1,107 @@
+""" Each point is polled at its own interval, from groups spread over the interval, and a
+    device is not polled while its breaker is open.
+"""
+
+import asyncio
+import logging
+import collections
+import time
+
+from brickbacnet.breaker import CircuitBreakers
+from brickbacnet.connector import Connector
+from brickbacnet.poll_plan import PollPlan, PollPoint
+from brickbacnet.scheduler import PollIntervals, PollSchedule
+
+
+DEVICE_ID = 1000
+
+
+def make_connector(plan):
+    """ A connector that polls `plan`, without a BACnet stack or a database. """
+    connector = object.__new__(Connector)
+    connector.logger = logging.getLogger('test_scheduler')
+    connector.min_interval = 0
+    connector.read_batch_size = 10
+    connector.read_sleeptime = 0
+    connector.device_breakers = CircuitBreakers(1, 10, 40)
+    connector.object_breakers = CircuitBreakers(1, 10, 40)
+    connector.get_poll_plan = lambda dev_id: plan
+    connector.restore_pacing = lambda plan: None
+    connector.get_points_to_poll = lambda plan, points: points
+    connector.update_breakers = lambda dev, objs, errors, now: None
+    connector.publish = lambda datapoints: None
+    connector.reads = collections.Counter() # uuid -> times read
+
+    async def read_window_async(dev, objs, errors=None):
+        connector.reads.update(obj.uuid for obj in objs)
+        return []
+    connector.read_window_async = read_window_async
+    return connector
+
+
+def make_plan(intervals):
+    """ A plan whose point `u<i>` is polled every `intervals[i]` seconds. """
+    points = [PollPoint(f'u{instance}', 'analogInput', instance, interval)
+              for instance, interval in enumerate(intervals)]
+    return PollPlan({'device_id': DEVICE_ID, 'addr': '127.0.0.1:47809'}, points, 0)
+
+
+async def poll_for(connector, seconds):
+    try:
+        await asyncio.wait_for(connector.read_device_forever_async(DEVICE_ID), seconds)
+    except asyncio.TimeoutError:
+        pass
+
+
+def test_an_open_breaker_is_waited_for_without_polling_again():
+    connector = make_connector(make_plan([0, 0, 0]))
+    probes = []
+
+    async def probe_device(plan, now):
+        probes.append(now)
+        return connector.device_breakers.allow(DEVICE_ID, now)
+
+    connector.probe_device = probe_device
+    connector.device_breakers.on_failure(DEVICE_ID, time.time()) # probed again in 10 seconds.
+
+    asyncio.run(poll_for(connector, 0.2))
+
+    assert len(probes) == 1
+
+
+def test_intervals_are_resolved_by_precedence():
+    intervals = PollIntervals(120, object_types={'binaryValue': 30},
+                              name_patterns={r'^zone_temp': 10})
+
+    assert intervals.resolve('analogInput', 'zone_temp_3', poll_interval=5) == 5
+    assert intervals.resolve('binaryValue', 'zone_temp_3') == 10
+    assert intervals.resolve('binaryValue', 'fan_status') == 30
+    assert intervals.resolve('analogInput', 'fan_speed') == 120
+
+
+def test_groups_are_spread_over_their_interval():
+    schedule = PollSchedule(make_plan([10, 10, 10, 10, 60, 60]), batch_size=2, now=100)
+
+    dues = sorted((due, [point.uuid for point in group.points])
+                  for due, _, group in schedule.queue)
+    assert dues == [(100, ['u0', 'u1']), (100, ['u4', 'u5']), (105, ['u2', 'u3'])]
+    assert [due for due, _ in schedule.pop_due(104)] == [100, 100]
+    assert schedule.next_due() == 105
+
+
+def test_a_late_group_keeps_its_phase():
+    schedule = PollSchedule(make_plan([10]), batch_size=2, now=100)
+    [(due, group)] = schedule.pop_due(100)
+
+    schedule.reschedule(due, group, now=134) # missed the polls at 110, 120 and 130.
+
+    assert schedule.next_due() == 140
+
+
+def test_points_are_polled_at_their_own_intervals():
+    connector = make_connector(make_plan([0.1, 0.1, 0.5]))
+
+    asyncio.run(poll_for(connector, 1.2))
+
+    assert 10 <= connector.reads['u0'] == connector.reads['u1'] <= 14
+    assert 2 <= connector.reads['u2'] <= 3
@@ -0,0 +1,157 @@
+""" The last value read of each point is served over HTTP, and the points read longer ago than
+    the age asked for are read from their devices first.
+"""
+
+import json
+import time
+import asyncio
+import logging
+import threading
+import http.client
+
+import pytest
+
+from brickbacnet.breaker import CircuitBreakers
+from brickbacnet.connector import Connector
+from brickbacnet.poll_plan import PollPlan, PollPoint
+from brickbacnet.snapshot import LastValues, start_snapshot_server
+
+
+DEVICE_ID = 1000
+
+
+def make_points(num_points):
+    return [PollPoint(f'u{instance}', 'analogInput', instance) for instance in range(num_points)]
+
+
+def make_datapoint(uuid, value, timestamp):
+    return {'uuid': uuid, 'timestamp': timestamp, 'value': value}
+
+
+def test_the_newest_value_of_a_point_is_kept():
+    last_values = LastValues()
+    last_values.set_points(DEVICE_ID, make_points(2))
+
+    last_values.update([make_datapoint('u0', 20.0, 100), make_datapoint('u9', 1.0, 100)])
+    # A notification older than the value read.
+    last_values.update([make_datapoint('u0', 19.0, 99)])
+
+    slots, unknown = last_values.find_slots(['u0', 'u9'], [])
+    assert unknown == ['u9']
+    entries = last_values.get(slots, 60, 130)
+    assert [(entry['value'], entry['age'], entry['stale']) for entry in entries] == \
+        [(20.0, 30, False)]
+
+
+def test_stale_points_are_those_still_polled():
+    last_values = LastValues()
+    last_values.set_points(DEVICE_ID, make_points(3))
+    last_values.update([make_datapoint('u0', 20.0, 100), make_datapoint('u1', 21.0, 10)])
+    slots, _ = last_values.find_slots(device_ids=[DEVICE_ID])
+
+    stale = last_values.stale_points(slots, 60, 130)
+    assert [point.uuid for point in stale[DEVICE_ID]] == ['u1', 'u2']
+
+    # e.g. u1 was quarantined. Its last value is still served.
+    last_values.set_points(DEVICE_ID, [point for point in make_points(3) if point.uuid != 'u1'])
+    assert [point.uuid for point in last_values.stale_points(slots, 60, 130)[DEVICE_ID]] \
+        == ['u2']
+    assert last_values.get(slots, 60, 130)[1]['value'] == 21.0
+
+
+@pytest.fixture
+def snapshot_server():
+    """ A snapshot server of the values in a LastValues, and the requests it got. """
+    last_values = LastValues()
+    last_values.set_points(DEVICE_ID, make_points(3))
+    last_values.update([make_datapoint('u0', 20.0, time.time())])
+    requests = []
+
+    def get_values(uuids, device_ids, max_age):
+        requests.append((uuids, device_ids, max_age))
+        slots, unknown = last_values.find_slots(uuids, device_ids)
+        return {'values': last_values.get(slots, max_age or 600, time.time()), 'unknown': unknown}
+
+    server = start_snapshot_server(get_values, 0, host='127.0.0.1')
+    yield server.server_address[1], requests
+    server.shutdown()
+
+
+def request(port, method, path, body=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    conn.request(method, path, body=None if body is None else json.dumps(body))
+    response = conn.getresponse()
+    payload = response.read()
+    conn.close()
+    return response.status, json.loads(payload) if response.status == 200 else None
+
+
+def test_values_are_served_by_uuid_or_device(snapshot_server):
+    port, requests = snapshot_server
+
+    status, body = request(port, 'GET', '/values?uuids=u0,u7&max_age=30')
+    assert status == 200
+    assert [entry['value'] for entry in body['values']] == [20.0]
+    assert body['unknown'] == ['u7']
+
+    status, body = request(port, 'POST', '/values', {'devices': [DEVICE_ID]})
+    assert status == 200
+    assert [(entry['uuid'], entry['stale']) for entry in body['values']] == \
+        [('u0', False), ('u1', True), ('u2', True)]
+    assert requests == [(['u0', 'u7'], [], 30.0), ([], [DEVICE_ID], None)]
+
+
+def test_bad_requests_are_refused(snapshot_server):
+    port, requests = snapshot_server
+
+    assert request(port, 'GET', '/values?devices=ahu')[0] == 400
+    assert request(port, 'POST', '/values', ['u0'])[0] == 400
+    assert request(port, 'GET', '/points')[0] == 404
+    assert requests == []
+
+
+def make_connector(plan):
+    """ A connector that reads `plan` in its own event loop, without a BACnet stack. """
+    connector = object.__new__(Connector)
+    connector.logger = logging.getLogger('test_snapshot')
+    connector.read_batch_size = 2
+    connector.snapshot_max_age = 60
+    connector.device_breakers = CircuitBreakers(1, 10, 40)
+    connector.object_breakers = CircuitBreakers(1, 10, 40)
+    connector.update_breakers = lambda dev, objs, errors, now: None
+    connector.poll_plans = {DEVICE_ID: plan}
+    connector.last_values = LastValues()
+    connector.last_values.set_points(DEVICE_ID, plan.points)
+    connector.reads = []
+
+    async def read_window_async(dev, objs, errors=None):
+        connector.reads.append([obj.uuid for obj in objs])
+        return [make_datapoint(obj.uuid, float(obj.instance), time.time()) for obj in objs]
+    connector.read_window_async = read_window_async
+    connector.loop = asyncio.new_event_loop()
+    threading.Thread(target=connector.loop.run_forever, daemon=True).start()
+    return connector
+
+
+def test_stale_points_are_read_before_they_are_served():
+    plan = PollPlan({'device_id': DEVICE_ID, 'addr': '127.0.0.1:47809'}, make_points(3), 0)
+    connector = make_connector(plan)
+    connector.last_values.update([make_datapoint('u0', 20.0, time.time() - 10)])
+    try:
+        values = connector.get_last_values(device_ids=[DEVICE_ID], max_age=30)
+
+        assert connector.reads == [['u1', 'u2']]
+        assert [entry['value'] for entry in values['values']] == [20.0, 1.0, 2.0]
+        assert not any(entry['stale'] for entry in values['values'])
+
+        connector.reads.clear()
+        # Read in windows of `read_batch_size`, but not while the device's breaker is open.
+        connector.get_last_values(device_ids=[DEVICE_ID], max_age=0)
+        assert connector.reads == [['u0', 'u1'], ['u2']]
+        connector.device_breakers.on_failure(DEVICE_ID, time.time())
+        connector.reads.clear()
+        values = connector.get_last_values(device_ids=[DEVICE_ID], max_age=0)
+        assert connector.reads == []
+        assert all(entry['stale'] for entry in values['values'])
+    finally:
+        connector.loop.call_soon_threadsafe(connector.loop.stop)
@@ -0,0 +1,57 @@
+""" Databases written by older versions, with a table of objects per device, are migrated to
+    the single object_table when they are opened.
+"""
+
+import sqlite3
+
+from brickbacnet.sqlite_wrapper import SqliteWrapper
+
+
+def make_legacy_db(path):
+    """ A database as the per-device-table versions wrote it. """
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE device_table ( version varchar(255), device_id int, " +
+                 "description varchar(255), jci_name varchar(255), name varchar(255), " +
+                 "ip_addr varchar(12), max_apdu int, uuid str, vendor_id int)")
+    conn.execute("CREATE TABLE uuid_table (uuid, nae_id int, instance int)")
+    conn.execute("INSERT INTO device_table VALUES ('v1', 1000, '', '', 'ahu', " +
+                 "'127.0.0.1:47809', 1476, NULL, 5)")
+    for device_id in (1000, 1001):
+        conn.execute(f"CREATE TABLE table_{device_id}_v1 ( uuid varchar(36), device_ref int, " +
+                     "instance int, object_type int, description varchar(255), " +
+                     "jci_name varchar(255), name varchar(255), unit varchar(255))")
+        conn.executemany(f"INSERT INTO table_{device_id}_v1 VALUES (?, ?, ?, ?, '', '', ?, '')",
+                         [(f'{device_id}-0', device_id, 0, 'analogInput', 'temp'),
+                          (f'{device_id}-1', device_id, 1, 'binaryValue', 'fan'),
+                          (None, device_id, None, None, None)])
+    conn.commit()
+    conn.close()
+
+
+def test_legacy_object_tables_are_migrated(tmp_path):
+    path = str(tmp_path / 'b2b.db')
+    make_legacy_db(path)
+
+    db = SqliteWrapper(path)
+
+    tables = set(row[0] for row in db.conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table'"))
+    assert not any(name.startswith('table_') for name in tables)
+    assert 'uuid_table' not in tables
+    for device_id in (1000, 1001):
+        assert db.find_obj_uuids(device_id) == {('analogInput', 0): f'{device_id}-0',
+                                                ('binaryValue', 1): f'{device_id}-1'}
+    assert db.find_obj_uuid(1001, 'binaryValue', 1) == '1001-1'
+    assert db.read_device_properties(1000)['addr'] == '127.0.0.1:47809'
+    assert db.read_device_revision(1000) == (None, None)
+
+
+def test_migrated_database_opens_again_unchanged(tmp_path):
+    path = str(tmp_path / 'b2b.db')
+    make_legacy_db(path)
+    data_version = SqliteWrapper(path).data_version()
+
+    db = SqliteWrapper(path)
+
+    assert db.data_version() == data_version
+    assert len(db.read_objects(1000)) == 2
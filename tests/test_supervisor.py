@@ -0,0 +1,208 @@
+""" Workers share one SQLite database, so what one of them writes must not start the polling
+    schedules of the others over, and share the actuation and snapshot ports of the supervisor,
+    which forwards each request to the worker polling its device.
+"""
+
+import os
+import time
+import uuid
+import signal
+import socket
+import multiprocessing
+
+import pytest
+import requests
+
+from brickbacnet.benchmark import CLIENT_INI_TEMPLATE, run_discovery
+from brickbacnet.poll_plan import PollPlan, PollPoint
+from brickbacnet.scheduler import PollSchedule
+from brickbacnet.simulator import run_farm
+from brickbacnet.sqlite_wrapper import SqliteWrapper
+from brickbacnet.supervisor import Supervisor
+
+
+NUM_DEVICES = 4
+NUM_OBJECTS = 60
+FARM_PORT = 47920
+CLIENT_PORT = 47780
+ACTUATION_PORT = 48280
+SNAPSHOT_PORT = 48290
+
+
+class RecordingDs(object):
+    """ A data service that appends the uuids uploaded to it to a file per process. """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def put_timeseries_data(self, datapoints):
+        with open(os.path.join(self.directory, str(os.getpid())), 'a') as fp:
+            fp.writelines(datapoint['uuid'] + '\n' for datapoint in datapoints)
+
+
+def test_pacing_does_not_change_data_version(tmp_path):
+    path = str(tmp_path / 'b2b.db')
+    worker_db = SqliteWrapper(path)
+    other_worker_db = SqliteWrapper(path)
+    data_version = worker_db.data_version()
+
+    other_worker_db.write_pacing(1000, 4, 0.01)
+
+    assert worker_db.data_version() == data_version
+
+
+def test_schedule_keeps_due_times_of_unchanged_groups():
+    points = [PollPoint(f'u{i}', 'analogInput', i, interval=60) for i in range(40)]
+    schedule = PollSchedule(PollPlan({}, points, 0), batch_size=10, now=0)
+    for due, group in schedule.pop_due(30):
+        schedule.reschedule(due, group, 30)
+    dues = sorted(due for due, _, _ in schedule.queue)
+
+    recompiled = [PollPoint(point.uuid, point.object_type, point.instance, point.interval)
+                  for point in points]
+    schedule = PollSchedule(PollPlan({}, recompiled, 1), batch_size=10, now=45, previous=schedule)
+
+    assert sorted(due for due, _, _ in schedule.queue) == dues
+
+
+@pytest.fixture(scope='module')
+def discovered(tmp_path_factory):
+    """ (BACpypes.ini, SQLite database) of a simulated farm whose objects were discovered and
+        given uuids.
+    """
+    workdir = tmp_path_factory.mktemp('farm')
+    ready = multiprocessing.Event()
+    farm = multiprocessing.Process(
+        target=run_farm, daemon=True,
+        kwargs=dict(num_devices=NUM_DEVICES, num_objects=NUM_OBJECTS, base_port=FARM_PORT,
+                    latency=0.005, ready=ready))
+    farm.start()
+    assert ready.wait(60)
+    device_ids = [1000 + i for i in range(NUM_DEVICES)]
+    bacpypes_ini = str(workdir / 'client.ini')
+    with open(bacpypes_ini, 'w') as fp:
+        fp.write(CLIENT_INI_TEMPLATE.format(port=CLIENT_PORT))
+    sqlite_db = str(workdir / 'b2b.db')
+    db = SqliteWrapper(sqlite_db)
+    for i, dev_id in enumerate(device_ids):
+        db.write_device_properties({'device_id': dev_id, 'description': '', 'jci_name': '',
+                                    'name': '', 'addr': f'127.0.0.1:{FARM_PORT + i}',
+                                    'max_apdu': 0, 'vendor_id': 0})
+    results = multiprocessing.Queue()
+    discovery = multiprocessing.Process(target=run_discovery,
+                                        args=(bacpypes_ini, sqlite_db, device_ids, {}, results))
+    discovery.start()
+    results.get(timeout=60)
+    discovery.join()
+    for dev_id in device_ids:
+        db.update_obj_properties(dev_id, 'uuid', {
+            (obj['object_type'], obj['instance']): str(uuid.uuid4())
+            for obj in db.read_objects(dev_id)})
+    yield bacpypes_ini, sqlite_db
+    farm.kill()
+    farm.join()
+
+
+def run_supervisor(connector_params, bacnet_port, num_workers=2):
+    """ Start a supervisor in a process of its own, as `b2b connector` runs it. """
+    device_ids = [1000 + i for i in range(NUM_DEVICES)]
+    def run():
+        Supervisor(connector_params, device_ids, bacnet_port, num_workers=num_workers,
+                   report_interval=1).run_forever()
+    process = multiprocessing.get_context('fork').Process(target=run)
+    process.start()
+    return process
+
+
+def stop_supervisor(process):
+    os.kill(process.pid, signal.SIGTERM)
+    process.join(30)
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+def test_every_point_is_polled_by_workers(tmp_path, discovered):
+    bacpypes_ini, sqlite_db = discovered
+    uuids = set()
+    db = SqliteWrapper(sqlite_db)
+    for dev_id in range(1000, 1000 + NUM_DEVICES):
+        uuids.update(db.find_obj_uuids(dev_id).values())
+
+    uploads = tmp_path / 'uploads'
+    uploads.mkdir()
+    connector_params = {
+        'bacpypes_ini': bacpypes_ini,
+        'ds_if': RecordingDs(str(uploads)),
+        'sqlite_db': sqlite_db,
+        'logdir': str(tmp_path / 'logs'),
+        # Each device is polled in 6 groups spread over 4 seconds, while every worker saves
+        # its pacing several times a second.
+        'min_interval': 4,
+        'read_batch_size': 10,
+        'pacing_save_interval': 0.3,
+        'upload_interval': 0.2,
+    }
+    process = run_supervisor(connector_params, CLIENT_PORT + 1)
+    time.sleep(12)
+    stop_supervisor(process)
+
+    polled = set()
+    for path in uploads.iterdir():
+        polled.update(path.read_text().split())
+    assert polled == uuids
+
+
+def test_requests_are_forwarded_to_the_worker_of_their_device(tmp_path, discovered):
+    bacpypes_ini, sqlite_db = discovered
+    db = SqliteWrapper(sqlite_db)
+    targets = {dev_id: db.find_obj_uuids(dev_id)[('analogValue', 1)]
+               for dev_id in range(1000, 1000 + NUM_DEVICES)}
+    connector_params = {
+        'bacpypes_ini': bacpypes_ini,
+        'ds_if': RecordingDs(str(tmp_path)),
+        'sqlite_db': sqlite_db,
+        'logdir': str(tmp_path / 'logs'),
+        'min_interval': 60,
+        'actuation_port': ACTUATION_PORT,
+        'snapshot_port': SNAPSHOT_PORT,
+    }
+    process = run_supervisor(connector_params, CLIENT_PORT + 3)
+    try:
+        for port in (ACTUATION_PORT, ACTUATION_PORT + 1, ACTUATION_PORT + 2):
+            wait_for_port(port)
+        writes = [{'uuid': uuid, 'value': 40.0 + i, 'priority': 8}
+                  for i, uuid in enumerate(targets.values())]
+        writes.append({'device_id': 999, 'object_type': 'analogValue', 'instance': 1,
+                       'value': 1.0})
+        resp = requests.post(f'http://127.0.0.1:{ACTUATION_PORT}/write',
+                             json={'writes': writes}, timeout=60)
+        results = resp.json()['results']
+        assert [result['status'] for result in results] == ['ok'] * NUM_DEVICES + ['error']
+
+        resp = requests.post(f'http://127.0.0.1:{SNAPSHOT_PORT}/values',
+                             json={'uuids': list(targets.values()) + ['nope'], 'max_age': 0},
+                             timeout=60)
+        body = resp.json()
+        assert {entry['uuid']: entry['value'] for entry in body['values']} == \
+            {uuid: 40.0 + i for i, uuid in enumerate(targets.values())}
+        assert body['unknown'] == ['nope']
+
+        # A worker takes only the writes to its own devices.
+        direct = [requests.post(f'http://127.0.0.1:{ACTUATION_PORT + 1 + shard}/write',
+                                json={'writes': writes[:NUM_DEVICES]}, timeout=60)
+                  .json()['results'] for shard in range(2)]
+        assert sorted(sum((result['status'] == 'ok' for result in results), 0)
+                      for results in direct) == [NUM_DEVICES // 2] * 2
+    finally:
+        stop_supervisor(process)
+
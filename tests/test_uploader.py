@@ -0,0 +1,136 @@
+""" Datapoints wait in a bounded buffer, in memory or in a durable outbox, and leave it only
+    once the data service has stored them.
+"""
+
+import time
+import threading
+
+from brickbacnet.ds_iface import PartialUpload
+from brickbacnet.outbox import Outbox
+from brickbacnet.uploader import MemoryBuffer, Uploader
+
+
+def make_datapoints(num_rows, object_type='analogInput'):
+    return [{'uuid': f'u{i}', 'object_type': object_type, 'timestamp': float(i), 'value': i}
+            for i in range(num_rows)]
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+class RecordingDs(object):
+    """ Records the batches it is given, and raises the exceptions in `failures` first. """
+
+    def __init__(self, failures=()):
+        self.failures = list(failures)
+        self.batches = []
+        self.lock = threading.Lock()
+
+    def put_timeseries_data(self, datapoints):
+        with self.lock:
+            self.batches.append(list(datapoints))
+            if self.failures:
+                raise self.failures.pop(0)
+
+
+def test_only_the_rest_of_a_partial_upload_is_uploaded_again():
+    datapoints = make_datapoints(4)
+    ds = RecordingDs([PartialUpload('text failed', datapoints[2:])])
+    uploader = Uploader(ds, MemoryBuffer(), flush_rows=4, flush_interval=0)
+
+    uploader.put(datapoints)
+    wait_until(lambda: len(ds.batches) == 2 and uploader.stats()['queued_rows'] == 0)
+
+    assert ds.batches == [datapoints, datapoints[2:]]
+    assert uploader.stats()['uploaded_rows'] == 4
+
+
+def test_batches_are_uploaded_when_full_or_once_the_oldest_row_waited():
+    ds = RecordingDs()
+    uploader = Uploader(ds, MemoryBuffer(), flush_rows=3, flush_interval=0.5)
+    datapoints = make_datapoints(7)
+
+    t0 = time.time()
+    uploader.put(datapoints)
+    wait_until(lambda: len(ds.batches) == 2)
+    assert time.time() - t0 < 0.4
+    wait_until(lambda: len(ds.batches) == 3)
+
+    assert time.time() - t0 >= 0.5
+    assert ds.batches == [datapoints[:3], datapoints[3:6], datapoints[6:]]
+
+
+def test_a_full_buffer_drops_the_oldest_rows_without_blocking_readers():
+    uploading = threading.Event()
+    released = threading.Event()
+
+    class SlowDs(RecordingDs):
+        def put_timeseries_data(self, datapoints):
+            uploading.set()
+            released.wait()
+            RecordingDs.put_timeseries_data(self, datapoints)
+    ds = SlowDs()
+    uploader = Uploader(ds, MemoryBuffer(max_rows=10), flush_rows=4, flush_interval=0)
+    datapoints = make_datapoints(16)
+
+    uploader.put(datapoints[:4])
+    assert uploading.wait(10)
+    t0 = time.time()
+    for i in range(4, 16, 4):
+        uploader.put(datapoints[i:i + 4])
+    assert time.time() - t0 < 0.1
+    released.set()
+    wait_until(lambda: uploader.stats()['queued_rows'] == 0)
+
+    # The batch being uploaded was dropped from the buffer along with the next oldest rows,
+    # but it is still uploaded.
+    assert uploader.stats()['dropped_rows'] == 6
+    uploaded = [datapoint['uuid'] for batch in ds.batches for datapoint in batch]
+    assert uploaded[:4] == ['u0', 'u1', 'u2', 'u3']
+    assert uploaded[-10:] == [f'u{i}' for i in range(6, 16)]
+
+
+def test_outbox_keeps_rows_until_they_are_acknowledged(tmp_path):
+    path = str(tmp_path / 'outbox.db')
+    datapoints = make_datapoints(5, 'binaryValue')
+    outbox = Outbox(path)
+    outbox.append(datapoints, time.time())
+    key, batch = outbox.peek(3)
+    assert batch == datapoints[:3]
+
+    outbox.ack(key)
+    reopened = Outbox(path) # as after a restart of the connector.
+
+    assert len(reopened) == 2
+    assert reopened.peek(10)[1] == datapoints[3:]
+
+
+def test_outbox_evicts_the_oldest_rows_over_its_quota(tmp_path):
+    outbox = Outbox(str(tmp_path / 'outbox.db'), max_bytes=64 * 1024)
+
+    num_evicted = sum(outbox.append(make_datapoints(100), time.time()) for _ in range(100))
+
+    assert num_evicted > 0
+    assert len(outbox) == 100 * 100 - num_evicted
+    assert outbox.used_bytes() <= 64 * 1024
+    # The newest rows are kept.
+    assert outbox.peek(len(outbox))[1][-100:] == make_datapoints(100)
+
+
+def test_rows_survive_a_data_service_outage_in_the_outbox(tmp_path):
+    path = str(tmp_path / 'outbox.db')
+    datapoints = make_datapoints(4)
+    ds = RecordingDs([ConnectionError('down'), ConnectionError('down')])
+    uploader = Uploader(ds, Outbox(path), flush_rows=4, flush_interval=0)
+
+    uploader.put(datapoints)
+    wait_until(lambda: len(ds.batches) == 3)
+    wait_until(lambda: uploader.stats()['queued_rows'] == 0)
+
+    assert ds.batches == [datapoints] * 3
+    assert uploader.stats()['failed_uploads'] == 2
+    assert len(Outbox(path)) == 0